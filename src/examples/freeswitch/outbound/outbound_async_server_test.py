@@ -66,7 +66,7 @@ class AsyncOutboundServer(OutboundServer):
         self.log.info("Start server %s ..." % str(address))
         OutboundServer.__init__(self, address, handle_class, filter)
 
-    def do_handle(self, socket, address):
+    def handle_call(self, socket, address):
         self.log.info("New request from %s" % str(address))
         self._handle_class(socket, address, self.log, filter=self._filter)
         self.log.info("End request from %s" % str(address))
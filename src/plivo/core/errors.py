@@ -6,7 +6,7 @@ Exceptions classes
 """
 
 class LimitExceededError(Exception):
-    '''Exception class when MAXLINES_PER_EVENT is reached'''
+    '''Exception class when max header size of an event is reached'''
     pass
 
 
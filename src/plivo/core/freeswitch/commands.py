@@ -18,6 +18,20 @@ class Commands(object):
         "Please refer to http://wiki.freeswitch.org/wiki/Event_Socket#bgapi"
         return self._protocol_send("bgapi", args)
 
+    def api_async(self, args):
+        """Same as api but doesn't wait for the response.
+
+        Returns an AsyncResult, use get() to wait for the ApiResponse.
+        """
+        return self._protocol_send_async("api", args)
+
+    def bgapi_async(self, args):
+        """Same as bgapi but doesn't wait for the response.
+
+        Returns an AsyncResult, use get() to wait for the BgapiResponse.
+        """
+        return self._protocol_send_async("bgapi", args)
+
     def exit(self):
         "Please refer to http://wiki.freeswitch.org/wiki/Event_Socket#exit"
         return self._protocol_send("exit")
@@ -5,6 +5,7 @@
 Event Socket class
 """
 
+from collections import deque
 import types
 import gevent
 import gevent.socket as socket
@@ -12,19 +13,55 @@ import gevent.queue as queue
 import gevent.pool
 from gevent import GreenletExit
 from gevent.coros import RLock
+from gevent.event import AsyncResult
 from plivo.core.freeswitch.commands import Commands
-from plivo.core.freeswitch.eventtypes import Event, CommandResponse, ApiResponse, BgapiResponse, JsonEvent
+from plivo.core.freeswitch.eventtypes import Event, CommandResponse, ApiResponse, BgapiResponse, JsonEvent, \
+                                            UJSON_DECODER
+from plivo.core.freeswitch.frameparser import FrameParser
 from plivo.core.errors import LimitExceededError, ConnectError
 
 
 EOL = "\n"
-MAXLINES_PER_EVENT = 1000
+YIELD_EVERY_FRAMES = 100
+
+
+
+class YieldPolicy(object):
+    '''
+    Cooperative yield policy for the event handler.
+
+    Yields to other greenlets every `frames` frames read,
+    or when all buffered data has been parsed if `on_drain` is True.
+    '''
+    def __init__(self, frames=YIELD_EVERY_FRAMES, on_drain=True):
+        self.frames = frames
+        self.on_drain = on_drain
+        self._count = 0
+
+    def step(self, pending=0):
+        '''
+        Called after each frame with the number of buffered bytes left.
+        '''
+        self._count += 1
+        if self._count >= self.frames or (self.on_drain and not pending):
+            self._count = 0
+            gevent.sleep(0)
 
 
 
 class EventSocket(Commands):
     '''EventSocket class'''
-    def __init__(self, filter="ALL", pool_size=5000, eventjson=True):
+    # Events are read with lazy headers decoding
+    LAZY_EVENTS = True
+    # Decoder for json events, see eventtypes.JsonDecoder
+    JSON_DECODER = UJSON_DECODER
+    # Handlers found by class, for each (Event-Name, Event-Subclass)
+    _handler_tables = {}
+    # Logger, set by subclasses (optional)
+    log = None
+
+    def __init__(self, filter="ALL", pool_size=5000, eventjson=True,
+                 yield_policy=None, scheduler=None):
         self._is_eventjson = eventjson
         # Callbacks for reading events and sending responses.
         self._response_callbacks = {'api/response':self._api_response,
@@ -40,9 +77,13 @@ class EventSocket(Commands):
         self._closing_state = False
         # Default event filter.
         self._filter = filter
-        # Synchronized Gevent based Queue for response events.
+        # Synchronized Gevent based Queue for responses
+        # not matching a command (auth/request).
         self._response_queue = queue.Queue(1)
-        # Lock to force eventsocket commands to be sequential.
+        # FIFO of (AsyncResult, cast) for commands waiting a response,
+        # responses arrive in the same order as commands are sent.
+        self._pending = deque()
+        # Lock to keep command writes and pending responses in the same order.
         self._lock = RLock()
         # Sets connected to False.
         self.connected = False
@@ -54,6 +95,18 @@ class EventSocket(Commands):
             self.pool = None
         # Handler thread
         self._handler_thread = None
+        # Frame parser, created on connect
+        self._parser = None
+        # Yield policy for event handler
+        if yield_policy is None:
+            yield_policy = YieldPolicy()
+        self._yield_policy = yield_policy
+        # Dispatch scheduler for events (optional)
+        self._scheduler = scheduler
+        # Handlers registered for this instance by Event-Name
+        self._handlers = {}
+        # Only dispatches events for this Unique-ID if set
+        self._unique_id_filter = None
 
     def _spawn(self, func, *args, **kwargs):
         '''
@@ -72,10 +125,18 @@ class EventSocket(Commands):
         '''
         return self.connected
 
+    def get_pending_count(self):
+        '''
+        Gets number of commands waiting a response.
+        '''
+        return len(self._pending)
+
     def start_event_handler(self):
         '''
         Starts Event handler in background.
         '''
+        if self._scheduler:
+            self._scheduler.start(self.dispatch_event, self.log)
         self._handler_thread = gevent.spawn(self.handle_events)
 
     def stop_event_handler(self):
@@ -93,52 +154,53 @@ class EventSocket(Commands):
             try:
                 # Gets event and dispatches to handler.
                 ev = self.get_event()
-                # Only dispatches event if Event-Name header found.
+                # Only dispatches event if Event-Name header found
                 if ev and ev['Event-Name']:
-                    self._spawn(self.dispatch_event, ev)
-                gevent.sleep(0.0001)
+                    self.route_event(ev)
+                self._yield_policy.step(self._parser.pending())
             except (LimitExceededError, ConnectError, socket.error):
                 self.connected = False
                 break
             except GreenletExit, e:
                 self.connected = False
                 break
+        # Releases commands still waiting a response
+        self._flush_pending()
         return
 
+    def route_event(self, event):
+        '''
+        Queues event for dispatch, unless filtered by Unique-ID.
+        '''
+        if self.is_filtered(event):
+            return
+        if self._scheduler:
+            self._scheduler.put(event)
+        else:
+            self._spawn(self.dispatch_event, event)
+
     def read_event(self):
         '''
-        Reads one Event from socket until EOL.
+        Reads one complete frame from socket.
 
-        Returns Event instance.
+        Returns Event instance, with raw frame body (if any) as Event body.
 
-        Raises LimitExceededError if MAXLINES_PER_EVENT is reached.
+        Raises LimitExceededError if max header size is reached.
         '''
-        buff = ''
-        for x in range(MAXLINES_PER_EVENT):
-            line = self.transport.read_line()
-            gevent.sleep(0.0001)
-            if line == '':
-                raise ConnectError("connection closed")
-            elif line == EOL:
-                # When matches EOL, creates Event and returns it.
-                return Event(buff)
-            else:
-                # Else appends line to current buffer.
-                buff += line
-        raise LimitExceededError("max lines per event (%d) reached" % MAXLINES_PER_EVENT)
+        header, body = self._parser.read_frame()
+        event = Event(header, lazy=self.LAZY_EVENTS)
+        if body:
+            event.set_body(body)
+        return event
 
     def read_raw(self, event):
         '''
-        Reads raw data based on Event Content-Length.
+        Gets raw data read with Event based on Content-Length.
 
         Returns raw string or None if not found.
         '''
-        length = event.get_content_length()
-        # Reads length bytes if length > 0
-        if length:
-            res = self.transport.read(int(length))
-            gevent.sleep(0.0001)
-            return res
+        if event.get_content_length():
+            return event.get_body()
         return None
 
     def read_raw_response(self, event, raw):
@@ -181,18 +243,39 @@ class EventSocket(Commands):
         # If raw was found, this is our Event body.
         if raw:
             event.set_body(raw)
-        # Pushes Event to response events queue and returns Event.
-        self._response_queue.put(event)
+        # Sets pending command response and returns Event.
+        self._push_response(event)
         return event
 
     def _command_reply(self, event):
         '''
         Receives command/reply callback.
         '''
-        # Pushes Event to response events queue and returns Event.
-        self._response_queue.put(event)
+        # Sets pending command response and returns Event.
+        self._push_response(event)
         return event
 
+    def _push_response(self, event):
+        '''
+        Sets response Event to the oldest command waiting a response.
+
+        If no command is waiting, pushes Event to response events queue.
+        '''
+        try:
+            result, cast = self._pending.popleft()
+        except IndexError:
+            self._response_queue.put(event)
+            return
+        result.set(cast(event))
+
+    def _flush_pending(self):
+        '''
+        Sets an empty response to all commands waiting a response.
+        '''
+        while self._pending:
+            result, cast = self._pending.popleft()
+            result.set(cast(Event()))
+
     def _event_plain(self, event):
         '''
         Receives text/event-plain callback.
@@ -202,7 +285,7 @@ class EventSocket(Commands):
         # If raw was found drops current event
         # and replaces with Event created from raw
         if raw:
-            event = Event(raw)
+            event = Event(raw, lazy=self.LAZY_EVENTS)
             # Gets raw response from Event Content-Length header
             # and raw buffer
             raw_response = self.read_raw_response(event, raw)
@@ -221,7 +304,7 @@ class EventSocket(Commands):
         # If raw was found drops current event
         # and replaces with JsonEvent created from json_data
         if json_data:
-            event = JsonEvent(json_data)
+            event = JsonEvent(json_data, self.JSON_DECODER)
         # Returns Event
         return event
 
@@ -240,22 +323,106 @@ class EventSocket(Commands):
         '''
         pass
 
+    def set_unique_id_filter(self, uuid):
+        '''
+        Only dispatches events without Unique-ID or with this Unique-ID.
+
+        Set to None to dispatch all events.
+        '''
+        self._unique_id_filter = uuid
+
+    def is_filtered(self, event):
+        '''
+        Returns True if event is for another Unique-ID than the filter one.
+        '''
+        if not self._unique_id_filter:
+            return False
+        uuid = event['Unique-ID']
+        return uuid and uuid != self._unique_id_filter
+
+    def register_handler(self, handler, name, subclass=None):
+        '''
+        Registers handler(event) for Event-Name name.
+
+        If subclass is set, handler is only called for this Event-Subclass.
+        Several handlers can be registered for a same event.
+        '''
+        self._handlers.setdefault(name, []).append((subclass, handler))
+
+    def unregister_handler(self, handler, name):
+        '''
+        Unregisters handler for Event-Name name.
+        '''
+        self._handlers[name] = [ (subclass, h) for subclass, h
+                                 in self._handlers.get(name, []) if h != handler ]
+
+    @classmethod
+    def refresh_handlers(cls):
+        '''
+        Clears handlers table of this class.
+
+        Must be called if on_ methods are added to class at runtime.
+        '''
+        cls._handler_tables.pop(cls, None)
+
+    @classmethod
+    def _find_handlers(cls, name, subclass):
+        '''
+        Finds handler names and class handlers (None if not defined)
+        for an Event-Name and Event-Subclass.
+
+        E.g. for CUSTOM event with conference::maintenance subclass,
+        finds on_custom_conference_maintenance and on_custom methods.
+        '''
+        methods = []
+        method = 'on_' + name.lower()
+        if subclass:
+            methods.append(method + '_' + subclass.lower().replace('::', '_'))
+        methods.append(method)
+        return tuple([ (m, getattr(cls, m, None)) for m in methods ])
+
     def dispatch_event(self, event):
         '''
-        Dispatches one event with callback.
+        Dispatches one event with callbacks.
 
         E.g. Receives Background_Job event and calls on_background_job function.
         '''
-        method = 'on_' + event['Event-Name'].lower()
-        callback = getattr(self, method, None)
-        # When no callbacks found, call unbound_event.
-        if not callback:
-            callback = self.unbound_event
-        # Calls callback.
+        name = event['Event-Name']
+        if name == 'CUSTOM':
+            subclass = event['Event-Subclass']
+        else:
+            subclass = None
+        # Gets class handlers from table, finds them on first event.
+        cls = self.__class__
         try:
-            callback(event)
-        except:
-            self.callback_failure(event)
+            table = self._handler_tables[cls]
+        except KeyError:
+            table = self._handler_tables[cls] = {}
+        try:
+            handlers = table[(name, subclass)]
+        except KeyError:
+            handlers = table[(name, subclass)] = cls._find_handlers(name, subclass)
+        callbacks = []
+        for method, handler in handlers:
+            # Handlers set on instance override class handlers.
+            callback = self.__dict__.get(method)
+            if callback is None and handler is not None:
+                callback = handler.__get__(self, cls)
+            if callback:
+                callbacks.append(callback)
+        # Adds instance handlers.
+        for handler_subclass, handler in self._handlers.get(name, ()):
+            if handler_subclass is None or handler_subclass == subclass:
+                callbacks.append(handler)
+        # When no callbacks found, call unbound_event.
+        if not callbacks:
+            callbacks = [self.unbound_event]
+        # Calls callbacks.
+        for callback in callbacks:
+            try:
+                callback(event)
+            except:
+                self.callback_failure(event)
 
     def callback_failure(self, event):
         '''
@@ -278,6 +445,10 @@ class EventSocket(Commands):
         Connects to eventsocket.
         '''
         self._closing_state = False
+        # New frame parser, drops any data from a previous connection
+        self._parser = FrameParser(self.transport)
+        # Releases commands left from a previous connection
+        self._flush_pending()
 
     def disconnect(self):
         '''
@@ -289,6 +460,7 @@ class EventSocket(Commands):
             pass
         self._handler_thread.kill()
         # prevent any pending request to be stuck
+        self._flush_pending()
         self._response_queue.put_nowait(Event())
         self.connected = False
 
@@ -313,37 +485,59 @@ class EventSocket(Commands):
             msg += "content-type: text/plain\ncontent-length: %d\n\n%s\n" % (arglen, arg)
         self.transport.write(msg + EOL)
 
-    def _protocol_send(self, command, args=""):
-        if self._closing_state:
-            return Event()
-        self._lock.acquire()
-        try:
-            self._send("%s %s" % (command, args))
-            event = self._response_queue.get()
-        finally:
-            self._lock.release()
+    def _protocol_send_async(self, command, args=""):
+        '''
+        Sends a command without waiting for its response.
+
+        Returns an AsyncResult, set with the response Event.
+        '''
         # Casts Event to appropriate event type :
         # Casts to ApiResponse, if event is api
         if command == 'api':
-            event = ApiResponse.cast(event)
+            cast = ApiResponse.cast
         # Casts to BgapiResponse, if event is bgapi
         elif command == "bgapi":
-            event = BgapiResponse.cast(event)
+            cast = BgapiResponse.cast
         # Casts to CommandResponse by default
         else:
-            event = CommandResponse.cast(event)
-        gevent.sleep(0.0001)
-        return event
+            cast = CommandResponse.cast
+        return self._pipeline(cast, self._send, "%s %s" % (command, args))
 
-    def _protocol_sendmsg(self, name, args=None, uuid="", lock=False, loops=1):
+    def _protocol_sendmsg_async(self, name, args=None, uuid="", lock=False, loops=1):
+        '''
+        Sends a message without waiting for its response.
+
+        Returns an AsyncResult, set with the response Event.
+        '''
+        # Always casts Event to CommandResponse
+        return self._pipeline(CommandResponse.cast, self._sendmsg,
+                              name, args, uuid, lock, loops)
+
+    def _pipeline(self, cast, send, *args):
+        '''
+        Queues a pending response then writes command with send(*args).
+
+        Returns an AsyncResult, set with the response Event casted with cast.
+        '''
+        result = AsyncResult()
         if self._closing_state:
-            return Event()
+            result.set(Event())
+            return result
         self._lock.acquire()
         try:
-            self._sendmsg(name, args, uuid, lock, loops)
-            event = self._response_queue.get()
+            # Queues before writing, response can come while writing.
+            self._pending.append((result, cast))
+            try:
+                send(*args)
+            except:
+                self._pending.pop()
+                raise
         finally:
             self._lock.release()
-        gevent.sleep(0.0001)
-        # Always casts Event to CommandResponse
-        return CommandResponse.cast(event)
+        return result
+
+    def _protocol_send(self, command, args=""):
+        return self._protocol_send_async(command, args).get()
+
+    def _protocol_sendmsg(self, name, args=None, uuid="", lock=False, loops=1):
+        return self._protocol_sendmsg_async(name, args, uuid, lock, loops).get()
@@ -6,27 +6,150 @@ Event Types classes
 """
 
 from urllib import unquote
+import json as stdlib_json
 import ujson as json
 
 
+EOL = "\n"
+
+
+class JsonDecoder(object):
+    '''
+    Decodes a json event body into a headers dict with loads function.
+    '''
+    # True if decode only returns some headers
+    partial = False
+
+    def __init__(self, loads=json.loads):
+        self.loads = loads
+
+    def decode(self, buffer):
+        return self.loads(buffer)
+
+
+class HeaderSubsetDecoder(JsonDecoder):
+    '''
+    Extracts only some headers from a json event body,
+    without decoding the whole json object.
+
+    FreeSWITCH json events are flat objects, so each key is searched
+    in the buffer and only its value is decoded.
+    The _body key is always extracted.
+    '''
+    partial = True
+
+    def __init__(self, keys, loads=json.loads):
+        JsonDecoder.__init__(self, loads)
+        self.keys = frozenset(keys) | frozenset(['_body'])
+        self._needles = [ (key, '"%s":' % key) for key in self.keys ]
+
+    def decode(self, buffer):
+        headers = {}
+        for key, needle in self._needles:
+            value = self._extract(buffer, needle)
+            if value is not None:
+                headers[key] = value
+        return headers
+
+    def _extract(self, buffer, needle):
+        '''
+        Gets decoded value after needle, or None if not found.
+        '''
+        pos = buffer.find(needle)
+        while pos >= 0:
+            # Needle must start a key, not be inside a string value.
+            prev = pos - 1
+            while prev > 0 and buffer[prev] in ' \t\r\n':
+                prev -= 1
+            if buffer[prev] in '{,':
+                break
+            pos = buffer.find(needle, pos + 1)
+        if pos < 0:
+            return None
+        start = pos + len(needle)
+        while buffer[start] in ' \t\r\n':
+            start += 1
+        if buffer[start] != '"':
+            # Not a string, reads until next separator
+            end = start
+            while buffer[end] not in ',}':
+                end += 1
+            return self.loads(buffer[start:end])
+        end = buffer.find('"', start + 1)
+        while end > 0:
+            # Skips escaped quotes
+            escapes = 0
+            while buffer[end - escapes - 1] == '\\':
+                escapes += 1
+            if not escapes % 2:
+                break
+            end = buffer.find('"', end + 1)
+        if end < 0:
+            return None
+        value = buffer[start + 1:end]
+        if '\\' in value:
+            return self.loads(buffer[start:end + 1])
+        return value.decode('utf-8')
+
+
+# Available json decoders
+UJSON_DECODER = JsonDecoder(json.loads)
+STDLIB_JSON_DECODER = JsonDecoder(stdlib_json.loads)
+
+
 class Event(object):
-    '''Event class'''
+    '''Event class
+
+    If lazy is True, headers are kept as a raw buffer and each header
+    is only parsed and unquoted when it is first read.
+    '''
     __slots__ = ('__weakref__',
                  '_headers',
                  '_raw_body',
+                 '_raw_headers',
                 )
 
-    def __init__(self, buffer=""):
+    def __init__(self, buffer="", lazy=False):
         self._headers = {}
         self._raw_body = ''
+        self._raw_headers = ''
         if buffer:
-            # Sets event headers from buffer.
-            for line in buffer.splitlines():
-                try:
-                    var, val = line.rstrip().split(': ', 1)
-                    self.set_header(var, val)
-                except ValueError:
-                    pass
+            if lazy:
+                # Keeps raw headers, each line starting with EOL.
+                self._raw_headers = EOL + buffer
+            else:
+                # Sets event headers from buffer.
+                self._parse_headers(buffer)
+
+    def _parse_headers(self, buffer):
+        '''
+        Sets all headers from buffer.
+        '''
+        for line in buffer.splitlines():
+            try:
+                var, val = line.rstrip().split(': ', 1)
+                self.set_header(var, val)
+            except ValueError:
+                pass
+
+    def _load_header(self, key):
+        '''
+        Parses a specific header from raw headers and caches it.
+
+        Raises KeyError if header not found.
+        '''
+        raw = self._raw_headers
+        # Last occurrence wins, as when all headers are parsed.
+        pos = raw.rfind(EOL + key + ': ')
+        if pos < 0:
+            raise KeyError(key)
+        start = pos + len(key) + 3
+        end = raw.find(EOL, start)
+        if end < 0:
+            end = len(raw)
+        value = unquote(raw[start:end].strip())
+        self._headers[key] = value
+        return value
 
     def __getitem__(self, key):
         return self.get_header(key)
@@ -77,6 +200,13 @@ class Event(object):
         '''
         Gets all headers as a python dict.
         '''
+        if self._raw_headers:
+            # Parses all raw headers, headers already read or set win.
+            headers = self._headers
+            self._headers = {}
+            self._parse_headers(self._raw_headers)
+            self._headers.update(headers)
+            self._raw_headers = ''
         return self._headers
 
     def set_headers(self, headers):
@@ -84,6 +214,7 @@ class Event(object):
         Sets all headers from dict.
         '''
         self._headers = headers.copy()
+        self._raw_headers = ''
 
     def get_header(self, key, defaultvalue=None):
         '''
@@ -94,6 +225,11 @@ class Event(object):
         try:
             return self._headers[key]
         except KeyError:
+            if self._raw_headers:
+                try:
+                    return self._load_header(key)
+                except KeyError:
+                    pass
             return defaultvalue
 
     def set_header(self, key, value):
@@ -116,7 +252,8 @@ class Event(object):
 
     def is_empty(self):
         '''Return True if no headers and no body.'''
-        return not self._raw_body and not self._headers
+        return not self._raw_body and not self._headers \
+                and not self._raw_headers
 
     def get_response(self):
         '''
@@ -135,38 +272,42 @@ class Event(object):
     def __str__(self):
         return '<%s headers=%s, body=%s>' \
                % (self.__class__.__name__,
-                  str(self._headers),
+                  str(self.get_headers()),
                   str(self._raw_body))
 
 
 class ApiResponse(Event):
-    def __init__(self, buffer=""):
-        Event.__init__(self, buffer)
+    __slots__ = ()
+
+    def __init__(self, buffer="", lazy=False):
+        Event.__init__(self, buffer, lazy)
 
     @classmethod
     def cast(self, event):
         '''
         Makes an ApiResponse instance from Event instance.
+
+        Event class is swapped in place, nothing is copied.
         '''
-        cls = ApiResponse()
-        cls._headers = event._headers
-        cls._raw_body = event._raw_body
-        return cls
+        event.__class__ = ApiResponse
+        return event
 
 
 class BgapiResponse(Event):
-    def __init__(self, buffer=""):
-        Event.__init__(self, buffer)
+    __slots__ = ()
+
+    def __init__(self, buffer="", lazy=False):
+        Event.__init__(self, buffer, lazy)
 
     @classmethod
     def cast(self, event):
         '''
         Makes a BgapiResponse instance from Event instance.
+
+        Event class is swapped in place, nothing is copied.
         '''
-        cls = BgapiResponse()
-        cls._headers = event._headers
-        cls._raw_body = event._raw_body
-        return cls
+        event.__class__ = BgapiResponse
+        return event
 
     def get_response(self):
         '''
@@ -190,18 +331,20 @@ class BgapiResponse(Event):
 
 
 class CommandResponse(Event):
-    def __init__(self, buffer=""):
-        Event.__init__(self, buffer)
+    __slots__ = ()
+
+    def __init__(self, buffer="", lazy=False):
+        Event.__init__(self, buffer, lazy)
 
     @classmethod
     def cast(self, event):
         '''
         Makes a CommandResponse instance from Event instance.
+
+        Event class is swapped in place, nothing is copied.
         '''
-        cls = CommandResponse()
-        cls._headers = event._headers
-        cls._raw_body = event._raw_body
-        return cls
+        event.__class__ = CommandResponse
+        return event
 
     def get_response(self):
         '''
@@ -219,14 +362,43 @@ class CommandResponse(Event):
 
 
 class JsonEvent(Event):
-    '''Json Event class'''
-    def __init__(self, buffer=""):
+    '''Json Event class
+
+    Headers are decoded with decoder (ujson by default).
+    If decoder is partial, the json buffer is kept and fully
+    decoded when a header not extracted is read.
+    '''
+    def __init__(self, buffer="", decoder=UJSON_DECODER):
         self._headers = {}
         self._raw_body = ''
+        self._raw_headers = ''
+        # Keys already extracted by a partial decoder
+        self._extracted = ()
+        # Decodes remaining headers as the decoder would
+        self._loads = decoder.loads
         if buffer:
-            self._headers = json.loads(buffer)
+            self._headers = decoder.decode(buffer)
+            if decoder.partial:
+                self._raw_headers = buffer
+                self._extracted = decoder.keys
             try:
                 self._raw_body = self._headers['_body']
             except KeyError:
                 pass
 
+    def _parse_headers(self, buffer):
+        '''
+        Sets all headers from json buffer.
+        '''
+        self._headers.update(self._loads(buffer))
+
+    def _load_header(self, key):
+        '''
+        Decodes all headers from json buffer, then gets a specific header.
+
+        Raises KeyError if header not found.
+        '''
+        if key in self._extracted:
+            # Not in json buffer, no need to decode
+            raise KeyError(key)
+        return self.get_headers()[key]
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+"""
+Frame Parser class
+
+Splits the raw eventsocket stream into complete frames.
+A frame is a header block ended by an empty line,
+followed by a body of Content-Length bytes (if any).
+"""
+
+from plivo.core.errors import LimitExceededError, ConnectError
+
+
+EOL = "\n"
+HEADER_END = EOL * 2
+CONTENT_LENGTH = "Content-Length:"
+READ_SIZE = 65536
+MAX_HEADER_SIZE = 65536
+
+
+def get_content_length(header):
+    '''
+    Gets Content-Length value from a raw header block.
+
+    Returns 0 if not found or invalid.
+    '''
+    if header.startswith(CONTENT_LENGTH):
+        pos = 0
+    else:
+        pos = header.find(EOL + CONTENT_LENGTH)
+        if pos < 0:
+            return 0
+        pos += 1
+    end = header.find(EOL, pos)
+    if end < 0:
+        end = len(header)
+    try:
+        return int(header[pos+len(CONTENT_LENGTH):end])
+    except ValueError:
+        return 0
+
+
+class FrameParser(object):
+    '''
+    Incremental eventsocket frame parser.
+
+    Reads chunks from transport into a reusable buffer
+    and returns complete frames as (header, body) tuples.
+    '''
+    def __init__(self, transport, read_size=READ_SIZE,
+                 max_header_size=MAX_HEADER_SIZE):
+        self.transport = transport
+        self.max_header_size = max_header_size
+        # Reusable chunk for recv_into.
+        self._chunk = bytearray(read_size)
+        self._view = memoryview(self._chunk)
+        # Pending data not yet returned as frames.
+        self._buffer = bytearray()
+        # Start of pending data in buffer.
+        self._pos = 0
+        # Offset from where to search for end of headers.
+        self._scan = 0
+
+    def pending(self):
+        '''
+        Returns number of buffered bytes not yet parsed.
+        '''
+        return len(self._buffer) - self._pos
+
+    def _fill(self):
+        '''
+        Reads one chunk from transport and appends it to buffer.
+
+        Raises ConnectError if connection is closed.
+        '''
+        # Drops already parsed frames before growing buffer.
+        if self._pos:
+            del self._buffer[:self._pos]
+            self._scan -= self._pos
+            self._pos = 0
+        length = self.transport.recv_into(self._chunk)
+        if not length:
+            raise ConnectError("connection closed")
+        self._buffer += self._view[:length]
+
+    def read_frame(self):
+        '''
+        Reads one complete frame.
+
+        Returns (header, body) tuple, body is None if no Content-Length.
+
+        Raises LimitExceededError if header is bigger than max_header_size.
+        '''
+        buff = self._buffer
+        # Waits for end of headers.
+        while True:
+            end = buff.find(HEADER_END, max(self._scan, self._pos))
+            if end >= 0:
+                break
+            if len(buff) - self._pos > self.max_header_size:
+                raise LimitExceededError("max header size (%d) reached" \
+                                                    % self.max_header_size)
+            # Next search starts on last byte, it can be the first EOL.
+            self._scan = max(len(buff) - 1, self._pos)
+            self._fill()
+            buff = self._buffer
+        header = str(buff[self._pos:end+1])
+        length = get_content_length(header)
+        # Body offsets, relative to start of pending data.
+        start = end + len(HEADER_END) - self._pos
+        stop = start + length
+        # Waits for body if any.
+        while self.pending() < stop:
+            self._fill()
+        body = None
+        if length > 0:
+            body = str(self._buffer[self._pos+start:self._pos+stop])
+        self._pos += stop
+        self._scan = self._pos
+        return (header, body)
@@ -5,22 +5,156 @@
 Inbound Event Socket class
 """
 
+import traceback
+
 import gevent
+import gevent.queue as queue
 from gevent.timeout import Timeout
+from plivo.core.freeswitch.commands import Commands
 from plivo.core.freeswitch.eventsocket import EventSocket
 from plivo.core.freeswitch.transport import InboundTransport
 from plivo.core.errors import ConnectError
 
 
+class CallSession(Commands):
+    '''
+    Call session over a shared Inbound Event Socket.
+
+    Events for this Unique-ID are queued in a mailbox and commands
+    are sent with sendmsg <uuid> (inbound-controlled mode),
+    so a call can be controlled without its own outbound connection.
+
+    The socket event filter must include the events needed by the call
+    (CHANNEL_EXECUTE_COMPLETE, CHANNEL_HANGUP, ...).
+    '''
+    def __init__(self, sock, uuid, dispatch=False):
+        self.sock = sock
+        self.uuid = uuid
+        # Also dispatches events to socket handlers if True
+        self.dispatch = dispatch
+        self.closed = False
+        self._mailbox = queue.Queue()
+
+    def get_channel_unique_id(self):
+        return self.uuid
+
+    def get_mailbox_size(self):
+        '''
+        Gets number of events waiting in mailbox.
+        '''
+        return self._mailbox.qsize()
+
+    def put_event(self, event):
+        '''
+        Queues event in mailbox, never blocks.
+        '''
+        self._mailbox.put_nowait(event)
+
+    def get_event(self, timeout=None):
+        '''
+        Gets next event for this call.
+
+        Returns None on timeout or when session is closed
+        and no event is left.
+        '''
+        if self.closed and self._mailbox.empty():
+            return None
+        try:
+            return self._mailbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        '''
+        Stops receiving events for this call.
+        '''
+        self.sock.close_session(self.uuid)
+
+    def _protocol_send(self, command, args=""):
+        return self.sock._protocol_send(command, args)
+
+    def _protocol_send_async(self, command, args=""):
+        return self.sock._protocol_send_async(command, args)
+
+    def _protocol_sendmsg(self, name, args=None, uuid="", lock=False, loops=1):
+        return self.sock._protocol_sendmsg(name, args, uuid or self.uuid,
+                                           lock, loops)
+
+    def _protocol_sendmsg_async(self, name, args=None, uuid="", lock=False, loops=1):
+        return self.sock._protocol_sendmsg_async(name, args, uuid or self.uuid,
+                                                 lock, loops)
+
+
+
 class InboundEventSocket(EventSocket):
     '''
     FreeSWITCH Inbound Event Socket
     '''
+    # Events closing a call session after being queued
+    SESSION_END_EVENTS = ('CHANNEL_HANGUP_COMPLETE', 'CHANNEL_DESTROY')
+
     def __init__(self, host, port, password, filter="ALL", 
-                 pool_size=500, connect_timeout=20, eventjson=True):
-        EventSocket.__init__(self, filter, pool_size, eventjson)
+                 pool_size=500, connect_timeout=20, eventjson=True,
+                 yield_policy=None, scheduler=None):
+        EventSocket.__init__(self, filter, pool_size, eventjson, yield_policy,
+                             scheduler)
         self.password = password
         self.transport = InboundTransport(host, port, connect_timeout=connect_timeout)
+        # Call sessions by Unique-ID
+        self._sessions = {}
+
+    def open_session(self, uuid, dispatch=False):
+        '''
+        Opens a call session for Unique-ID uuid.
+
+        Events for this call are queued in the session mailbox instead
+        of being dispatched, unless dispatch is True.
+
+        Returns CallSession instance.
+        '''
+        session = self._sessions.get(uuid)
+        if session is None:
+            session = CallSession(self, uuid, dispatch)
+            self._sessions[uuid] = session
+        return session
+
+    def close_session(self, uuid):
+        '''
+        Closes call session for Unique-ID uuid.
+        '''
+        session = self._sessions.pop(uuid, None)
+        if session:
+            session.closed = True
+            # Wakes up a reader waiting in get_event
+            session.put_event(None)
+
+    def get_session(self, uuid):
+        return self._sessions.get(uuid)
+
+    def get_session_count(self):
+        return len(self._sessions)
+
+    def route_event(self, event):
+        '''
+        Queues event in its call session mailbox if any,
+        else queues event for dispatch.
+        '''
+        if self._sessions:
+            uuid = event['Unique-ID']
+            session = self._sessions.get(uuid)
+            if session:
+                session.put_event(event)
+                if event['Event-Name'] in self.SESSION_END_EVENTS:
+                    self.close_session(uuid)
+                if not session.dispatch:
+                    return
+        super(InboundEventSocket, self).route_event(event)
+
+    def handle_events(self):
+        super(InboundEventSocket, self).handle_events()
+        # Connection is lost, no more events for call sessions
+        for uuid in self._sessions.keys():
+            self.close_session(uuid)
 
     def _wait_auth_request(self):
         '''
@@ -96,3 +230,130 @@ class InboundEventSocket(EventSocket):
         while self.is_connected():
             gevent.sleep(0.1)
 
+
+
+class InboundEventSocketPool(object):
+    '''
+    Pool of FreeSWITCH Inbound Event Sockets for commands.
+
+    Sockets don't subscribe to any event, api and bgapi commands
+    are sent on the connected socket with fewest commands in flight.
+    A background checker reconnects sockets that are down or not responding.
+    '''
+    def __init__(self, host, port, password, size=4,
+                 connect_timeout=20, check_interval=30, check_timeout=10,
+                 log=None):
+        self.size = size
+        self.log = log
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.sockets = [ InboundEventSocket(host, port, password, filter=None,
+                                            pool_size=0,
+                                            connect_timeout=connect_timeout)
+                         for x in range(size) ]
+        self._running = False
+        self._checker = None
+
+    def start(self):
+        '''
+        Starts checker in background, it connects all sockets.
+        '''
+        self._running = True
+        self._checker = gevent.spawn(self._check_loop)
+
+    def stop(self):
+        '''
+        Stops checker and closes all sockets.
+        '''
+        self._running = False
+        if self._checker:
+            self._checker.kill()
+        for sock in self.sockets:
+            self._close(sock)
+
+    def get_connected_count(self):
+        '''
+        Gets number of connected sockets.
+        '''
+        return len([ sock for sock in self.sockets if sock.is_connected() ])
+
+    def get_socket(self):
+        '''
+        Gets connected socket with fewest commands waiting a response.
+
+        Raises ConnectError if no socket is connected.
+        '''
+        best = None
+        for sock in self.sockets:
+            if not sock.is_connected():
+                continue
+            if best is None or sock.get_pending_count() < best.get_pending_count():
+                best = sock
+        if best is None:
+            raise ConnectError("No connected socket in pool")
+        return best
+
+    def api(self, args):
+        return self.get_socket().api(args)
+
+    def bgapi(self, args):
+        return self.get_socket().bgapi(args)
+
+    def api_async(self, args):
+        return self.get_socket().api_async(args)
+
+    def bgapi_async(self, args):
+        return self.get_socket().bgapi_async(args)
+
+    def check(self):
+        '''
+        Checks all sockets at the same time,
+        reconnects sockets down or not responding.
+        '''
+        gevent.joinall([ gevent.spawn(self.check_socket, sock)
+                         for sock in self.sockets ])
+
+    def check_socket(self, sock):
+        try:
+            if sock.is_connected():
+                try:
+                    response = sock.api_async("status").get(
+                                                timeout=self.check_timeout)
+                    if not response.is_empty():
+                        return
+                except Timeout:
+                    pass
+            self._close(sock)
+            try:
+                sock.connect()
+            except ConnectError:
+                self._close(sock)
+        except Exception, e:
+            # Keeps checking other sockets and next times
+            self._error("Checking command socket failed: %s" % str(e))
+            try:
+                self._close(sock)
+            except Exception:
+                pass
+
+    def _error(self, msg):
+        if self.log:
+            self.log.error(msg)
+        else:
+            traceback.print_exc()
+
+    def _close(self, sock):
+        '''
+        Closes socket and stops its event handler.
+        '''
+        sock.connected = False
+        sock.transport.close()
+        sock.stop_event_handler()
+
+    def _check_loop(self):
+        while self._running:
+            try:
+                self.check()
+            except Exception, e:
+                self._error("Checking command sockets failed: %s" % str(e))
+            gevent.sleep(self.check_interval)
@@ -2,13 +2,32 @@
 # Copyright (c) 2011 Plivo Team. See LICENSE for details.
 
 from gevent import monkey; monkey.patch_all()
+from collections import deque
+import select
+import signal
 import socket
 import sys
-import os    
+import os
+import traceback
 try:
     import multiprocessing
 except ImportError:
     import processing as multiprocessing
+import _multiprocessing
+
+from gevent.pool import Pool
+from gevent.socket import wait_read
+
+from plivo.core.freeswitch.outboundsocket import OVERLOAD_CLOSE, reject_call
+
+
+# Messages from pool workers to server
+WORKER_IDLE = '1'
+WORKER_EXIT = 'x'
+
+# Max calls rejected at the same time by the rejecter process,
+# next ones are closed
+REJECT_POOL_SIZE = 100
 
 
 class Process(multiprocessing.Process):
@@ -23,35 +42,288 @@ class Process(multiprocessing.Process):
                 raise SystemExit()
 
 
+class PoolWorker(object):
+    '''
+    Worker process of the pool, receiving connections
+    through a UNIX socket (SCM_RIGHTS)
+    '''
+    def __init__(self, server, target=None):
+        self.channel, child_channel = socket.socketpair(socket.AF_UNIX,
+                                                        socket.SOCK_STREAM)
+        self.process = Process(target=target or server.serve_pool,
+                               args=(child_channel, self.channel))
+        self.process.daemon = True
+        self.process.start()
+        child_channel.close()
+
+    def send(self, conn):
+        '''
+        Passes connection to worker process
+        '''
+        _multiprocessing.sendfd(self.channel.fileno(), conn.fileno())
+
+    def close(self):
+        self.channel.close()
+
+
 class OutboundServer(object):
-    def __init__(self, address, handle_class, filter='ALL'):
+    def __init__(self, address, handle_class, filter='ALL', pool_size=0,
+                 max_calls=0, pool_max=0, overload=OVERLOAD_CLOSE):
+        '''
+        pool_size: number of worker processes kept ready,
+                   0 starts a new process for each connection
+        max_calls: worker processes are replaced after max_calls
+                   connections, 0 for no limit
+        pool_max: max number of worker processes, more are started when
+                  all are busy (extra ones exit once idle), next connections
+                  are rejected (0 for no limit)
+        overload: overload policy of rejected connections, close, hangup
+                  or busy (see outboundsocket.OutboundServer), hangup and
+                  busy are handled by a rejecter process
+        '''
         self.hostname, self.port = address
         self.running = False
         self._filter = filter
         # Define the Class that will handle process when receiving message
         self._handle_class = handle_class
         self._pid = int(os.getpid())
-                                         
+        self.pool_size = pool_size
+        self.max_calls = max_calls
+        self.pool_max = pool_max
+        self.overload = overload
+        self.rejected = 0
+        # Idle pool workers, first idle first used
+        self._idle_workers = deque()
+        self._workers = []
+        self._rejecter = None
+        # Processes of removed workers, not reaped yet
+        self._exited = []
+
     def start(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.hostname, self.port))
         self.socket.listen(5)
+        for i in range(self.pool_size):
+            self.spawn_worker()
 
     def loop(self):
         self._run = True
         try:
             while self._run:
+                if self.pool_size > 0:
+                    self.poll_pool()
+                    continue
                 conn, address = self.socket.accept()
                 process = Process(target=self.do_handle, args=(conn, address))
                 process.daemon = True
                 process.start()
+                conn.close()
         except (SystemExit, KeyboardInterrupt):
             pass
 
     def kill(self):
-        pass
+        workers = self._workers[:]
+        if self._rejecter:
+            workers.append(self._rejecter)
+            self._rejecter = None
+        for worker in workers:
+            worker.close()
+        for worker in workers:
+            worker.process.join(1)
 
     def do_handle(self, conn, address):
-        self._handle_class(socket, address, self._filter)
+        self._handle_class(conn, address, self._filter)
+
+    def spawn_worker(self):
+        worker = PoolWorker(self)
+        self._workers.append(worker)
+        self._idle_workers.append(worker)
+        return worker
+
+    def poll_pool(self, timeout=1.0):
+        '''
+        Reads worker messages, and accepts connections
+
+        Workers are only forked from this loop, so they never inherit
+        other greenlets of the server.
+        '''
+        self.reap_workers()
+        channels = dict([ (worker.channel, worker) for worker in self._workers ])
+        readers = channels.keys()
+        readers.append(self.socket)
+        for sock in select.select(readers, [], [], timeout)[0]:
+            if sock is self.socket:
+                conn, address = self.socket.accept()
+                if self._idle_workers or not self.pool_max \
+                        or len(self._workers) < self.pool_max:
+                    self.dispatch(conn)
+                else:
+                    self.reject(conn, address, 'max processes')
+                continue
+            worker = channels[sock]
+            if not worker in self._workers:
+                continue
+            try:
+                message = sock.recv(1)
+            except socket.error:
+                message = ''
+            if message == WORKER_IDLE:
+                if len(self._workers) > self.pool_size:
+                    # Extra worker started for a busy pool, stop it
+                    self.remove_worker(worker)
+                else:
+                    self._idle_workers.append(worker)
+            else:
+                # Worker exits after max_calls (WORKER_EXIT) or died,
+                # replace it
+                self.remove_worker(worker)
+                if self._run and len(self._workers) < self.pool_size:
+                    self.spawn_worker()
+
+    def remove_worker(self, worker):
+        '''
+        Closes worker channel, its process is reaped by reap_workers
+        '''
+        worker.close()
+        self._exited.append(worker.process)
+        if worker in self._workers:
+            self._workers.remove(worker)
+        if worker in self._idle_workers:
+            self._idle_workers.remove(worker)
 
+    def reap_workers(self):
+        '''
+        Reaps exited worker processes, without waiting
+        '''
+        # is_alive() polls process without blocking
+        self._exited = [ process for process in self._exited
+                         if process.is_alive() ]
+
+    def reject(self, conn, address, reason):
+        '''
+        Rejects connection when all pool_max workers are busy
+        '''
+        self.rejected += 1
+        try:
+            self.on_reject(address, reason)
+            if self.overload != OVERLOAD_CLOSE:
+                self.send_reject(conn)
+        finally:
+            conn.close()
+
+    def on_reject(self, address, reason):
+        pass
+
+    def send_reject(self, conn):
+        '''
+        Passes connection to the rejecter process, started when needed
+        '''
+        for i in range(2):
+            if self._rejecter is None:
+                self._rejecter = PoolWorker(self, self.serve_rejects)
+            try:
+                self._rejecter.send(conn)
+                return
+            except (OSError, socket.error):
+                # Rejecter died
+                self._rejecter.close()
+                self._exited.append(self._rejecter.process)
+                self._rejecter = None
+
+    def get_stats(self):
+        return {'workers': len(self._workers),
+                'idle': len(self._idle_workers),
+                'rejected': self.rejected,
+               }
+
+    def dispatch(self, conn):
+        '''
+        Passes connection to the first idle worker, or a new one
+        '''
+        try:
+            while True:
+                if self._idle_workers:
+                    worker = self._idle_workers.popleft()
+                else:
+                    worker = self.spawn_worker()
+                    self._idle_workers.remove(worker)
+                try:
+                    worker.send(conn)
+                    return
+                except (OSError, socket.error):
+                    # Worker died
+                    self.remove_worker(worker)
+                    self.spawn_worker()
+        finally:
+            conn.close()
+
+    def _close_server(self, server_channel):
+        '''
+        Closes server sockets inherited by a child process
+        '''
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        server_channel.close()
+        self.socket.close()
+        for worker in self._workers:
+            worker.channel.close()
+        if self._rejecter:
+            self._rejecter.channel.close()
+
+    def serve_rejects(self, channel, server_channel):
+        '''
+        Rejecter process main loop, applies overload policy
+        to rejected connections
+        '''
+        self._close_server(server_channel)
+        pool = Pool(REJECT_POOL_SIZE)
+        while True:
+            wait_read(channel.fileno())
+            try:
+                fd = _multiprocessing.recvfd(channel.fileno())
+            except (OSError, RuntimeError):
+                # Server closed channel
+                break
+            conn = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            os.close(fd)
+            if pool.full():
+                conn.close()
+                continue
+            try:
+                address = conn.getpeername()
+            except socket.error:
+                conn.close()
+                continue
+            pool.spawn(reject_call, conn, address, self.overload)
+        pool.join()
+
+    def serve_pool(self, channel, server_channel):
+        '''
+        Pool worker process main loop
+        '''
+        self._close_server(server_channel)
+        calls = 0
+        while True:
+            wait_read(channel.fileno())
+            try:
+                fd = _multiprocessing.recvfd(channel.fileno())
+            except (OSError, RuntimeError):
+                # Server closed channel
+                return
+            conn = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+            os.close(fd)
+            calls += 1
+            try:
+                self.do_handle(conn, conn.getpeername())
+            except Exception:
+                traceback.print_exc()
+            finally:
+                conn.close()
+            try:
+                if self.max_calls and calls >= self.max_calls:
+                    channel.sendall(WORKER_EXIT)
+                    return
+                channel.sendall(WORKER_IDLE)
+            except socket.error:
+                # Server is gone
+                return
@@ -2,42 +2,168 @@
 # Copyright (c) 2011 Plivo Team. See LICENSE for details.
 
 from gevent import monkey; monkey.patch_all()
+import Queue
 import socket
 import sys
 import os
 import threading
+import traceback
 
+from plivo.core.freeswitch.outboundsocket import OVERLOAD_CLOSE, reject_call
 
 
+# Threads rejecting connections with hangup and busy overload policies,
+# and max connections waiting for them (next ones are closed)
+REJECT_THREADS = 10
+REJECT_QUEUE_SIZE = 100
+
 class OutboundServer(object):
-    def __init__(self, address, handle_class, filter='ALL'):
+    def __init__(self, address, handle_class, filter='ALL', pool_size=0,
+                 queue_size=0, overload=OVERLOAD_CLOSE):
+        '''
+        pool_size: number of worker threads,
+                   0 starts a new thread for each connection
+        queue_size: max connections waiting for a worker thread,
+                    next ones are rejected (0 for no limit)
+        overload: overload policy of rejected connections, close, hangup
+                  or busy (see outboundsocket.OutboundServer)
+        '''
         self.hostname, self.port = address
         self.running = False
         self._filter = filter
         # Define the Class that will handle process when receiving message
         self._handle_class = handle_class
         self._pid = int(os.getpid())
-                                         
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.overload = overload
+        # Unbounded, queue_size is checked by dispatch so kill never blocks
+        self._queue = Queue.Queue()
+        self._reject_queue = Queue.Queue()
+        self._threads = []
+        self._reject_threads = []
+        self._active = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+
     def start(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.hostname, self.port))
         self.socket.listen(5)
+        for i in range(self.pool_size):
+            th = threading.Thread(target=self.serve_queue)
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+        if self.pool_size > 0 and self.overload != OVERLOAD_CLOSE:
+            for i in range(REJECT_THREADS):
+                th = threading.Thread(target=self.serve_rejects)
+                th.daemon = True
+                th.start()
+                self._reject_threads.append(th)
 
     def loop(self):
         self._run = True
         try:
             while self._run:
                 conn, address = self.socket.accept()
-                th = threading.Thread(target=self.do_handle, args=(conn, address))
+                if self.pool_size > 0:
+                    self.dispatch(conn, address)
+                    continue
+                th = threading.Thread(target=self.handle, args=(conn, address))
                 th.daemon = True
                 th.start()
         except (SystemExit, KeyboardInterrupt):
             pass
 
     def kill(self):
+        # Stops worker threads once queued connections are handled
+        for th in self._threads:
+            self._queue.put_nowait(None)
+        for th in self._reject_threads:
+            self._reject_queue.put_nowait(None)
+        self._threads = []
+        self._reject_threads = []
+
+    def dispatch(self, conn, address):
+        '''
+        Queues connection for worker threads, or rejects it if queue is full
+        '''
+        # Only this thread puts connections, size can only decrease meanwhile
+        if not self.queue_size or self._queue.qsize() < self.queue_size:
+            self._queue.put_nowait((conn, address))
+            return
+        with self._lock:
+            self.rejected += 1
+        self.on_reject(address, 'queue full')
+        if self.overload == OVERLOAD_CLOSE \
+                or self._reject_queue.qsize() >= REJECT_QUEUE_SIZE:
+            reject_call(conn, address, OVERLOAD_CLOSE)
+            return
+        self._reject_queue.put_nowait((conn, address))
+
+    def serve_rejects(self):
+        '''
+        Rejecter thread main loop
+        '''
+        while True:
+            item = self._reject_queue.get()
+            if item is None:
+                return
+            self.reject(*item)
+
+    def serve_queue(self):
+        '''
+        Worker thread main loop
+        '''
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self.handle(*item)
+
+    def handle(self, conn, address):
+        with self._lock:
+            self._active += 1
+        try:
+            self.do_handle(conn, address)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self._lock:
+                self._active -= 1
+            try:
+                conn.close()
+            except socket.error:
+                pass
+
+    def reject(self, conn, address):
+        '''
+        Applies overload policy to a rejected connection
+        '''
+        reject_call(conn, address, self.overload)
+
+    def on_reject(self, address, reason):
         pass
 
-    def do_handle(self, conn, address):
-        self._handle_class(socket, address, self._filter)
+    def get_active_count(self):
+        '''
+        Returns the number of connections being handled
+        '''
+        return self._active
 
+    def get_queued_count(self):
+        '''
+        Returns the number of connections waiting for a worker thread
+        '''
+        return self._queue.qsize()
+
+    def get_stats(self):
+        return {'active': self.get_active_count(),
+                'queued': self.get_queued_count(),
+                'rejected': self.rejected,
+               }
+
+    def do_handle(self, conn, address):
+        self._handle_class(conn, address, self._filter)
@@ -7,6 +7,9 @@ Outbound Event Socket class
 This manage Event Socket communication with the Freeswitch Server
 """
 
+import time
+import types
+
 import gevent
 from gevent.server import StreamServer
 from gevent.timeout import Timeout
@@ -15,6 +18,15 @@ from plivo.core.freeswitch.transport import OutboundTransport
 from plivo.core.errors import ConnectError
 
 
+# Overload policies
+OVERLOAD_CLOSE = 'close'
+OVERLOAD_HANGUP = 'hangup'
+OVERLOAD_BUSY = 'busy'
+OVERLOAD_POLICIES = (OVERLOAD_CLOSE, OVERLOAD_HANGUP, OVERLOAD_BUSY)
+
+# US busy tone
+BUSY_TONE = 'tone_stream://%(500,500,480,620)'
+
 
 class OutboundEventSocket(EventSocket):
     '''
@@ -23,8 +35,10 @@ class OutboundEventSocket(EventSocket):
     A new instance of this class is created for every call/ session from FreeSWITCH.
     '''
     def __init__(self, socket, address, filter="ALL", 
-                 pool_size=500, connect_timeout=20, eventjson=True):
-        EventSocket.__init__(self, filter, pool_size, eventjson)
+                 pool_size=500, connect_timeout=20, eventjson=True,
+                 yield_policy=None, scheduler=None):
+        EventSocket.__init__(self, filter, pool_size, eventjson, yield_policy,
+                             scheduler)
         self.transport = OutboundTransport(socket, address, connect_timeout)
         self._uuid = None
         self._channel = None
@@ -87,17 +101,138 @@ class OutboundEventSocket(EventSocket):
         pass
 
 
+class RejectEventSocket(OutboundEventSocket):
+    '''
+    Rejects a call without handling it, when server is overloaded.
+
+    Hangs up the call, after playing busy tone with busy policy.
+    '''
+    def __init__(self, socket, address, policy=OVERLOAD_HANGUP,
+                 cause='USER_BUSY', busy_tone=BUSY_TONE, busy_loops=3,
+                 timeout=10):
+        self.policy = policy
+        self.cause = cause
+        self.busy_tone = busy_tone
+        self.busy_loops = busy_loops
+        self.timeout = timeout
+        OutboundEventSocket.__init__(self, socket, address, filter=None,
+                                     pool_size=0, connect_timeout=timeout)
+
+    def run(self):
+        if self.policy == OVERLOAD_BUSY:
+            self.playback(self.busy_tone, loops=self.busy_loops)
+        self.hangup(self.cause)
+        # FreeSWITCH closes connection once call is hung up
+        self._handler_thread.join(self.timeout)
+
+
+def reject_call(socket, address, overload=OVERLOAD_CLOSE):
+    '''
+    Rejects a call with overload policy (see OutboundServer)
+    '''
+    try:
+        if overload != OVERLOAD_CLOSE:
+            RejectEventSocket(socket, address, overload)
+    except Exception:
+        pass
+    finally:
+        socket.close()
+
+
+class TokenBucket(object):
+    '''
+    Token bucket, allows rate tokens per second, with bursts of up
+    to burst tokens.
+    '''
+    def __init__(self, rate, burst=0):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._last = time.time()
+
+    def consume(self, tokens=1):
+        '''
+        Takes tokens, returns False if not enough tokens
+        '''
+        now = time.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+
 class OutboundServer(StreamServer):
     '''
     FreeSWITCH Outbound Event Server
+
+    Admission control : new calls are rejected when max_sessions calls
+    are handled, or when more than rate calls per second come
+    (with bursts of up to burst calls).
+    Rejected calls are handled with overload policy :
+      close : connection is closed
+      hangup : call is hung up
+      busy : busy tone is played then call is hung up
     '''
-    def __init__(self, address, handle_class, filter="ALL"):
+    def __init__(self, address, handle_class, filter="ALL", max_sessions=0,
+                 rate=0, burst=0, overload=OVERLOAD_CLOSE):
         self._filter = filter
         #Define the Class that will handle process when receiving message
         self._handle_class = handle_class
-        StreamServer.__init__(self, address, self.do_handle)
+        self.max_sessions = max_sessions
+        self.overload = overload
+        if rate > 0:
+            self._bucket = TokenBucket(rate, burst or rate)
+        else:
+            self._bucket = None
+        self.active = 0
+        self.accepted = 0
+        self.rejected_sessions = 0
+        self.rejected_rate = 0
+        StreamServer.__init__(self, address, self.handle)
+        # Compatibility : subclasses overriding do_handle (the call hook
+        # before handle_call) get it called by handle, after admission,
+        # gevent keeps using its own do_handle to spawn handle
+        do_handle = type(self).do_handle.im_func
+        if do_handle is not StreamServer.do_handle.im_func:
+            self.handle_call = types.MethodType(do_handle, self)
+            self.do_handle = types.MethodType(StreamServer.do_handle.im_func,
+                                              self)
+
+    def handle(self, socket, address):
+        if self.max_sessions and self.active >= self.max_sessions:
+            self.rejected_sessions += 1
+            self.reject(socket, address, 'max sessions')
+            return
+        if self._bucket and not self._bucket.consume():
+            self.rejected_rate += 1
+            self.reject(socket, address, 'rate')
+            return
+        self.accepted += 1
+        self.active += 1
+        try:
+            self.handle_call(socket, address)
+        finally:
+            self.active -= 1
 
-    def do_handle(self, socket, address):
+    def reject(self, socket, address, reason):
+        self.on_reject(address, reason)
+        reject_call(socket, address, self.overload)
+
+    def on_reject(self, address, reason):
+        pass
+
+    def get_stats(self):
+        return {'active': self.active,
+                'accepted': self.accepted,
+                'rejected_sessions': self.rejected_sessions,
+                'rejected_rate': self.rejected_rate,
+               }
+
+    def handle_call(self, socket, address):
+        # Not named do_handle, gevent servers call do_handle to spawn handle
         self._handle_class(socket, address, self._filter)
 
     def loop(self):
@@ -111,7 +246,6 @@ class OutboundServer(StreamServer):
 
 
 
-
 if __name__ == '__main__':
     outboundserver = OutboundServer(('127.0.0.1', 8084), OutboundEventSocket)
     outboundserver.serve_forever()
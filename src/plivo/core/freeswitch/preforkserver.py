@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from gevent import monkey; monkey.patch_all()
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import gevent
+from gevent.pool import Pool
+
+from plivo.core.freeswitch import outboundsocket
+from plivo.core.freeswitch.multiprocserver import Process
+
+
+# Not defined by python 2 socket module, value on Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def has_reuseport():
+    '''
+    Returns True if SO_REUSEPORT is supported
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return True
+    except (socket.error, OSError):
+        return False
+    finally:
+        sock.close()
+
+
+class WorkerServer(outboundsocket.OutboundServer):
+    '''
+    Server of a worker process, with admission control of
+    outboundsocket.OutboundServer, calls are handled by prefork server
+    '''
+    def __init__(self, listener, server):
+        self._server = server
+        outboundsocket.OutboundServer.__init__(self, listener,
+                            server._handle_class, server._filter,
+                            max_sessions=server.max_sessions,
+                            rate=server.rate, burst=server.burst,
+                            overload=server.overload)
+        # Greenlets in a pool, stop waits for current calls.
+        # Not bounded, admission control rejects calls over max_sessions
+        self.set_spawn(Pool())
+
+    def handle_call(self, socket, address):
+        self._server.do_handle(socket, address)
+
+    def on_reject(self, address, reason):
+        self._server.on_reject(address, reason)
+
+
+class OutboundServer(object):
+    '''
+    FreeSWITCH Outbound Event Server with pre-forked workers
+
+    Each worker process handles connections in greenlets.
+    With SO_REUSEPORT, each worker listens on its own socket and the
+    kernel balances connections, else workers share a listening socket.
+    Dead workers are respawned. On kill, workers stop accepting
+    connections and wait for current calls, up to drain_timeout seconds.
+    Each worker has admission control of outboundsocket.OutboundServer,
+    max_sessions, rate and burst limits are per worker.
+    '''
+    def __init__(self, address, handle_class, filter='ALL', workers=0,
+                 backlog=1024, drain_timeout=30, max_sessions=0, rate=0,
+                 burst=0, overload=outboundsocket.OVERLOAD_CLOSE):
+        self.hostname, self.port = address
+        self._filter = filter
+        # Define the Class that will handle process when receiving message
+        self._handle_class = handle_class
+        self.workers = workers or multiprocessing.cpu_count()
+        self.backlog = backlog
+        self.drain_timeout = drain_timeout
+        self.max_sessions = max_sessions
+        self.rate = rate
+        self.burst = burst
+        self.overload = overload
+        self.reuseport = False
+        self.socket = None
+        # Worker process by worker index
+        self._workers = {}
+        # Server of this worker process
+        self._server = None
+        self._run = False
+        self._pid = int(os.getpid())
+
+    def start(self):
+        self.reuseport = has_reuseport()
+        if not self.reuseport:
+            self.socket = self.create_socket()
+        self._run = True
+        for index in range(self.workers):
+            self.spawn_worker(index)
+
+    def create_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind((self.hostname, self.port))
+        sock.listen(self.backlog)
+        return sock
+
+    def spawn_worker(self, index):
+        process = Process(target=self.serve, args=(index,))
+        process.daemon = True
+        process.start()
+        self._workers[index] = process
+        return process
+
+    def check_workers(self):
+        '''
+        Respawns dead workers, returns respawned worker indexes
+        '''
+        respawned = []
+        for index, process in self._workers.items():
+            if self._run and not process.is_alive():
+                self.on_worker_exit(index, process)
+                self.spawn_worker(index)
+                respawned.append(index)
+        return respawned
+
+    def on_worker_exit(self, index, process):
+        pass
+
+    def loop(self):
+        try:
+            while self._run:
+                self.check_workers()
+                gevent.sleep(1.0)
+        except (SystemExit, KeyboardInterrupt):
+            pass
+
+    def kill(self):
+        '''
+        Stops workers, waiting for them to drain their calls
+        '''
+        self._run = False
+        workers = [ p for p in self._workers.values() if p.is_alive() ]
+        for process in workers:
+            try:
+                os.kill(process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + self.drain_timeout + 1
+        for process in workers:
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                try:
+                    os.kill(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                process.join(1)
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def serve(self, index):
+        '''
+        Worker process main loop
+        '''
+        # Interrupt is handled by the master
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.reuseport:
+            listener = self.create_socket()
+        else:
+            listener = self.socket
+        self._server = WorkerServer(listener, self)
+        # Stop accepting, serve_forever waits for current calls
+        gevent.signal(signal.SIGTERM, self._server.close)
+        self._server.serve_forever(stop_timeout=self.drain_timeout)
+
+    def on_reject(self, address, reason):
+        pass
+
+    def get_stats(self):
+        '''
+        Returns admission stats of this worker process
+        '''
+        if self._server is None:
+            return {}
+        return self._server.get_stats()
+
+    def do_handle(self, socket, address):
+        self._handle_class(socket, address, self._filter)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+"""
+Dispatch Scheduler class
+
+Queues events in one FIFO per call, and dispatches them with a fixed
+number of worker greenlets, so the event reader never blocks.
+Events of a same call are dispatched one at a time in order,
+priority lanes only choose which call is served first.
+"""
+
+from collections import deque
+import traceback
+
+import gevent
+import gevent.event
+
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+LANES = (HIGH, NORMAL, LOW)
+
+
+def get_unique_id(event):
+    return event['Unique-ID']
+
+
+class DispatchScheduler(object):
+    '''
+    Bounded event dispatch scheduler.
+
+    size: number of worker greenlets calling the handler
+    priorities: dict Event-Name -> lane (HIGH, NORMAL or LOW), default NORMAL,
+                a call is served in the lane of its most urgent queued event
+    limits: dict Event-Name -> max queued events, new events are dropped
+            when reached (0 or missing for no limit)
+    coalesce: Event-Names for which a queued event is replaced
+              by a newer event with the same Unique-ID
+    key: function returning the call of an event, events of a same call
+         are dispatched in order (default Unique-ID, events without
+         call are not ordered)
+    keep: function returning True for events never dropped
+    '''
+    def __init__(self, size=100, priorities=None, limits=None, coalesce=None,
+                 key=get_unique_id, keep=None):
+        self.size = size
+        self.priorities = priorities or {}
+        self.limits = limits or {}
+        self.coalesce = set(coalesce or ())
+        self.key = key
+        self.keep = keep
+        # One FIFO by call, each item is a [name, event] slot
+        self._calls = {}
+        # Calls ready for dispatch, one FIFO per lane.
+        # A call is only in the lane given by _lane_of,
+        # other entries are outdated and skipped.
+        self._lanes = [ deque() for lane in LANES ]
+        self._lane_of = {}
+        # Calls being dispatched
+        self._busy = set()
+        # Queued slots by (Event-Name, Unique-ID) for coalesced events
+        self._slots = {}
+        # Counters by Event-Name
+        self._queued = {}
+        self._dropped = {}
+        self._coalesced = {}
+        self._dispatched = 0
+        self._errors = 0
+        self._depth = 0
+        self._ready = gevent.event.Event()
+        self._handler = None
+        self._log = None
+        self._workers = []
+
+    def start(self, handler, log=None):
+        '''
+        Starts workers calling handler(event), if not already started.
+
+        Handler errors are logged to log, if set.
+        '''
+        self._handler = handler
+        self._log = log
+        if self._workers:
+            return
+        self._workers = [ gevent.spawn(self._work) for x in range(self.size) ]
+
+    def stop(self):
+        '''
+        Stops workers, queued events are kept.
+        '''
+        gevent.killall(self._workers)
+        self._workers = []
+
+    def put(self, event):
+        '''
+        Queues an event, never blocks.
+
+        Returns False if event was dropped or coalesced, True otherwise.
+        '''
+        name = event['Event-Name']
+        if name in self.coalesce:
+            slot_key = (name, event['Unique-ID'])
+            slot = self._slots.get(slot_key)
+            if slot:
+                slot[1] = event
+                self._coalesced[name] = self._coalesced.get(name, 0) + 1
+                return False
+        else:
+            slot_key = None
+        queued = self._queued.get(name, 0)
+        limit = self.limits.get(name, 0)
+        if limit and queued >= limit and not (self.keep and self.keep(event)):
+            self._dropped[name] = self._dropped.get(name, 0) + 1
+            return False
+        slot = [name, event]
+        if slot_key:
+            self._slots[slot_key] = slot
+        # Events without call get their own queue
+        key = self.key(event) or object()
+        self._calls.setdefault(key, deque()).append(slot)
+        if not key in self._busy:
+            self._schedule(key, self.priorities.get(name, NORMAL))
+        self._queued[name] = queued + 1
+        self._depth += 1
+        self._ready.set()
+        return True
+
+    def _schedule(self, key, lane):
+        current = self._lane_of.get(key)
+        if current is not None and current <= lane:
+            return
+        self._lane_of[key] = lane
+        self._lanes[lane].append(key)
+
+    def _pop(self):
+        '''
+        Gets (call, event) of next event by priority, the call is busy
+        until released.
+
+        Returns None if no event is ready.
+        '''
+        for index, lane in enumerate(self._lanes):
+            while lane:
+                key = lane.popleft()
+                if self._lane_of.get(key) != index:
+                    continue
+                del self._lane_of[key]
+                name, event = self._calls[key].popleft()
+                self._queued[name] -= 1
+                self._depth -= 1
+                if name in self.coalesce:
+                    self._slots.pop((name, event['Unique-ID']), None)
+                self._busy.add(key)
+                return key, event
+        return None
+
+    def _release(self, key):
+        '''
+        Schedules next events of call, once its event is dispatched.
+        '''
+        self._busy.discard(key)
+        queue = self._calls[key]
+        if not queue:
+            del self._calls[key]
+            return
+        self._schedule(key, min([ self.priorities.get(name, NORMAL)
+                                  for name, event in queue ]))
+        self._ready.set()
+
+    def get(self):
+        '''
+        Gets next event by priority.
+
+        Returns None if no event is queued.
+        '''
+        item = self._pop()
+        if item is None:
+            return None
+        key, event = item
+        self._release(key)
+        return event
+
+    def get_queue_depth(self):
+        '''
+        Gets total number of queued events.
+        '''
+        return self._depth
+
+    def get_stats(self):
+        '''
+        Gets counters as a dict.
+        '''
+        return {'queued': dict(self._queued),
+                'dropped': dict(self._dropped),
+                'coalesced': dict(self._coalesced),
+                'dispatched': self._dispatched,
+                'errors': self._errors,
+                'depth': self.get_queue_depth(),
+               }
+
+    def _work(self):
+        while True:
+            item = self._pop()
+            if item is None:
+                self._ready.clear()
+                self._ready.wait()
+                continue
+            key, event = item
+            self._dispatched += 1
+            try:
+                self._handler(event)
+            except Exception:
+                # Worker keeps running
+                self._errors += 1
+                if self._log:
+                    self._log.error("Event handler failed: %s"
+                                    % traceback.format_exc())
+                else:
+                    traceback.print_exc()
+            finally:
+                self._release(key)
@@ -17,6 +17,9 @@ class Transport(object):
     def read(self, length):
         return self.sockfd.read(length)
 
+    def recv_into(self, buffer):
+        return self.sock.recv_into(buffer)
+
     def close(self):
         try:
             self.sock.shutdown(2)
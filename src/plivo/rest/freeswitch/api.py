@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2011 Plivo Team. See LICENSE for details
 
-import base64
 import re
 import uuid
 import flask
 from flask import request
 from werkzeug.exceptions import Unauthorized
 
+from plivo.rest.freeswitch.auth import get_rest_auth
 from plivo.rest.freeswitch.helpers import is_valid_url, get_conf_value, \
                                                             get_post_param
 
@@ -62,36 +62,26 @@ class CallRequest(object):
 class PlivoRestApi(object):
     _config = None
     _rest_inbound_socket = None
+    _auth = None
+
+    def _get_auth(self):
+        if self._auth is None:
+            self._auth = get_rest_auth(self._config)
+        return self._auth
 
     def _validate_ip_auth(self):
         """Verify request is from allowed ips
         """
-        allowed_ips = get_conf_value(self._config, 'rest_server',
-                                     'ALLOWED_IPS')
-        if not allowed_ips:
+        if self._get_auth().check_ip(request.remote_addr):
             return True
-        for ip in allowed_ips.split(','):
-            if ip.strip() == request.remote_addr.strip():
-                return True
         raise Unauthorized("IP Auth Failed")
 
     def _validate_http_auth(self):
         """Verify http auth request with values in "Authorization" header
         """
-        key = get_conf_value(self._config, 'rest_server', 'AUTH_ID')
-        secret = get_conf_value(self._config, 'rest_server', 'AUTH_TOKEN')
-        if not key or not secret:
+        if self._get_auth().check_authorization(
+                                    request.headers.get('Authorization')):
             return True
-        try:
-            auth_type, encoded_auth_str = \
-                request.headers['Authorization'].split(' ', 1)
-            if auth_type == 'Basic':
-                decoded_auth_str = base64.decodestring(encoded_auth_str)
-                auth_id, auth_token = decoded_auth_str.split(':', 1)
-                if auth_id == key and secret == auth_token:
-                    return True
-        except (KeyError, ValueError, TypeError):
-            pass
         raise Unauthorized("HTTP Auth Failed")
 
     @auth_protect
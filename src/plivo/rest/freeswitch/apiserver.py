@@ -15,13 +15,36 @@ import gevent
 from gevent.wsgi import WSGIServer
 
 from plivo.core.errors import ConnectError
+from plivo.core.freeswitch.inboundsocket import InboundEventSocketPool
 from plivo.rest.freeswitch.api import PlivoRestApi
+from plivo.rest.freeswitch.auth import get_rest_auth
 from plivo.rest.freeswitch.inboundsocket import RESTInboundSocket
 from plivo.rest.freeswitch import urls, helpers
+from plivo.rest.freeswitch.webhooks import WebhookDispatcher
 import plivo.utils.daemonize
 from plivo.utils.logger import StdoutLogger, FileLogger, SysLogger
 
 
+def get_webhook_dispatcher(config, auth_id, auth_token, log):
+    """Creates ring/hangup notifications dispatcher from config
+    """
+    kwargs = {}
+    for key, name, cast in (('WEBHOOK_MAX_PER_HOST', 'max_per_host', int),
+                            ('WEBHOOK_QUEUE_SIZE', 'queue_size', int),
+                            ('WEBHOOK_RETRIES', 'retries', int),
+                            ('WEBHOOK_RETRY_DELAY', 'retry_delay', float),
+                            ('WEBHOOK_BATCH_SIZE', 'batch_size', int),
+                            ('WEBHOOK_BATCH_INTERVAL', 'batch_interval', float),
+                            ('WEBHOOK_FLUSH_TIMEOUT', 'flush_timeout', float)):
+        try:
+            kwargs[name] = cast(helpers.get_conf_value(config, 'rest_server', key))
+        except ValueError:
+            pass
+    batch_urls = helpers.get_conf_value(config, 'rest_server', 'WEBHOOK_BATCH_URLS')
+    kwargs['batch_urls'] = [ u.strip() for u in batch_urls.split(',') if u.strip() ]
+    return WebhookDispatcher(auth_id, auth_token, log=log, **kwargs)
+
+
 class PlivoRestServer(PlivoRestApi):
     """Class PlivoRestServer"""
     name = 'PlivoRestServer'
@@ -49,7 +72,9 @@ class PlivoRestServer(PlivoRestApi):
         self._run = False
         self._pidfile = pidfile
         # load config
+        self._configfile = configfile
         self._config = helpers.get_config(configfile)
+        self._auth = get_rest_auth(self._config)
         # create flask app
         self.app = Flask(self.name)
         self.app.secret_key = helpers.get_conf_value(self._config,
@@ -69,6 +94,9 @@ class PlivoRestServer(PlivoRestApi):
                                         'rest_server', 'AUTH_ID')
         self.auth_token = helpers.get_conf_value(self._config,
                                         'rest_server', 'AUTH_TOKEN')
+        # keep-alive connections for http callbacks
+        helpers.set_connection_pool(
+            helpers.get_connection_pool_from_config(self._config, 'rest_server'))
         # get outbound socket host/port
         fs_out_address = helpers.get_conf_value(self._config,
                                         'freeswitch', 'FS_OUTBOUND_ADDRESS')
@@ -82,12 +110,27 @@ class PlivoRestServer(PlivoRestApi):
         if not default_http_method or \
                             default_http_method not in ('GET', 'POST'):
             self.default_http_method = 'POST'
+        # create pool of inbound sockets for commands if enabled
+        try:
+            pool_size = int(helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_INBOUND_POOL_SIZE'))
+        except ValueError:
+            pool_size = 0
+        if pool_size > 0:
+            self._command_pool = InboundEventSocketPool(fs_host, fs_port,
+                                            fs_password, size=pool_size,
+                                            log=self.log)
+        else:
+            self._command_pool = None
         # create inbound socket instance
         self._rest_inbound_socket = RESTInboundSocket(fs_host, fs_port,
                             fs_password, outbound_address=fs_out_address,
                             auth_id=self.auth_id,
                             auth_token=self.auth_token,
-                            log=self.log, default_http_method=default_http_method)
+                            log=self.log, default_http_method=default_http_method,
+                            command_pool=self._command_pool,
+                            webhooks=get_webhook_dispatcher(self._config,
+                                        self.auth_id, self.auth_token, self.log))
         # expose API functions to flask app
         for path, func_desc in urls.URLS.iteritems():
             func, methods = func_desc
@@ -177,11 +220,31 @@ class PlivoRestServer(PlivoRestApi):
         self.stop()
         sys.exit(0)
 
+    def sig_hup(self, *args):
+        """if we receive a hup signal, we reload auth settings
+        (AUTH_ID, AUTH_TOKEN, ALLOWED_IPS) from config file
+        """
+        try:
+            self._auth = get_rest_auth(helpers.get_config(self._configfile))
+        except Exception, e:
+            self.log.error("Reloading auth settings failed: %s" % str(e))
+            return
+        self.log.info("Auth settings reloaded")
+
     def stop(self):
         """Method stop stop the infinite loop from start method
         and close the socket
         """
         self._run = False
+        if self._command_pool:
+            self._command_pool.stop()
+        webhooks = self._rest_inbound_socket.webhooks
+        # Delivers pending notifications before exiting
+        webhooks.flush()
+        if not webhooks.join():
+            self.log.warn("Webhooks not delivered after %s seconds"
+                          % webhooks.flush_timeout)
+        self.log.info("Webhooks: %s" % str(webhooks.get_stats()))
         self._rest_inbound_socket.exit()
 
     def start(self):
@@ -195,6 +258,8 @@ class PlivoRestServer(PlivoRestApi):
         self.log.info("RESTServer starting ...")
         # catch SIG_TERM
         gevent.signal(signal.SIGTERM, self.sig_term)
+        # catch SIG_HUP
+        gevent.signal(signal.SIGHUP, self.sig_hup)
         # run
         self._run = True
         if self._daemon:
@@ -204,6 +269,11 @@ class PlivoRestServer(PlivoRestApi):
         # start http server
         self.http_proc = gevent.spawn(self.http_server.serve_forever)
         self.log.info("RESTServer started at: 'http://%s'" % self.http_address)
+        # start pool of inbound sockets for commands
+        if self._command_pool:
+            self.log.info("Starting %d FreeSWITCH command connections" \
+                                            % self._command_pool.size)
+            self._command_pool.start()
         # Start inbound socket
         try:
             while self._run:
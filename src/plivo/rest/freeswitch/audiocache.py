@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from hashlib import md5
+import os
+import os.path
+import tempfile
+import time
+import urllib2
+
+import gevent
+
+
+class AudioCache(object):
+    """Local cache of remote audio files.
+
+    Files are stored in directory, named by the MD5 hash of their url.
+    File modification time is the last use time, least recently used
+    files are removed when the total size exceeds max_size, except files
+    used in the last grace seconds (they may be playing).
+    Cached files older than ttl seconds are revalidated in background
+    with their ETag / Last-Modified, stored in a .meta file whose
+    modification time is the last validation time.
+    Responses which are not audio (error pages) are not cached.
+    The directory can be shared by several processes, it is scanned
+    when the size counted from downloads exceeds max_size, and at least
+    every evict_interval seconds.
+    """
+    CHUNK_SIZE = 65536
+    CONTENT_TYPES = ('audio/', 'application/octet-stream')
+
+    def __init__(self, directory, max_size=100*1024*1024, timeout=30,
+                 ttl=300, grace=300, evict_interval=60):
+        """initialize a object
+
+        directory: cache directory, created if missing
+        max_size: max total size of cached files in bytes
+        timeout: download timeout in seconds
+        ttl: seconds before a cached file is revalidated, 0 to never
+             revalidate
+        grace: seconds a used file is kept, and a .tmp file left
+               by a download is kept
+        evict_interval: max seconds between scans of the directory
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ttl = ttl
+        self.grace = grace
+        self.evict_interval = evict_interval
+        # Total size, counted at last scan plus downloads since
+        self._size = None
+        self._evicted = 0
+        # Downloads in progress by url
+        self._downloads = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_path(self, url):
+        """Gets local file path for url
+        """
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        ext = os.path.splitext(url.split('?', 1)[0])[1][:5]
+        return os.path.join(self.directory, md5(url).hexdigest() + ext)
+
+    def get_meta_path(self, path):
+        return path + '.meta'
+
+    def lookup(self, url):
+        """Gets local file path if url is cached, or None
+
+        If cached file is expired, it is still returned and
+        revalidated in background.
+        """
+        path = self.get_path(url)
+        try:
+            # Marks as recently used
+            os.utime(path, None)
+        except OSError:
+            return None
+        if self.is_expired(path):
+            self.prefetch(url)
+        return path
+
+    def is_expired(self, path):
+        if not self.ttl:
+            return False
+        try:
+            checked = os.path.getmtime(self.get_meta_path(path))
+        except OSError:
+            return True
+        return checked + self.ttl < time.time()
+
+    def prefetch(self, url):
+        """Starts downloading url in background, if not cached
+        or expired
+
+        Returns the download greenlet, its value is the local
+        file path or None on failure.
+        """
+        try:
+            return self._downloads[url]
+        except KeyError:
+            pass
+        download = gevent.spawn(self.fetch, url)
+        self._downloads[url] = download
+        download.link(lambda g: self._downloads.pop(url, None))
+        return download
+
+    def fetch(self, url):
+        """Downloads url if not cached, or revalidates it if expired
+
+        Returns the local file path, or None on failure
+        (the expired file if revalidation failed).
+        """
+        path = self.get_path(url)
+        meta_path = self.get_meta_path(path)
+        if os.path.exists(path):
+            if not self.is_expired(path):
+                os.utime(path, None)
+                return path
+            cached = path
+        else:
+            cached = None
+        request = urllib2.Request(url)
+        if cached:
+            etag, last_modified = self._read_meta(meta_path)
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        size = 0
+        response = None
+        try:
+            try:
+                response = urllib2.urlopen(request, timeout=self.timeout)
+                content_type = response.info().get('Content-Type', '')
+                if not content_type.lower().startswith(self.CONTENT_TYPES):
+                    raise ValueError("Not audio content type '%s'"
+                                     % content_type)
+                while True:
+                    data = response.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    os.write(fd, data)
+                    size += len(data)
+            finally:
+                os.close(fd)
+                if response is not None:
+                    response.close()
+            if cached:
+                try:
+                    size -= os.path.getsize(cached)
+                except OSError:
+                    pass
+            # Atomic, readers never see a partial file,
+            # a file being played is still readable once replaced
+            os.rename(tmp_path, path)
+            self._write_meta(meta_path, response.info().get('ETag', ''),
+                             response.info().get('Last-Modified', ''))
+        except urllib2.HTTPError, e:
+            if e.fp is not None:
+                e.close()
+            self._unlink(tmp_path)
+            if cached and e.code == 304:
+                # Not modified, valid for ttl seconds again
+                self._write_meta(meta_path, *self._read_meta(meta_path))
+            return cached
+        except Exception:
+            self._unlink(tmp_path)
+            return cached
+        self._add_size(size)
+        return path
+
+    def _add_size(self, size):
+        if self._size is not None:
+            self._size += size
+        if self._size is None or self._size > self.max_size \
+            or self._evicted + self.evict_interval < time.time():
+            self.evict()
+
+    def _read_meta(self, meta_path):
+        try:
+            lines = open(meta_path).read().split('\n')
+            return lines[0], lines[1]
+        except (IOError, IndexError):
+            return '', ''
+
+    def _write_meta(self, meta_path, etag, last_modified):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            try:
+                os.write(fd, '%s\n%s\n' % (etag, last_modified))
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, meta_path)
+        except OSError:
+            self._unlink(tmp_path)
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes least recently used files over max size,
+        and .tmp files left by interrupted downloads
+        """
+        files = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if name.endswith('.meta'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                # Downloads write at least every timeout seconds
+                if st.st_mtime + max(self.grace, self.timeout) < now:
+                    self._unlink(path)
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.max_size or mtime + self.grace >= now:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._unlink(self.get_meta_path(path))
+            total -= size
+        self._size = total
+        self._evicted = now
+
+    def get_size(self):
+        """Gets total size of cached files
+        """
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.meta'):
+                continue
+            try:
+                total += os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        return total
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import base64
+import binascii
+import socket
+import struct
+
+from plivo.rest.freeswitch.helpers import get_conf_value
+
+
+# Number of checked Authorization headers kept (up to twice as many
+# with previous ones)
+CACHE_SIZE = 1000
+
+
+def ip_to_int(ip):
+    """Converts an IPv4 address to an int, raises ValueError if invalid
+    """
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, struct.error):
+        raise ValueError("Invalid IPv4 address %r" % ip)
+
+
+class RestAuth(object):
+    """REST API auth settings, compiled once.
+
+    auth_id, auth_token: HTTP Basic auth credentials,
+                         auth is disabled if one is empty
+    allowed_ips: comma separated ips or IPv4 networks (CIDR notation),
+                 all ips are allowed if empty
+    """
+    def __init__(self, auth_id='', auth_token='', allowed_ips=''):
+        self.auth_id = auth_id
+        self.auth_token = auth_token
+        self.http_auth = bool(auth_id and auth_token)
+        ips = []
+        # Network ints by prefix length
+        networks = {}
+        for entry in allowed_ips.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            if not '/' in entry:
+                ips.append(entry)
+                continue
+            address, prefix = entry.split('/', 1)
+            prefix = int(prefix)
+            if not 0 <= prefix <= 32:
+                raise ValueError("Invalid network %r" % entry)
+            mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+            networks.setdefault(mask, set()).add(ip_to_int(address) & mask)
+        self.ips = frozenset(ips)
+        self.networks = [ (mask, frozenset(nets))
+                          for mask, nets in sorted(networks.items(),
+                                                   reverse=True) ]
+        self.ip_auth = bool(self.ips or self.networks)
+        # Check results by Authorization header, see urlvalidator
+        self._cache = {}
+        self._previous = {}
+
+    def check_ip(self, ip):
+        """Returns True if ip is allowed
+        """
+        if not self.ip_auth:
+            return True
+        ip = ip.strip()
+        if ip in self.ips:
+            return True
+        if not self.networks:
+            return False
+        try:
+            value = ip_to_int(ip)
+        except ValueError:
+            return False
+        for mask, nets in self.networks:
+            if value & mask in nets:
+                return True
+        return False
+
+    def check_authorization(self, header):
+        """Returns True if Authorization header has the right credentials
+        """
+        if not self.http_auth:
+            return True
+        if not header:
+            return False
+        try:
+            return self._cache[header]
+        except KeyError:
+            pass
+        try:
+            result = self._previous[header]
+        except KeyError:
+            result = self._check_authorization(header)
+        if len(self._cache) >= CACHE_SIZE:
+            self._previous, self._cache = self._cache, {}
+        self._cache[header] = result
+        return result
+
+    def _check_authorization(self, header):
+        try:
+            auth_type, encoded_auth_str = header.split(' ', 1)
+            if auth_type == 'Basic':
+                decoded_auth_str = base64.decodestring(encoded_auth_str)
+                auth_id, auth_token = decoded_auth_str.split(':', 1)
+                if auth_id == self.auth_id and auth_token == self.auth_token:
+                    return True
+        except (ValueError, TypeError, binascii.Error):
+            pass
+        return False
+
+
+def get_rest_auth(config):
+    """Creates REST API auth settings from config
+    """
+    return RestAuth(get_conf_value(config, 'rest_server', 'AUTH_ID'),
+                    get_conf_value(config, 'rest_server', 'AUTH_TOKEN'),
+                    get_conf_value(config, 'rest_server', 'ALLOWED_IPS'))
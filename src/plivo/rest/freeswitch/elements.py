@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2011 Plivo Team. See LICENSE for details.
 
+import copy
 import gevent
 import os.path
 from datetime import datetime
@@ -8,6 +9,7 @@ import re
 import uuid
 from plivo.rest.freeswitch.helpers import is_valid_url, url_exists, \
                                                         file_exists
+from plivo.rest.freeswitch.urlvalidator import validate_url
 from plivo.rest.freeswitch.exceptions import RESTFormatException, \
                                             RESTAttributeException, \
                                             RESTRedirectException, \
@@ -15,6 +17,10 @@ from plivo.rest.freeswitch.exceptions import RESTFormatException, \
                                             RESTHangup
 
 
+# Max seconds a Play waits for its remote audio download,
+# before streaming it
+PREFETCH_WAIT = 0.5
+
 ELEMENTS_DEFAULT_PARAMS = {
         'Conference': {
                 #'room': SET IN ELEMENT BODY
@@ -94,6 +100,40 @@ ELEMENTS_DEFAULT_PARAMS = {
     }
 
 
+def get_remote_audio_path(audio_url, audio_cache=None):
+    """Gets path to play a remote mp3 audio url
+
+    audio_url: ValidatedURL of audio
+
+    Returns local file if cached in audio_cache, else starts
+    downloading it in background and returns the shout:// stream.
+    """
+    if audio_url.url[-4:].lower() != '.mp3':
+        raise RESTFormatException("Only mp3 files allowed for remote file play")
+    if audio_cache:
+        local_path = audio_cache.lookup(audio_url.url)
+        if local_path:
+            return local_path
+        audio_cache.prefetch(audio_url.url)
+    return audio_url.shout_url
+
+
+def get_prefetched_audio_path(url, audio_cache, wait=PREFETCH_WAIT):
+    """Gets local file of a remote audio url, waiting at most wait seconds
+    for its download
+
+    Returns None if not downloaded yet, download keeps running.
+    """
+    local_path = audio_cache.lookup(url)
+    if local_path:
+        return local_path
+    download = audio_cache.prefetch(url)
+    download.join(wait)
+    if download.ready():
+        return download.value
+    return None
+
+
 class Element(object):
     """Abstract Element Class to be inherited by all Element elements"""
 
@@ -108,6 +148,38 @@ class Element(object):
         self.prepare_attributes(element)
         self.prepare_text(element)
 
+    def copy(self):
+        """Returns a copy of a parsed element for a new call.
+
+        Lists and dicts are copied, so the copy can be changed
+        while executing without changing this element.
+        """
+        element = copy.copy(self)
+        for key, value in self.__dict__.iteritems():
+            if isinstance(value, (list, dict)):
+                element.__dict__[key] = type(value)(value)
+        element.children = [ child.copy() for child in self.children ]
+        return element
+
+    def prepare_children(self, outbound_socket):
+        """Prepares children concurrently, returns when all are prepared
+        """
+        jobs = [ gevent.spawn(child_instance.prepare, outbound_socket)
+                 for child_instance in self.children
+                 if hasattr(child_instance, "prepare") ]
+        try:
+            gevent.joinall(jobs, raise_error=True)
+        finally:
+            gevent.killall(jobs)
+
+    def get_audio_urls(self):
+        """Gets remote audio urls played by this element and children
+        """
+        urls = []
+        for child in self.children:
+            urls.extend(child.get_audio_urls())
+        return urls
+
     def run(self, outbound_socket):
         outbound_socket.log.info("[%s] %s %s" \
             % (self.name, self.text, self.attributes))
@@ -144,7 +216,7 @@ class Element(object):
         if not text:
             self.text = ''
         else:
-            self.text = text.strip()
+            self.text = ' '.join(text.split())
 
     def fetch_rest_xml(self, url, params={}, method='POST'):
         raise RESTRedirectException(url, params, method)
@@ -236,27 +308,24 @@ class Conference(Element):
         except ValueError:
             self.exit_sound = ''
 
-    def _prepare_moh(self):
+    def get_audio_urls(self):
+        if not self.moh_sound:
+            return []
+        return [ audio_path for audio_path in self.moh_sound.split(',')
+                 if is_valid_url(audio_path) ]
+
+    def _prepare_moh(self, audio_cache=None):
         mohs = []
         if not self.moh_sound:
             return mohs
         for audio_path in self.moh_sound.split(','):
-            if not is_valid_url(audio_path):
+            audio_url = validate_url(audio_path)
+            if not audio_url:
                 if file_exists(audio_path):
                     mohs.append(audio_path)
             else:
                 if url_exists(audio_path):
-                    if audio_path[-4:].lower() != '.mp3':
-                        raise RESTFormatException("Only mp3 files allowed for remote file play")
-                    if audio_path[:7].lower() == 'http://':
-                        audio_path = audio_path[7:]
-                    elif audio_path[:8].lower() == 'https://':
-                        audio_path = audio_path[8:]
-                    elif audio_path[:6].lower() == 'ftp://':
-                        audio_path = audio_path[6:]
-                    else:
-                        pass
-                    mohs.append("shout://%s" % audio_path)
+                    mohs.append(get_remote_audio_path(audio_url, audio_cache))
         return mohs
 
     def execute(self, outbound_socket):
@@ -268,7 +337,7 @@ class Conference(Element):
         else:
             outbound_socket.unset("max-members")
         # set moh sound
-        mohs = self._prepare_moh()
+        mohs = self._prepare_moh(outbound_socket.audio_cache)
         if not mohs:
             outbound_socket.unset("conference_moh_sound")
         else:
@@ -397,27 +466,24 @@ class Dial(Element):
             raise RESTAttributeException("Method, must be 'GET' or 'POST'")
         self.method = method
 
-    def _prepare_moh(self):
+    def get_audio_urls(self):
+        if not self.dial_music:
+            return []
+        return [ audio_path for audio_path in self.dial_music.split(',')
+                 if is_valid_url(audio_path) ]
+
+    def _prepare_moh(self, audio_cache=None):
         mohs = []
         if not self.dial_music:
             return mohs
         for audio_path in self.dial_music.split(','):
-            if not is_valid_url(audio_path):
+            audio_url = validate_url(audio_path)
+            if not audio_url:
                 if file_exists(audio_path):
                     mohs.append(audio_path)
             else:
                 if url_exists(audio_path):
-                    if audio_path[-4:].lower() != '.mp3':
-                        raise RESTFormatException("Only mp3 files allowed for remote file play")
-                    if audio_path[:7].lower() == "http://":
-                        audio_path = audio_path[7:]
-                    elif audio_path[:8].lower() == "https://":
-                        audio_path = audio_path[8:]
-                    elif audio_path[:6].lower() == "ftp://":
-                        audio_path = audio_path[6:]
-                    else:
-                        pass
-                    mohs.append("shout://%s" % audio_path)
+                    mohs.append(get_remote_audio_path(audio_url, audio_cache))
         return mohs
 
     def create_number(self, number_instance, outbound_socket):
@@ -517,7 +583,7 @@ class Dial(Element):
         else:
             outbound_socket.unset("bridge_terminate_key")
         # Play Dial music or bridge the early media accordingly
-        mohs = self._prepare_moh()
+        mohs = self._prepare_moh(outbound_socket.audio_cache)
         if not mohs:
             outbound_socket.set("bridge_early_media=true")
             outbound_socket.unset("instant_ringback")
@@ -661,11 +727,8 @@ class GetDigits(Element):
         self.finish_on_key = finish_on_key
         self.retries = retries
 
-    def prepare(self):
-        for child_instance in self.children:
-            if hasattr(child_instance, "prepare"):
-                # :TODO Prepare Element concurrently
-                child_instance.prepare()
+    def prepare(self, outbound_socket):
+        self.prepare_children(outbound_socket)
 
     def execute(self, outbound_socket):
         for child_instance in self.children:
@@ -873,6 +936,8 @@ class Play(Element):
         self.audio_directory = ''
         self.loop_times = 1
         self.sound_file_path = ''
+        self.audio_path = ''
+        self.audio_url = ''
 
     def parse_element(self, element, uri=None):
         Element.parse_element(self, element, uri)
@@ -890,28 +955,36 @@ class Play(Element):
         if not audio_path:
             raise RESTFormatException("No File to play set !")
 
-        if not is_valid_url(audio_path):
-            if file_exists(audio_path):
-                self.sound_file_path = audio_path
-        else:
-            if url_exists(audio_path):
-                if audio_path[-4:].lower() != '.mp3':
-                    raise RESTFormatException("Only mp3 files allowed for remote file play")
-                if audio_path[:7].lower() == "http://":
-                    audio_path = audio_path[7:]
-                elif audio_path[:8].lower() == "https://":
-                    audio_path = audio_path[8:]
-                elif audio_path[:6].lower() == "ftp://":
-                    audio_path = audio_path[6:]
-                else:
-                    pass
-                self.sound_file_path = "shout://%s" % audio_path
+        self.audio_path = audio_path
+        if validate_url(audio_path):
+            if audio_path[-4:].lower() != '.mp3':
+                raise RESTFormatException("Only mp3 files allowed for remote file play")
+            self.audio_url = audio_path
+
+    def get_audio_urls(self):
+        if self.audio_url:
+            return [self.audio_url]
+        return []
 
-    def prepare(self):
-        # TODO: If Sound File is Audio URL then Check file type format
-        # Download the file, move to audio directory and set sound file path
-        # Create MD5 hash to identify the with filename for caching
-        pass
+    def prepare(self, outbound_socket):
+        # File and url are checked for each call, parsed elements
+        # may be cached (url checks are cached by URLChecker)
+        self.sound_file_path = ''
+        if not self.audio_url:
+            if file_exists(self.audio_path):
+                self.sound_file_path = self.audio_path
+            return
+        if not url_exists(self.audio_url):
+            return
+        # Plays local file if remote audio is downloaded soon enough,
+        # else keeps streaming it
+        if outbound_socket.audio_cache:
+            local_path = get_prefetched_audio_path(self.audio_url,
+                                                   outbound_socket.audio_cache)
+            if local_path:
+                self.sound_file_path = local_path
+                return
+        self.sound_file_path = validate_url(self.audio_url).shout_url
 
     def execute(self, outbound_socket):
         if self.sound_file_path:
@@ -958,10 +1031,8 @@ class PreAnswer(Element):
     def parse_element(self, element, uri=None):
         Element.parse_element(self, element, uri)
 
-    def prepare(self):
-        for child_instance in self.children:
-            if hasattr(child_instance, "prepare"):
-                child_instance.prepare()
+    def prepare(self, outbound_socket):
+        self.prepare_children(outbound_socket)
 
     def execute(self, outbound_socket):
         outbound_socket.preanswer()
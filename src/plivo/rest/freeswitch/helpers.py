@@ -2,30 +2,30 @@
 # Copyright (c) 2011 Plivo Team. See LICENSE for details.
 
 import base64
+from collections import OrderedDict
 import ConfigParser
 from hashlib import sha1
 import hmac
 import httplib
+import os
 import os.path
-import re
+import select
+import socket
+import threading
+import time
 import urllib
 import urllib2
 import urlparse
 
+import gevent.event
 
 from werkzeug.datastructures import MultiDict
 
+from plivo.rest.freeswitch.urlvalidator import validate_url
+
 
 def url_exists(url):
-    p = urlparse.urlparse(url)
-    try:
-        connection = httplib.HTTPConnection(p[1])
-        connection.request('HEAD', p[2])
-        response = connection.getresponse()
-        connection.close()
-        return response.status == httplib.OK
-    except Exception:
-        return False
+    return get_url_checker().exists(url)
 
 
 def file_exists(filepath):
@@ -54,68 +54,479 @@ def get_conf_value(config, section, key):
 
 
 def is_valid_url(value):
-    regex = re.compile(
-      r'^(?:http|ftp)s?://'  # http:// or https://
-      r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain
-      r'localhost|'  # localhost
-      r'http://127.0.0.1|'  # 127.0.0.1
-      r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # or ip
-      r'(?::\d+)?'  # optional port
-      r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-
-    # If no domain starters we assume its http and add it
-    if not value.startswith('http://') and not value.startswith('https://') \
-        and not value.startswith('ftp://'):
-        value = ''.join(['http://', value])
-
-    if regex.search(value):
-        return True
-    # Trivial case failed. Try for possible IDN domain
-    if value:
-        scheme, netloc, path, query, fragment = urlparse.urlsplit(value)
+    return validate_url(value) is not None
+
+
+class HTTPCacheEntry(object):
+    """Cached HTTP response body with ETag and expiry time.
+    """
+    __slots__ = ('body', 'etag', 'expires')
+
+    def __init__(self, body, etag, expires):
+        self.body = body
+        self.etag = etag
+        self.expires = expires
+
+    def is_fresh(self):
+        return self.expires > time.time()
+
+
+class HTTPResponseCache(object):
+    """LRU cache of HTTP responses, used for RESTXML documents.
+
+    Responses are keyed by method, url and the whitelisted params only,
+    other params (CallUUID, From, ...) are ignored.
+    Cache-Control max-age sets the freshness lifetime (ttl if missing),
+    no-store and private responses are never cached.
+    Stale responses with an ETag are revalidated with If-None-Match.
+    """
+    def __init__(self, size=1000, ttl=0, params=()):
+        """initialize a object
+
+        size: max number of cached responses
+        ttl: freshness lifetime in seconds without Cache-Control max-age
+        params: params part of the cache key
+        """
+        self.size = size
+        self.ttl = ttl
+        self.params = tuple(sorted(params))
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get_key(self, method, uri, params):
+        return (method, uri, tuple([ (k, params[k]) for k in self.params
+                                     if k in params ]))
+
+    def get(self, key):
+        """Gets cache entry or None, and counts a hit if fresh
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        # Most recently used goes last
+        self._entries[key] = entry
+        if entry.is_fresh():
+            self.hits += 1
+        else:
+            self.misses += 1
+        return entry
+
+    def put(self, key, body, headers):
+        """Caches a response body according to response headers
+        """
+        ttl = self._get_ttl(headers)
+        etag = headers.get('ETag')
+        if ttl is None or (ttl <= 0 and not etag):
+            self._entries.pop(key, None)
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = HTTPCacheEntry(body, etag, time.time() + ttl)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def revalidate(self, key, entry, headers):
+        """Renews a stale entry after a 304 Not Modified response
+        """
+        self.revalidations += 1
+        ttl = self._get_ttl(headers)
+        if ttl is not None:
+            entry.expires = time.time() + ttl
+        entry.etag = headers.get('ETag') or entry.etag
+
+    def _get_ttl(self, headers):
+        """Gets freshness lifetime, or None if response must not be cached
+        """
+        ttl = self.ttl
+        for directive in headers.get('Cache-Control', '').lower().split(','):
+            directive = directive.strip()
+            if directive in ('no-store', 'private'):
+                return None
+            elif directive == 'no-cache':
+                ttl = 0
+            elif directive.startswith('max-age='):
+                try:
+                    ttl = int(directive[8:])
+                except ValueError:
+                    pass
+        return ttl
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self):
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+               }
+
+
+# Requests retried if a kept connection fails after sending them
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+
+class HTTPConnectionPool(object):
+    """Keep-alive HTTP connections, pooled per scheme, host and port.
+
+    Requests are not limited, a new connection is opened when none is idle.
+    Up to max_idle connections are kept per host once used, connections
+    idle for more than idle_timeout seconds are closed instead of
+    being reused.
+    """
+    def __init__(self, max_idle=10, idle_timeout=60,
+                 connect_timeout=10, read_timeout=30):
+        """initialize a object
+
+        max_idle: max idle connections kept per host
+        idle_timeout: max idle time in seconds of a kept connection
+        connect_timeout: connection timeout in seconds
+        read_timeout: socket timeout in seconds once connected
+        """
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Connections inherited from a parent process are never reused
+        self._pid = os.getpid()
+        # Idle connections by host, most recently used last
+        self._idle = {}
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port,
+                                           timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port,
+                                          timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def _get_connection(self, key):
+        """Gets (connection, reused), reusing an idle connection if any
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            idle = self._idle.get(key)
+            while idle:
+                conn, last_used = idle.pop()
+                if time.time() - last_used < self.idle_timeout \
+                        and not self._is_closed(conn):
+                    return conn, True
+                conn.close()
+        return self._connect(key), False
+
+    def _is_closed(self, conn):
+        """Checks if an idle connection was closed by server
+        (readable while idle means closed)
+        """
         try:
-            netloc = netloc.encode('idna')  # IDN -> ACE
-        except UnicodeError:  # invalid domain part
-            return False
-        url = urlparse.urlunsplit((scheme, netloc, path, query, fragment))
-        if regex.search(url):
+            return bool(select.select([conn.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError, TypeError):
             return True
 
-    return False
+    def _put_connection(self, key, conn):
+        with self._lock:
+            if self._pid == os.getpid():
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append((conn, time.time()))
+                    return
+        conn.close()
 
+    def open(self, method, url, body=None, headers={}):
+        """Sends a request, returns the HTTPPooledResponse
+
+        The response must be closed, to release its connection.
+        """
+        p = urlparse.urlsplit(url)
+        scheme = p.scheme.lower()
+        key = (scheme, p.hostname, p.port or (scheme == 'https' and 443 or 80))
+        selector = p.path or '/'
+        if p.query:
+            selector += '?' + p.query
+        conn, reused = self._get_connection(key)
+        sent = False
+        try:
+            conn.request(method, selector, body, headers)
+            sent = True
+            sock = conn.sock
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            # Kept connection closed by server, retries on a new one,
+            # unless the server may have received a non idempotent
+            # request (sent a POST twice would notify twice)
+            if not reused or (sent and not method in IDEMPOTENT_METHODS):
+                raise
+            conn = self._connect(key)
+            conn.request(method, selector, body, headers)
+            sock = conn.sock
+            response = conn.getresponse()
+        return HTTPPooledResponse(self, key, conn, response, sock)
+
+    def request(self, method, url, body=None, headers={}):
+        """Sends a request and reads the response.
+
+        Returns (status, reason, headers, body).
+        """
+        response = self.open(method, url, body, headers)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        return response.status, response.reason, response.msg, data
+
+    def get_idle_count(self):
+        with self._lock:
+            return sum([ len(idle) for idle in self._idle.values() ])
+
+    def close(self):
+        """Closes all idle connections
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, last_used in idle:
+                    conn.close()
+            self._idle.clear()
+
+
+class HTTPPooledResponse(object):
+    """Response read from a pooled connection.
+
+    Connection goes back to the pool on close if response was fully read,
+    else it is closed.
+    """
+    def __init__(self, pool, key, conn, response, sock):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        # Kept as connection forgets it when response closes the connection
+        self._sock = sock
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+    def read(self, size=None):
+        try:
+            return self._response.read(size)
+        except:
+            self._conn.close()
+            raise
+
+    def read_available(self, size):
+        """Reads up to size bytes, returns as soon as some were received
+        ('' at end of response)
+        """
+        response = self._response
+        try:
+            # Waits for the first byte
+            data = response.read(1)
+            if not data or size <= 1:
+                return data
+            if response.chunked:
+                left = response.chunk_left or 0
+            else:
+                left = response.length
+            received = self._get_received(size - 1)
+            if left is not None:
+                received = min(received, left)
+            if received:
+                data += response.read(received)
+            return data
+        except:
+            self._conn.close()
+            raise
+
+    def _get_received(self, size):
+        """Returns the number of bytes received but not read yet (up to size)
+        """
+        if hasattr(self._sock, 'pending'):
+            # SSL socket, bytes of the decrypted record
+            return min(self._sock.pending(), size)
+        if not select.select([self._sock], [], [], 0)[0]:
+            return 0
+        return len(self._sock.recv(size, socket.MSG_PEEK))
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._put_connection(self._key, conn)
+        else:
+            conn.close()
 
-class HTTPErrorProcessor(urllib2.HTTPErrorProcessor):
-    def https_response(self, request, response):
-        code, msg, hdrs = response.code, response.msg, response.info()
-        if code >= 300:
-            response = self.parent.error(
-                'http', request, response, code, msg, hdrs)
-        return response
 
+# Connection pool shared by all HTTPRequest objects of the process
+_connection_pool = None
 
-class HTTPUrlRequest(urllib2.Request):
-    def get_method(self):
-        if getattr(self, 'http_method', None):
-            return self.http_method
-        return urllib2.Request.get_method(self)
+
+def get_connection_pool():
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = HTTPConnectionPool()
+    return _connection_pool
+
+
+def set_connection_pool(pool):
+    global _connection_pool
+    if _connection_pool is not None and _connection_pool is not pool:
+        _connection_pool.close()
+    _connection_pool = pool
+
+
+def get_connection_pool_from_config(config, section):
+    """Creates HTTP connection pool from config section
+    """
+    kwargs = {}
+    for key, name, cast in (('HTTP_MAX_IDLE', 'max_idle', int),
+                            ('HTTP_IDLE_TIMEOUT', 'idle_timeout', float),
+                            ('HTTP_CONNECT_TIMEOUT', 'connect_timeout', float),
+                            ('HTTP_READ_TIMEOUT', 'read_timeout', float)):
+        try:
+            value = cast(get_conf_value(config, section, key))
+        except ValueError:
+            continue
+        if value > 0:
+            kwargs[name] = value
+    return HTTPConnectionPool(**kwargs)
+
+
+class URLChecker(object):
+    """Checks urls exist with HEAD requests, caching results.
+
+    Existing urls are cached for ttl seconds, missing ones for
+    negative_ttl seconds. Concurrent checks of a same url wait for
+    the same HEAD request.
+    """
+    def __init__(self, ttl=60, negative_ttl=10, size=1000, timeout=5):
+        """initialize a object
+
+        ttl: cache time in seconds of existing urls
+        negative_ttl: cache time in seconds of missing urls
+        size: max number of cached results
+        timeout: HEAD request connect/read timeout in seconds
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.pool = HTTPConnectionPool(connect_timeout=timeout,
+                                       read_timeout=timeout)
+        # (exists, expires) by url, oldest first
+        self._results = OrderedDict()
+        # Checks in progress by url
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def exists(self, url):
+        result = self._results.get(url)
+        if result and result[1] > time.time():
+            self.hits += 1
+            return result[0]
+        pending = self._pending.get(url)
+        if pending:
+            self.hits += 1
+            return pending.get()
+        self.misses += 1
+        pending = gevent.event.AsyncResult()
+        self._pending[url] = pending
+        exists = False
+        try:
+            exists = self._check(url)
+        finally:
+            del self._pending[url]
+            pending.set(exists)
+        if exists:
+            ttl = self.ttl
+        else:
+            ttl = self.negative_ttl
+        self._results.pop(url, None)
+        if ttl > 0:
+            self._results[url] = (exists, time.time() + ttl)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return exists
+
+    def _check(self, url):
+        try:
+            status = self.pool.request('HEAD', url)[0]
+        except Exception:
+            return False
+        return status == httplib.OK
+
+    def clear(self):
+        self._results.clear()
+
+    def get_stats(self):
+        return {'size': len(self._results),
+                'hits': self.hits,
+                'misses': self.misses,
+               }
+
+
+# Url checker shared by all elements of the process
+_url_checker = None
+
+
+def get_url_checker():
+    global _url_checker
+    if _url_checker is None:
+        _url_checker = URLChecker()
+    return _url_checker
+
+
+def set_url_checker(checker):
+    global _url_checker
+    _url_checker = checker
+
+
+def get_url_checker_from_config(config, section):
+    """Creates url checker from config section
+    """
+    kwargs = {}
+    for key, name, cast in (('URL_EXISTS_TTL', 'ttl', float),
+                            ('URL_EXISTS_NEGATIVE_TTL', 'negative_ttl', float),
+                            ('URL_EXISTS_CACHE_SIZE', 'size', int),
+                            ('URL_EXISTS_TIMEOUT', 'timeout', float)):
+        try:
+            value = cast(get_conf_value(config, section, key))
+        except ValueError:
+            continue
+        if value >= 0:
+            kwargs[name] = value
+    return URLChecker(**kwargs)
 
 
 class HTTPRequest:
     """Helper class for preparing HTTP requests.
     """
     USER_AGENT = 'Plivo'
+    MAX_REDIRECTS = 5
 
-    def __init__(self, auth_id='', auth_token=''):
+    def __init__(self, auth_id='', auth_token='', pool=None):
         """initialize a object
 
         auth_id: Plivo SID/ID
         auth_token: Plivo token
+        pool: HTTPConnectionPool (optional, default is the process pool)
 
         returns a HTTPRequest object
         """
         self.auth_id = auth_id
         self.auth_token = auth_token
-        self.opener = None
+        self.pool = pool
 
     def _build_get_uri(self, uri, params):
         if params:
@@ -128,33 +539,64 @@ class HTTPRequest:
         return uri
 
     def _prepare_http_request(self, uri, params, method='POST'):
-        # install error processor to handle HTTP 201 response correctly
-        if self.opener == None:
-            self.opener = urllib2.build_opener(HTTPErrorProcessor)
-            urllib2.install_opener(self.opener)
-
+        """Returns (uri, body, headers) for the request
+        """
+        headers = {'User-Agent': self.USER_AGENT}
         if method and method == 'GET':
-            uri = self._build_get_uri(uri, params)
-            request = HTTPUrlRequest(uri)
+            request_uri = self._build_get_uri(uri, params)
+            body = None
         else:
-            request = HTTPUrlRequest(uri, urllib.urlencode(params))
-            if method and (method == 'DELETE' or method == 'PUT'):
-                request.http_method = method
-
-        request.add_header('User-Agent', self.USER_AGENT)
+            request_uri = uri
+            body = urllib.urlencode(params)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
 
         # append the POST variables sorted by key to the uri
-        s = uri
+        s = request_uri
         for k, v in sorted(params.items()):
             s += k + v
 
         # compute signature and compare signatures
         signature =  base64.encodestring(hmac.new(self.auth_token, s, sha1).\
                                                             digest()).strip()
-        request.add_header("X_PLIVO_SIGNATURE", "%s" % signature)
-        return request
+        headers["X_PLIVO_SIGNATURE"] = "%s" % signature
+        return request_uri, body, headers
+
+    def _open(self, uri, body, headers, method):
+        """Sends request on a pooled connection, following redirects
 
-    def fetch_response(self, uri, params={}, method='POST'):
+        Returns the HTTPPooledResponse, raises urllib2.HTTPError
+        if status >= 300
+        """
+        pool = self.pool or get_connection_pool()
+        for i in range(self.MAX_REDIRECTS + 1):
+            response = pool.open(method, uri, body, headers)
+            location = response.msg.get('Location')
+            if not response.status in (301, 302, 303, 307) or not location:
+                break
+            response.read()
+            response.close()
+            # Redirected request is sent as GET, like urllib2 does
+            uri = urlparse.urljoin(uri, location)
+            method, body = 'GET', None
+            headers = dict([ (k, v) for k, v in headers.items()
+                             if k != 'Content-Type' ])
+        if response.status >= 300:
+            response.read()
+            response.close()
+            raise urllib2.HTTPError(uri, response.status, response.reason,
+                                    response.msg, None)
+        return response
+
+    def _send(self, uri, body, headers, method):
+        """Returns (headers, body) of response, see _open
+        """
+        response = self._open(uri, body, headers, method)
+        try:
+            return response.msg, response.read()
+        finally:
+            response.close()
+
+    def _add_query_params(self, uri, params, method):
         if not method in ('GET', 'POST'):
             raise NotImplementedError('HTTP %s method not implemented' \
                                                             % method)
@@ -168,7 +610,41 @@ class HTTPRequest:
             except ValueError:
                 pass
 
-        request = self._prepare_http_request(uri, params, method)
-        response = urllib2.urlopen(request).read()
-        return response
+    def open_response(self, uri, params={}, method='POST'):
+        """Opens uri and returns response, to read body as it arrives.
 
+        Response must be closed once read.
+        """
+        self._add_query_params(uri, params, method)
+        request_uri, body, headers = self._prepare_http_request(uri, params,
+                                                                method)
+        return self._open(request_uri, body, headers, method)
+
+    def fetch_response(self, uri, params={}, method='POST', cache=None):
+        """Fetches uri and returns response body.
+
+        cache: HTTPResponseCache for responses (optional)
+        """
+        self._add_query_params(uri, params, method)
+        request_uri, body, headers = self._prepare_http_request(uri, params,
+                                                                method)
+        if cache is None:
+            return self._send(request_uri, body, headers, method)[1]
+
+        key = cache.get_key(method, uri, params)
+        entry = cache.get(key)
+        if entry and entry.is_fresh():
+            return entry.body
+        if entry and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        try:
+            response_headers, data = self._send(request_uri, body, headers,
+                                                method)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or not entry:
+                raise
+            # Not modified, cached response is still valid
+            cache.revalidate(key, entry, e.info())
+            return entry.body
+        cache.put(key, data, response_headers)
+        return data
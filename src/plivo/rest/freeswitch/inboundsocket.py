@@ -4,15 +4,32 @@
 from gevent import monkey
 monkey.patch_all()
 
-from gevent import spawn
 from gevent import pool
 
 from plivo.core.freeswitch.inboundsocket import InboundEventSocket
+from plivo.core.freeswitch.scheduler import DispatchScheduler, HIGH, LOW
+from plivo.core.errors import ConnectError
 from plivo.rest.freeswitch.helpers import HTTPRequest
+from plivo.rest.freeswitch.webhooks import WebhookDispatcher
 
 
 EVENT_FILTER = "BACKGROUND_JOB CHANNEL_PROGRESS CHANNEL_PROGRESS_MEDIA CHANNEL_HANGUP CHANNEL_STATE"
 
+# Calls with a job or hangup event are handled before other calls,
+# events of a same call are always handled in order
+EVENT_PRIORITIES = {'BACKGROUND_JOB': HIGH,
+                    'CHANNEL_HANGUP': HIGH,
+                    'CHANNEL_STATE': LOW,
+                   }
+# Max queued events, next ones are dropped
+EVENT_LIMITS = {'CHANNEL_STATE': 20000}
+# Channel states used by transfers, never dropped
+KEEP_STATES = ('CS_RESET', 'CS_HANGUP')
+# Only the first progress event of a call is used,
+# so queued progress events for a same call are merged
+EVENT_COALESCE = ('CHANNEL_PROGRESS', 'CHANNEL_PROGRESS_MEDIA')
+DISPATCH_SIZE = 500
+
 
 class RESTInboundSocket(InboundEventSocket):
     """
@@ -21,8 +38,14 @@ class RESTInboundSocket(InboundEventSocket):
     def __init__(self, host, port, password,
                  outbound_address='',
                  auth_id='', auth_token='',
-                 log=None, default_http_method='POST'):
-        InboundEventSocket.__init__(self, host, port, password, filter=EVENT_FILTER)
+                 log=None, default_http_method='POST',
+                 command_pool=None, webhooks=None):
+        scheduler = DispatchScheduler(DISPATCH_SIZE, priorities=EVENT_PRIORITIES,
+                                      limits=EVENT_LIMITS, coalesce=EVENT_COALESCE,
+                                      key=self.get_event_key,
+                                      keep=self.is_kept_event)
+        InboundEventSocket.__init__(self, host, port, password, filter=EVENT_FILTER,
+                                    scheduler=scheduler)
         self.fs_outbound_address = outbound_address
         self.log = log
         self.auth_id = auth_id
@@ -34,6 +57,49 @@ class RESTInboundSocket(InboundEventSocket):
         # Call Requests
         self.call_requests = {}
         self.default_http_method = default_http_method
+        # Pool of sockets to send api/bgapi commands (optional)
+        self.command_pool = command_pool
+        # Ring and hangup notifications are sent in background
+        if webhooks is None:
+            webhooks = WebhookDispatcher(auth_id, auth_token, log=log)
+        self.webhooks = webhooks
+
+    def get_event_key(self, ev):
+        """
+        Events of a same call request (or of a same channel
+        if not from a call request) are handled in order
+        """
+        if ev['Event-Name'] == 'BACKGROUND_JOB':
+            return self.bk_jobs.get(ev['Job-UUID'])
+        return ev['variable_plivo_request_uuid'] or ev['Unique-ID']
+
+    def is_kept_event(self, ev):
+        return ev['Event-Name'] == 'CHANNEL_STATE' \
+                and ev['Channel-State'] in KEEP_STATES
+
+    def api(self, args):
+        """
+        Sends api command through command pool if any.
+        Falls back to this socket if no pool socket is connected.
+        """
+        if self.command_pool:
+            try:
+                return self.command_pool.api(args)
+            except ConnectError:
+                pass
+        return InboundEventSocket.api(self, args)
+
+    def bgapi(self, args):
+        """
+        Sends bgapi command through command pool if any.
+        Falls back to this socket if no pool socket is connected.
+        """
+        if self.command_pool:
+            try:
+                return self.command_pool.bgapi(args)
+            except ConnectError:
+                pass
+        return InboundEventSocket.bgapi(self, args)
 
     def on_background_job(self, ev):
         """
@@ -113,7 +179,7 @@ class RESTInboundSocket(InboundEventSocket):
                             'CallStatus': 'ringing',
                             'From': caller_num
                         }
-                    spawn(self.send_to_url, ring_url, params)
+                    self.webhooks.send(ring_url, params, self.default_http_method)
 
     def on_channel_progress_media(self, ev):
         request_uuid = ev['variable_plivo_request_uuid']
@@ -145,7 +211,7 @@ class RESTInboundSocket(InboundEventSocket):
                             'CallStatus': 'ringing',
                             'From': caller_num
                         }
-                    spawn(self.send_to_url, ring_url, params)
+                    self.webhooks.send(ring_url, params, self.default_http_method)
 
     def on_channel_hangup(self, ev):
         """
@@ -219,7 +285,7 @@ class RESTInboundSocket(InboundEventSocket):
                     'CallStatus': 'completed',
                     'From': caller_num
                 }
-            spawn(self.send_to_url, hangup_url, params)
+            self.webhooks.send(hangup_url, params, self.default_http_method)
         else:
             self.log.debug("No hangupUrl for RequestUUID %s" % request_uuid)
 
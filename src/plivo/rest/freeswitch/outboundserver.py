@@ -17,8 +17,11 @@ import gevent
 from plivo.core.freeswitch import multiprocserver
 from plivo.core.freeswitch import multithreadserver
 from plivo.core.freeswitch import outboundsocket
-from plivo.rest.freeswitch.outboundsocket import PlivoOutboundEventSocket
+from plivo.core.freeswitch import preforkserver
+from plivo.rest.freeswitch.outboundsocket import PlivoOutboundEventSocket, \
+                                                 ParsedXMLCache
 from plivo.rest.freeswitch import helpers
+from plivo.rest.freeswitch.audiocache import AudioCache
 import plivo.utils.daemonize
 from plivo.utils.logger import StdoutLogger, FileLogger, SysLogger
 
@@ -31,6 +34,79 @@ This server is listening by default on 127.0.0.1:8084
 """
 
 
+def get_xml_cache(config):
+    """Creates RESTXML cache from config, returns None if disabled
+    """
+    try:
+        size = int(helpers.get_conf_value(config, 'freeswitch', 'XML_CACHE_SIZE'))
+    except ValueError:
+        size = 0
+    if size <= 0:
+        return None
+    try:
+        ttl = int(helpers.get_conf_value(config, 'freeswitch', 'XML_CACHE_TTL'))
+    except ValueError:
+        ttl = 0
+    params = helpers.get_conf_value(config, 'freeswitch', 'XML_CACHE_PARAMS')
+    params = [ p.strip() for p in params.split(',') if p.strip() ]
+    return helpers.HTTPResponseCache(size, ttl, params)
+
+
+def get_parsed_xml_cache(config):
+    """Creates parsed RESTXML cache from config, returns None if disabled
+    """
+    try:
+        size = int(helpers.get_conf_value(config, 'freeswitch', 'PARSED_XML_CACHE_SIZE'))
+    except ValueError:
+        size = 0
+    if size <= 0:
+        return None
+    return ParsedXMLCache(size)
+
+
+def get_audio_cache(config):
+    """Creates remote audio cache from config, returns None if disabled
+    """
+    directory = helpers.get_conf_value(config, 'freeswitch', 'AUDIO_CACHE_DIR')
+    if not directory:
+        return None
+    try:
+        max_size = int(helpers.get_conf_value(config, 'freeswitch', 'AUDIO_CACHE_SIZE'))
+    except ValueError:
+        max_size = 100
+    try:
+        ttl = int(helpers.get_conf_value(config, 'freeswitch', 'AUDIO_CACHE_TTL'))
+    except ValueError:
+        ttl = 300
+    return AudioCache(directory, max_size * 1024 * 1024, ttl=ttl)
+
+
+def get_admission_config(config):
+    """Returns admission control params of outbound servers from config
+    """
+    try:
+        max_sessions = int(helpers.get_conf_value(config,
+                                'freeswitch', 'FS_OUTBOUND_MAX_SESSIONS'))
+    except ValueError:
+        max_sessions = 0
+    try:
+        rate = float(helpers.get_conf_value(config,
+                                'freeswitch', 'FS_OUTBOUND_RATE'))
+    except ValueError:
+        rate = 0
+    try:
+        burst = int(helpers.get_conf_value(config,
+                                'freeswitch', 'FS_OUTBOUND_BURST'))
+    except ValueError:
+        burst = 0
+    overload = helpers.get_conf_value(config,
+                                'freeswitch', 'FS_OUTBOUND_OVERLOAD')
+    if not overload in outboundsocket.OVERLOAD_POLICIES:
+        overload = outboundsocket.OVERLOAD_CLOSE
+    return {'max_sessions': max_sessions, 'rate': rate, 'burst': burst,
+            'overload': overload}
+
+
 class PlivoOutboundServer(object):
     def __init__(self, configfile, daemon=False,
                     pidfile='/tmp/plivo_outbound.pid'):
@@ -44,6 +120,9 @@ class PlivoOutboundServer(object):
         elif self._handler_mode == 'process':
             self.server = PlivoProcessOutboundServer(self._config,
                                         daemon, pidfile)
+        elif self._handler_mode == 'prefork':
+            self.server = PlivoPreforkOutboundServer(self._config,
+                                        daemon, pidfile)
         else:
             self.server = PlivoSpawnOutboundServer(self._config,
                                         daemon, pidfile)
@@ -86,28 +165,70 @@ class PlivoProcessOutboundServer(multiprocserver.OutboundServer):
                                         'rest_server', 'DEFAULT_HTTP_METHOD')
         if not self.default_http_method in ('GET', 'POST'):
             self.default_http_method = 'POST'
+        self.xml_cache = get_xml_cache(self._config)
+        self.parsed_xml_cache = get_parsed_xml_cache(self._config)
+        self.audio_cache = get_audio_cache(self._config)
+        self.xml_streaming = helpers.get_conf_value(self._config,
+                                    'freeswitch', 'XML_STREAMING') == 'true'
+        helpers.set_connection_pool(
+            helpers.get_connection_pool_from_config(self._config, 'freeswitch'))
+        helpers.set_url_checker(
+            helpers.get_url_checker_from_config(self._config, 'freeswitch'))
 
         # This is where we define the connection with the
         # Plivo XML element Processor
+        try:
+            pool_size = int(helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_PROCESS_POOL'))
+        except ValueError:
+            pool_size = 0
+        try:
+            max_calls = int(helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_MAX_CALLS'))
+        except ValueError:
+            max_calls = 0
+        try:
+            pool_max = int(helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_PROCESS_POOL_MAX'))
+        except ValueError:
+            pool_max = 0
+        overload = helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_OVERLOAD')
+        if not overload in outboundsocket.OVERLOAD_POLICIES:
+            overload = outboundsocket.OVERLOAD_CLOSE
         multiprocserver.OutboundServer.__init__(self, (fs_host, fs_port),
-                            PlivoOutboundEventSocket, filter=None)
+                            PlivoOutboundEventSocket, filter=None,
+                            pool_size=pool_size, max_calls=max_calls,
+                            pool_max=pool_max, overload=overload)
 
     def _get_request_id(self):
-        self._request_id = os.getpid()
-        return self._request_id
+        # Worker processes handle many calls, pid makes ids unique
+        try:
+            self._request_id += 1
+        except OverflowError:
+            self._request_id = 1
+        return '%d-%d' % (os.getpid(), self._request_id)
+
+    def on_reject(self, address, reason):
+        self.log.warn("Overloaded (%s), rejecting (%s) request from %s -- %s"
+                      % (reason, self.overload, str(address), self.get_stats()))
 
     def do_handle(self, socket, address):
         request_id = self._get_request_id()
-        self.log.info("(%d) New request from %s" % (request_id, str(address)))
+        self.log.info("(%s) New request from %s" % (request_id, str(address)))
         self._handle_class(socket, address, self.log,
                            default_answer_url=self.default_answer_url,
                            default_hangup_url=self.default_hangup_url,
                            default_http_method = self.default_http_method,
                            auth_id=self.auth_id,
                            auth_token=self.auth_token,
-                           request_id=request_id
+                           request_id=request_id,
+                           xml_cache=self.xml_cache,
+                           parsed_xml_cache=self.parsed_xml_cache,
+                           audio_cache=self.audio_cache,
+                           xml_streaming=self.xml_streaming
                            )
-        self.log.info("(%d) End request from %s" % (request_id, str(address)))
+        self.log.info("(%s) End request from %s" % (request_id, str(address)))
 
     def create_logger(self):
         if self._daemon is False:
@@ -160,7 +281,10 @@ class PlivoProcessOutboundServer(multiprocserver.OutboundServer):
         self.kill()
 
     def start(self):
-        msg = "with processes"
+        if self.pool_size > 0:
+            msg = "with a pool of %d processes" % self.pool_size
+        else:
+            msg = "with processes"
         self.log.info("Starting OutboundServer (%s) ..." \
                         % msg)
         # catch SIG_TERM
@@ -205,11 +329,37 @@ class PlivoThreadOutboundServer(multithreadserver.OutboundServer):
                                         'rest_server', 'DEFAULT_HTTP_METHOD')
         if not self.default_http_method in ('GET', 'POST'):
             self.default_http_method = 'POST'
+        self.xml_cache = get_xml_cache(self._config)
+        self.parsed_xml_cache = get_parsed_xml_cache(self._config)
+        self.audio_cache = get_audio_cache(self._config)
+        self.xml_streaming = helpers.get_conf_value(self._config,
+                                    'freeswitch', 'XML_STREAMING') == 'true'
+        helpers.set_connection_pool(
+            helpers.get_connection_pool_from_config(self._config, 'freeswitch'))
+        helpers.set_url_checker(
+            helpers.get_url_checker_from_config(self._config, 'freeswitch'))
+
+        try:
+            pool_size = int(helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_THREADS'))
+        except ValueError:
+            pool_size = 0
+        try:
+            queue_size = int(helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_QUEUE_SIZE'))
+        except ValueError:
+            queue_size = 0
+        overload = helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_OVERLOAD')
+        if not overload in outboundsocket.OVERLOAD_POLICIES:
+            overload = outboundsocket.OVERLOAD_CLOSE
 
         # This is where we define the connection with the
         # Plivo XML element Processor
         multithreadserver.OutboundServer.__init__(self, (fs_host, fs_port),
-                                PlivoOutboundEventSocket, filter=None)
+                                PlivoOutboundEventSocket, filter=None,
+                                pool_size=pool_size, queue_size=queue_size,
+                                overload=overload)
 
     def _get_request_id(self):
         try:
@@ -227,10 +377,18 @@ class PlivoThreadOutboundServer(multithreadserver.OutboundServer):
                            default_http_method = self.default_http_method,
                            auth_id=self.auth_id,
                            auth_token=self.auth_token,
-                           request_id=request_id
+                           request_id=request_id,
+                           xml_cache=self.xml_cache,
+                           parsed_xml_cache=self.parsed_xml_cache,
+                           audio_cache=self.audio_cache,
+                           xml_streaming=self.xml_streaming
                            )
         self.log.info("(%d) End request from %s" % (request_id, str(address)))
 
+    def on_reject(self, address, reason):
+        self.log.warn("Overloaded (%s), rejecting (%s) request from %s -- %s"
+                      % (reason, self.overload, str(address), self.get_stats()))
+
     def create_logger(self):
         if self._daemon is False:
             self.log = StdoutLogger()
@@ -282,7 +440,10 @@ class PlivoThreadOutboundServer(multithreadserver.OutboundServer):
         self.kill()
 
     def start(self):
-        msg = "with threads"
+        if self.pool_size > 0:
+            msg = "with a pool of %d threads" % self.pool_size
+        else:
+            msg = "with threads"
         self.log.info("Starting OutboundServer (%s) ..." \
                         % msg)
         # catch SIG_TERM
@@ -328,11 +489,21 @@ class PlivoSpawnOutboundServer(outboundsocket.OutboundServer):
                                         'rest_server', 'DEFAULT_HTTP_METHOD')
         if not self.default_http_method in ('GET', 'POST'):
             self.default_http_method = 'POST'
+        self.xml_cache = get_xml_cache(self._config)
+        self.parsed_xml_cache = get_parsed_xml_cache(self._config)
+        self.audio_cache = get_audio_cache(self._config)
+        self.xml_streaming = helpers.get_conf_value(self._config,
+                                    'freeswitch', 'XML_STREAMING') == 'true'
+        helpers.set_connection_pool(
+            helpers.get_connection_pool_from_config(self._config, 'freeswitch'))
+        helpers.set_url_checker(
+            helpers.get_url_checker_from_config(self._config, 'freeswitch'))
 
         # This is where we define the connection with the
         # Plivo XML element Processor
         outboundsocket.OutboundServer.__init__(self, (fs_host, fs_port),
-                                PlivoOutboundEventSocket, filter=None)
+                                PlivoOutboundEventSocket, filter=None,
+                                **get_admission_config(self._config))
 
     def _get_request_id(self):
         try:
@@ -341,7 +512,7 @@ class PlivoSpawnOutboundServer(outboundsocket.OutboundServer):
             self._request_id = 1
         return self._request_id
 
-    def do_handle(self, socket, address):
+    def handle_call(self, socket, address):
         request_id = self._get_request_id()
         self.log.info("(%d) New request from %s" % (request_id, str(address)))
         self._handle_class(socket, address, self.log,
@@ -350,10 +521,18 @@ class PlivoSpawnOutboundServer(outboundsocket.OutboundServer):
                            default_http_method = self.default_http_method,
                            auth_id=self.auth_id,
                            auth_token=self.auth_token,
-                           request_id=request_id
+                           request_id=request_id,
+                           xml_cache=self.xml_cache,
+                           parsed_xml_cache=self.parsed_xml_cache,
+                           audio_cache=self.audio_cache,
+                           xml_streaming=self.xml_streaming
                            )
         self.log.info("(%d) End request from %s" % (request_id, str(address)))
 
+    def on_reject(self, address, reason):
+        self.log.warn("Overloaded (%s), rejecting (%s) request from %s -- %s"
+                      % (reason, self.overload, str(address), self.get_stats()))
+
     def create_logger(self):
         if self._daemon is False:
             self.log = StdoutLogger()
@@ -403,6 +582,7 @@ class PlivoSpawnOutboundServer(outboundsocket.OutboundServer):
     def stop(self):
         self._run = False
         self.kill()
+        self.log.info("OutboundServer stats %s" % self.get_stats())
 
     def start(self):
         msg = "with spawns"
@@ -421,6 +601,162 @@ class PlivoSpawnOutboundServer(outboundsocket.OutboundServer):
         self.log.info("OutboundServer Exited")
 
 
+class PlivoPreforkOutboundServer(preforkserver.OutboundServer):
+    def __init__(self, config, daemon=False,
+                            pidfile='/tmp/plivo_outbound.pid'):
+        self._request_id = 0
+        self._daemon = daemon
+        self._run = False
+        self._pidfile = pidfile
+        # load config
+        self._config = config
+        # create logger
+        self.create_logger()
+        # create outbound server
+        self.fs_outbound_address = helpers.get_conf_value(self._config,
+                                        'freeswitch', 'FS_OUTBOUND_ADDRESS')
+        fs_host, fs_port = self.fs_outbound_address.split(':', 1)
+        fs_port = int(fs_port)
+        self.default_answer_url = helpers.get_conf_value(self._config,
+                                        'freeswitch', 'DEFAULT_ANSWER_URL')
+        self.auth_id = helpers.get_conf_value(self._config,
+                                        'rest_server', 'AUTH_ID')
+        self.auth_token = helpers.get_conf_value(self._config,
+                                        'rest_server', 'AUTH_TOKEN')
+        self.default_hangup_url = helpers.get_conf_value(self._config,
+                                        'freeswitch', 'DEFAULT_HANGUP_URL')
+        self.default_http_method = helpers.get_conf_value(self._config,
+                                        'rest_server', 'DEFAULT_HTTP_METHOD')
+        if not self.default_http_method in ('GET', 'POST'):
+            self.default_http_method = 'POST'
+        self.xml_cache = get_xml_cache(self._config)
+        self.parsed_xml_cache = get_parsed_xml_cache(self._config)
+        self.audio_cache = get_audio_cache(self._config)
+        self.xml_streaming = helpers.get_conf_value(self._config,
+                                    'freeswitch', 'XML_STREAMING') == 'true'
+        helpers.set_connection_pool(
+            helpers.get_connection_pool_from_config(self._config, 'freeswitch'))
+        helpers.set_url_checker(
+            helpers.get_url_checker_from_config(self._config, 'freeswitch'))
+
+        # This is where we define the connection with the
+        # Plivo XML element Processor
+        try:
+            workers = int(helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_WORKERS'))
+        except ValueError:
+            workers = 0
+        try:
+            drain_timeout = int(helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_DRAIN_TIMEOUT'))
+        except ValueError:
+            drain_timeout = 30
+        preforkserver.OutboundServer.__init__(self, (fs_host, fs_port),
+                                PlivoOutboundEventSocket, filter=None,
+                                workers=workers, drain_timeout=drain_timeout,
+                                **get_admission_config(self._config))
+
+    def _get_request_id(self):
+        # Worker processes handle many calls, pid makes ids unique
+        try:
+            self._request_id += 1
+        except OverflowError:
+            self._request_id = 1
+        return '%d-%d' % (os.getpid(), self._request_id)
+
+    def do_handle(self, socket, address):
+        request_id = self._get_request_id()
+        self.log.info("(%s) New request from %s" % (request_id, str(address)))
+        self._handle_class(socket, address, self.log,
+                           default_answer_url=self.default_answer_url,
+                           default_hangup_url=self.default_hangup_url,
+                           default_http_method = self.default_http_method,
+                           auth_id=self.auth_id,
+                           auth_token=self.auth_token,
+                           request_id=request_id,
+                           xml_cache=self.xml_cache,
+                           parsed_xml_cache=self.parsed_xml_cache,
+                           audio_cache=self.audio_cache,
+                           xml_streaming=self.xml_streaming
+                           )
+        self.log.info("(%s) End request from %s" % (request_id, str(address)))
+
+    def on_reject(self, address, reason):
+        self.log.warn("Overloaded (%s), rejecting (%s) request from %s -- %s"
+                      % (reason, self.overload, str(address), self.get_stats()))
+
+    def on_worker_exit(self, index, process):
+        self.log.error("Worker %d (pid %s) exited with code %s, respawning" \
+                        % (index, process.pid, process.exitcode))
+
+    def create_logger(self):
+        if self._daemon is False:
+            self.log = StdoutLogger()
+            self.log.set_debug()
+        else:
+            logtype = helpers.get_conf_value(self._config,
+                                                'freeswitch', 'LOG_TYPE')
+            if logtype == 'file':
+                logfile = helpers.get_conf_value(self._config,
+                                                'freeswitch', 'LOG_FILE')
+                self.log = FileLogger(logfile)
+            elif logtype == 'syslog':
+                syslogaddress = helpers.get_conf_value(self._config,
+                                            'freeswitch', 'SYSLOG_ADDRESS')
+                syslogfacility = helpers.get_conf_value(self._config,
+                                            'freeswitch', 'SYSLOG_FACILITY')
+                self.log = SysLogger(syslogaddress, syslogfacility)
+            else:
+                self.log = StdoutLogger()
+            debug_mode = helpers.get_conf_value(self._config,
+                                                'freeswitch', 'DEBUG')
+            if debug_mode == 'true':
+                self.log.set_debug()
+            else:
+                self.log.set_info()
+
+    def do_daemon(self):
+        # get user/group from config
+        user = helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_USER')
+        group = helpers.get_conf_value(self._config,
+                                    'freeswitch', 'FS_OUTBOUND_GROUP')
+        if not user or not group:
+            uid = os.getuid()
+            user = pwd.getpwuid(uid)[0]
+            gid = os.getgid()
+            group = grp.getgrgid(gid)[0]
+        # daemonize now
+        plivo.utils.daemonize.daemon(user, group, path='/',
+                                    pidfile=self._pidfile, other_groups=())
+
+    def sig_term(self, *args):
+        self.stop()
+        self.log.warn("Shutdown ...")
+        sys.exit(0)
+
+    def stop(self):
+        self._run = False
+        self.kill()
+
+    def start(self):
+        msg = "with %d prefork workers" % self.workers
+        self.log.info("Starting OutboundServer (%s) ..." \
+                        % msg)
+        # catch SIG_TERM
+        gevent.signal(signal.SIGTERM, self.sig_term)
+        # run
+        self._run = True
+        if self._daemon:
+            self.do_daemon()
+        super(PlivoPreforkOutboundServer, self).start()
+        self.log.info("OutboundServer started at '%s' (%s)" \
+                        % (str(self.fs_outbound_address),
+                           self.reuseport and "SO_REUSEPORT" or "shared socket"))
+        self.loop()
+        self.log.info("OutboundServer Exited")
+
+
 if __name__ == '__main__':
     outboundserver = PlivoOutboundServer(
                                 configfile='./etc/plivo/default.conf',
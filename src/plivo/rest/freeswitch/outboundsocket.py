@@ -4,6 +4,10 @@
 from gevent import monkey
 monkey.patch_all()
 
+from collections import OrderedDict
+from cStringIO import StringIO
+from hashlib import sha1
+import sys
 import traceback
 try:
     import xml.etree.cElementTree as etree
@@ -11,6 +15,7 @@ except ImportError:
     from xml.etree.elementtree import ElementTree as etree
 
 import gevent
+import gevent.coros
 import gevent.queue
 
 from plivo.core.freeswitch.eventtypes import Event
@@ -25,11 +30,100 @@ from plivo.rest.freeswitch.exceptions import RESTFormatException, \
 
 
 MAX_REDIRECT = 1000
+# Max elements prepared at the same time
+PREPARE_POOL_SIZE = 10
 EVENT_FILTER = "CHANNEL_EXECUTE_COMPLETE CHANNEL_HANGUP CUSTOM conference::maintenance"
 
 
 
 
+# Max bytes fed at once to the RESTXML parser
+XML_READ_SIZE = 16384
+
+
+class XMLEventTarget(object):
+    """
+    XMLParser target building the tree, and recording
+    ('start', element) and ('end', element) events
+    """
+    def __init__(self):
+        self.builder = etree.TreeBuilder()
+        self.events = []
+
+    def start(self, tag, attrib):
+        self.events.append(('start', self.builder.start(tag, attrib)))
+
+    def end(self, tag):
+        self.events.append(('end', self.builder.end(tag)))
+
+    def data(self, data):
+        self.builder.data(data)
+
+    def close(self):
+        return self.builder.close()
+
+
+def read_available(source, size):
+    """
+    Reads up to size bytes from file-like source, returns as soon as
+    some data is available if source has a read_available method
+    ('' at end of source)
+    """
+    try:
+        read = source.read_available
+    except AttributeError:
+        read = source.read
+    return read(size)
+
+
+def iter_xml(source):
+    """
+    Validates RESTXML read from file-like source,
+    yields each top level element as soon as it is complete
+    """
+    depth = 0
+    root = None
+    target = XMLEventTarget()
+    parser = etree.XMLParser(target=target)
+    started = False
+    while True:
+        data = read_available(source, XML_READ_SIZE)
+        try:
+            if not data:
+                parser.close()
+            elif started:
+                parser.feed(data)
+            else:
+                # Skips whitespace before the document
+                started = bool(data.strip())
+                if started:
+                    parser.feed(data.lstrip())
+        except SyntaxError, e:
+            raise RESTSyntaxException("Invalid RESTXML Response Syntax: %s" \
+                        % str(e))
+        events, target.events = target.events, []
+        for event, element in events:
+            if event == 'start':
+                depth += 1
+                # Make sure the document has a <Response> root
+                if depth == 1:
+                    if element.tag != "Response":
+                        raise RESTFormatException("No Response Tag Present")
+                    root = element
+                # Make sure we recognize all the Element in the xml
+                elif depth == 2 and not hasattr(elements, element.tag):
+                    raise UnrecognizedElementException("Unrecognized Element: %s"
+                                                            % [element.tag])
+            else:
+                depth -= 1
+                if depth == 1:
+                    yield element
+                    # Element is parsed, free it
+                    root.remove(element)
+        if not data:
+            return
+
+
 class RequestLogger(object):
     """
     Class RequestLogger
@@ -58,6 +152,55 @@ class RequestLogger(object):
 
 
 
+class ParsedXMLCache(object):
+    """
+    Class ParsedXMLCache
+
+    LRU cache of parsed and validated RESTXML elements, keyed by a hash
+    of the url and the RESTXML document.
+    Cached elements are never executed, each call gets copies.
+    """
+    def __init__(self, size=100):
+        self.size = size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, url, xml):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        return sha1('%s\n%s' % (url, xml)).digest()
+
+    def get(self, key):
+        """Gets copies of parsed elements, or None if not cached
+        """
+        parsed_element = self._entries.pop(key, None)
+        if parsed_element is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Most recently used goes last
+        self._entries[key] = parsed_element
+        return [ element.copy() for element in parsed_element ]
+
+    def put(self, key, parsed_element):
+        """Caches copies of parsed elements, before any execution
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = [ element.copy() for element in parsed_element ]
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def get_stats(self):
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+               }
+
+
+
 class PlivoOutboundEventSocket(OutboundEventSocket):
     """Class PlivoOutboundEventSocket
 
@@ -87,7 +230,11 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
                  default_http_method='POST',
                  auth_id='',
                  auth_token='',
-                 request_id=0):
+                 request_id=0,
+                 xml_cache=None,
+                 parsed_xml_cache=None,
+                 audio_cache=None,
+                 xml_streaming=False):
         # the request id
         self._request_id = request_id
         # set logger
@@ -115,12 +262,25 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
             self.default_hangup_url = self.default_answer_url
         # set default http method POST or GET
         self.default_http_method = default_http_method
+        # set RESTXML cache (optional)
+        self.xml_cache = xml_cache
+        # set parsed RESTXML cache (optional)
+        self.parsed_xml_cache = parsed_xml_cache
+        # set remote audio cache (optional)
+        self.audio_cache = audio_cache
+        # execute RESTXML while it is received (only without caches)
+        self.xml_streaming = xml_streaming
         # set answered flag
         self.answered = False
         # inherits from outboundsocket
         OutboundEventSocket.__init__(self, socket, address, filter=EVENT_FILTER, 
                                      eventjson=True, pool_size=0)
 
+    def connect(self):
+        super(PlivoOutboundEventSocket, self).connect()
+        # Only dispatch events for this channel
+        self.set_unique_id_filter(self.get_channel_unique_id())
+
     def _protocol_send(self, command, args=''):
         """Access parent method _protocol_send
         """
@@ -157,8 +317,6 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
     # method will put that event in the queue, then we may continue working.
     # However, other events will still come, like for instance, DTMF.
     def on_channel_execute_complete(self, event):
-        if not event['Unique-ID'] == self.get_channel_unique_id():
-            return
         if event['Application'] in self.WAIT_FOR_ACTIONS:
             # If transfer has begun, put empty event to break current action
             if event['variable_plivo_transfer_progress'] == 'true':
@@ -167,8 +325,6 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
                 self._action_queue.put(event)
 
     def on_channel_hangup(self, event):
-        if not event['Unique-ID'] == self.get_channel_unique_id():
-            return
         self._hangup_cause = event['Hangup-Cause']
         self.log.info('Event: channel %s has hung up (%s)' %
                       (self.get_channel_unique_id(), self._hangup_cause))
@@ -186,11 +342,9 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
         # Prevent command to be stuck while waiting response
         self._action_queue.put_nowait(Event())
 
-    def on_custom(self, event):
+    def on_custom_conference_maintenance(self, event):
         # special case to get Member-ID for conference
-        if event['Event-Subclass'] == 'conference::maintenance' \
-            and event['Action'] == 'add-member' \
-            and event['Unique-ID'] == self.get_channel_unique_id():
+        if event['Action'] == 'add-member':
             self._action_queue.put(event)
 
     def has_hangup(self):
@@ -330,13 +484,23 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
             try:
                 if self.has_hangup():
                     raise RESTHangup()
-                self.fetch_xml(params=params)
-                if not self.xml_response:
-                    self.log.warn("No XML Response")
-                    return
-                self.lex_xml()
-                self.parse_xml()
-                self.execute_xml()
+                if self.xml_streaming and not self.xml_cache \
+                                      and not self.parsed_xml_cache:
+                    response = self.open_xml(params=params)
+                    if not response:
+                        self.log.warn("No XML Response")
+                        return
+                    try:
+                        self.execute_xml(self.stream_parse_xml(response))
+                    finally:
+                        response.close()
+                else:
+                    self.fetch_xml(params=params)
+                    if not self.xml_response:
+                        self.log.warn("No XML Response")
+                        return
+                    self.lex_and_parse_xml()
+                    self.execute_xml()
                 self.log.info("End of RESTXML")
                 return
             except RESTRedirectException, redirect:
@@ -368,13 +532,37 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
         """
         self.log.info("Fetching RESTXML from %s with %s" \
                                 % (self.target_url, params))
-        self.xml_response = self.send_to_url(self.target_url, params, method)
+        self.xml_response = self.send_to_url(self.target_url, params, method,
+                                             cache=self.xml_cache)
         self.log.info("Requested RESTXML to %s with %s" \
                                 % (self.target_url, params))
+        if self.xml_cache:
+            self.log.debug("RESTXML cache %s" % self.xml_cache.get_stats())
+
+    def open_xml(self, params={}, method=None):
+        """
+        This method will request the xml from the target url,
+        and returns the response to read the xml as it arrives,
+        or None on error
+        """
+        if method is None:
+            method = self.default_http_method
+        self.log.info("Fetching RESTXML from %s with %s" \
+                                % (self.target_url, params))
+        params.update(self.session_params)
+        http_obj = HTTPRequest(self.auth_id, self.auth_token)
+        try:
+            return http_obj.open_response(self.target_url, params, method)
+        except Exception, e:
+            self.log.error("Sending to %s %s with %s -- Error: %s" \
+                                % (method, self.target_url, params, e))
+        return None
 
-    def send_to_url(self, url=None, params={}, method=None):
+    def send_to_url(self, url=None, params={}, method=None, cache=None):
         """
         This method will do an http POST or GET request to the Url
+
+        Response is fetched from cache if cache is set
         """
         if method is None:
             method = self.default_http_method
@@ -385,7 +573,7 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
         params.update(self.session_params)
         http_obj = HTTPRequest(self.auth_id, self.auth_token)
         try:
-            data = http_obj.fetch_response(url, params, method)
+            data = http_obj.fetch_response(url, params, method, cache)
             self.log.info("Sent to %s %s with %s -- Result: %s" \
                                             % (method, url, params, data))
             return data
@@ -394,48 +582,63 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
                                             % (method, url, params, e))
         return None
 
+    def lex_and_parse_xml(self):
+        """
+        Gets parsed elements from cache if any,
+        else validates and parses the XML, then caches parsed elements
+        """
+        if not self.parsed_xml_cache:
+            self.lex_xml()
+            self.parse_xml()
+            return
+        key = self.parsed_xml_cache.get_key(self.target_url, self.xml_response)
+        parsed_element = self.parsed_xml_cache.get(key)
+        if parsed_element is not None:
+            self.parsed_element = parsed_element
+            self.log.debug("Parsed RESTXML from cache %s" \
+                                % self.parsed_xml_cache.get_stats())
+            return
+        self.lex_xml()
+        self.parse_xml()
+        self.parsed_xml_cache.put(key, self.parsed_element)
+
     def lex_xml(self):
         """
         Validate the XML document and make sure we recognize all Element
         """
-        # Parse XML into a doctring
-        xml_str = ' '.join(self.xml_response.split())
-        try:
-            #convert the string into an Element instance
-            doc = etree.fromstring(xml_str)
-        except Exception, e:
-            raise RESTSyntaxException("Invalid RESTXML Response Syntax: %s" \
-                        % str(e))
-
-        # Make sure the document has a <Response> root
-        if doc.tag != "Response":
-            raise RESTFormatException("No Response Tag Present")
-
-        # Make sure we recognize all the Element in the xml
-        for element in doc:
-            invalid_element = []
-            if not hasattr(elements, element.tag):
-                invalid_element.append(element.tag)
-            else:
-                self.lexed_xml_response.append(element)
-            if invalid_element:
-                raise UnrecognizedElementException("Unrecognized Element: %s"
-                                                        % invalid_element)
+        xml = self.xml_response
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        self.lexed_xml_response.extend(iter_xml(StringIO(xml)))
 
     def parse_xml(self):
         """
         This method will parse the XML
         and add the Elements into parsed_element
         """
-        # Check all Elements tag name
         for element in self.lexed_xml_response:
-            element_class = getattr(elements, str(element.tag), None)
-            element_instance = element_class()
-            element_instance.parse_element(element, self.target_url)
-            self.parsed_element.append(element_instance)
-            # Validate, Parse & Store the nested children
-            # inside the main element element
-            self.validate_element(element, element_instance)
+            self.parse_xml_element(element)
+
+    def stream_parse_xml(self, source):
+        """
+        Validates, parses and yields Elements
+        as the XML is read from file-like source
+        """
+        for element in iter_xml(source):
+            yield self.parse_xml_element(element)
+
+    def parse_xml_element(self, element):
+        """
+        Parses a top level element, adds the Element to parsed_element
+        """
+        element_class = getattr(elements, str(element.tag), None)
+        element_instance = element_class()
+        element_instance.parse_element(element, self.target_url)
+        self.parsed_element.append(element_instance)
+        # Validate, Parse & Store the nested children
+        # inside the main element element
+        self.validate_element(element, element_instance)
+        return element_instance
 
     def validate_element(self, element, element_instance):
         children = element.getchildren()
@@ -455,23 +658,88 @@ class PlivoOutboundEventSocket(OutboundEventSocket):
         child_element_instance.parse_element(child_element, None)
         parent_instance.children.append(child_element_instance)
 
-    def execute_xml(self):
-        for element_instance in self.parsed_element:
-            if hasattr(element_instance, 'prepare'):
-                # TODO Prepare element concurrently
-                element_instance.prepare()
-            # Check if it's an inbound call
-            if self.session_params['Direction'] == 'inbound':
-                # Don't answer the call if element is of type no answer
-                # Only execute the element
-                if not self.answered and \
-                    not element_instance.name in self.NO_ANSWER_ELEMENTS:
-                    self.log.debug("Answering because Element %s need it" \
-                        % element_instance.name)
-                    self.answer()
-                    self.answered = True
-            # execute Element
-            element_instance.run(self)
+    def prefetch_audio(self, element_instance):
+        """
+        Starts downloading remote audio of element in background,
+        so it is cached when played
+        """
+        if not self.audio_cache:
+            return
+        for url in element_instance.get_audio_urls():
+            self.audio_cache.prefetch(url)
+
+    def prepare_xml(self, element_instances, queue, jobs):
+        """
+        Starts preparing elements in background, as they are parsed
+
+        Puts each element in queue with its prepare greenlet
+        (None for elements without prepare), then None at the end,
+        or (None, exc_info) on parsing error.
+        Prepare greenlets are added to jobs.
+        """
+        # Greenlets are started as soon as possible, so starting never
+        # blocks, but only PREPARE_POOL_SIZE prepare at the same time, in order.
+        semaphore = gevent.coros.Semaphore(PREPARE_POOL_SIZE)
+        def prepare(element_instance):
+            semaphore.acquire()
+            try:
+                element_instance.prepare(self)
+            finally:
+                semaphore.release()
+        try:
+            for element_instance in element_instances:
+                self.prefetch_audio(element_instance)
+                if hasattr(element_instance, 'prepare'):
+                    job = gevent.spawn(prepare, element_instance)
+                    jobs.append(job)
+                else:
+                    job = None
+                queue.put((element_instance, job))
+        except Exception:
+            queue.put((None, sys.exc_info()))
+        else:
+            queue.put(None)
+
+    def execute_xml(self, element_instances=None):
+        """
+        Executes parsed_element, or Elements from element_instances
+        iterator as soon as each one is parsed
+        """
+        if element_instances is None:
+            element_instances = self.parsed_element
+        queue = gevent.queue.Queue()
+        jobs = []
+        producer = gevent.spawn(self.prepare_xml, element_instances,
+                                queue, jobs)
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                element_instance, job = item
+                if element_instance is None:
+                    # Parsing failed, raise error with its traceback
+                    raise job[0], job[1], job[2]
+                if job:
+                    # Waits until this element is prepared, raises prepare error
+                    job.get()
+                # Check if it's an inbound call
+                if self.session_params['Direction'] == 'inbound':
+                    # Don't answer the call if element is of type no answer
+                    # Only execute the element
+                    if not self.answered and \
+                        not element_instance.name in self.NO_ANSWER_ELEMENTS:
+                        self.log.debug("Answering because Element %s need it" \
+                            % element_instance.name)
+                        self.answer()
+                        self.answered = True
+                # execute Element
+                element_instance.run(self)
+        finally:
+            # Stops parsing and preparing elements not executed
+            # (redirect, hangup, error)
+            producer.kill()
+            gevent.killall(jobs, block=False)
         # If transfer is in progress, don't hangup call
         if not self.has_hangup():
             xfer_progress = self.get_var("plivo_transfer_progress") == 'true'
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+import re
+import urlparse
+
+
+URL_REGEX = re.compile(
+  r'^(?:http|ftp)s?://'  # http:// or https://
+  r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'  # domain
+  r'localhost|'  # localhost
+  r'http://127.0.0.1|'  # 127.0.0.1
+  r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'  # or ip
+  r'(?::\d+)?'  # optional port
+  r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+SCHEME_REGEX = re.compile(r'^(http|https|ftp)://', re.IGNORECASE)
+
+# Number of validation results kept (up to twice as many with previous ones)
+CACHE_SIZE = 1000
+
+
+class ValidatedURL(object):
+    """Url which passed validation.
+
+    url: url as given
+    scheme: lower case scheme, '' if url has no scheme
+    address: url without scheme
+    shout_url: shout:// stream of url, as played by FreeSWITCH
+    """
+    __slots__ = ('url', 'scheme', 'address', 'shout_url')
+
+    def __init__(self, url):
+        self.url = url
+        match = SCHEME_REGEX.match(url)
+        if match:
+            self.scheme = match.group(1).lower()
+            self.address = url[match.end():]
+        else:
+            self.scheme = ''
+            self.address = url
+        self.shout_url = "shout://%s" % self.address
+
+    def __str__(self):
+        return self.url
+
+    def __repr__(self):
+        return '<ValidatedURL %r>' % self.url
+
+
+def check_url(value):
+    """Checks url format, without cache
+    """
+    # If no domain starters we assume its http and add it
+    if not value.startswith('http://') and not value.startswith('https://') \
+        and not value.startswith('ftp://'):
+        value = ''.join(['http://', value])
+
+    if URL_REGEX.search(value):
+        return True
+    # Trivial case failed. Try for possible IDN domain
+    if value:
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(value)
+        try:
+            netloc = netloc.encode('idna')  # IDN -> ACE
+        except UnicodeError:  # invalid domain part
+            return False
+        url = urlparse.urlunsplit((scheme, netloc, path, query, fragment))
+        if URL_REGEX.search(url):
+            return True
+
+    return False
+
+
+# Recent validation results, ValidatedURL or None, by url.
+# When full, current results become previous ones, and previous
+# results used again are moved back to current ones, so recently
+# used results are kept (cheaper than a strict LRU).
+_cache = {}
+_previous = {}
+
+
+def validate_url(value):
+    """Gets ValidatedURL for value, or None if value is not a valid url
+    """
+    global _cache, _previous
+    try:
+        return _cache[value]
+    except KeyError:
+        pass
+    try:
+        result = _previous[value]
+    except KeyError:
+        if check_url(value):
+            result = ValidatedURL(value)
+        else:
+            result = None
+    if len(_cache) >= CACHE_SIZE:
+        _previous, _cache = _cache, {}
+    _cache[value] = result
+    return result
+
+
+def clear_cache():
+    _cache.clear()
+    _previous.clear()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from collections import deque
+import json
+import urllib2
+import urlparse
+
+import gevent
+
+from plivo.rest.freeswitch.helpers import HTTPRequest
+
+
+class WebhookDispatcher(object):
+    """Delivers notifications (ring, hangup, ...) to urls in background.
+
+    Notifications are queued per destination host, and at most
+    max_per_host of them are sent at the same time to a host.
+    Notifications of a same call (same RequestUUID, or CallUUID) to
+    a host go through a same worker, so they are delivered in order.
+    Failed deliveries (connection errors and 5xx responses) are retried
+    with an exponential backoff, next notifications of the worker wait.
+    Notifications for urls in batch_urls are grouped and POSTed
+    together in a Batch param, as a JSON list of params.
+    Notifications are only kept in memory, on exit flush and join
+    deliver them for at most flush_timeout seconds, then they are lost.
+    """
+    def __init__(self, auth_id='', auth_token='', log=None,
+                 max_per_host=10, queue_size=10000,
+                 retries=3, retry_delay=1.0,
+                 batch_urls=(), batch_size=50, batch_interval=1.0,
+                 flush_timeout=10.0):
+        """initialize a object
+
+        max_per_host: max concurrent deliveries per host
+        queue_size: max queued notifications, next ones are dropped
+        retries: max retries of a failed delivery
+        retry_delay: delay in seconds before first retry, doubled each time
+        batch_urls: urls receiving notifications in batch
+        batch_size: max notifications per batch
+        batch_interval: max delay in seconds before sending a batch
+        flush_timeout: max time in seconds join waits for deliveries
+        """
+        self.auth_id = auth_id
+        self.auth_token = auth_token
+        self.log = log
+        self.max_per_host = max_per_host
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.batch_urls = frozenset(batch_urls)
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.flush_timeout = flush_timeout
+        # Queued deliveries and their worker by (host, worker index)
+        self._queues = {}
+        self._workers = {}
+        # Pending batch notifications and flush timers by url
+        self._batches = {}
+        self._timers = {}
+        self._queued = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def send(self, url, params, method='POST'):
+        """Queues a notification, returns False if dropped
+        """
+        if self._queued >= self.queue_size:
+            self.dropped += 1
+            if self.log:
+                self.log.warn("Webhook queue full, dropping %s %s with %s"
+                              % (method, url, params))
+            return False
+        self._queued += 1
+        if url in self.batch_urls:
+            batch = self._batches.setdefault(url, [])
+            batch.append(params)
+            if len(batch) >= self.batch_size:
+                self._flush_batch(url)
+            elif not url in self._timers:
+                self._timers[url] = gevent.spawn_later(self.batch_interval,
+                                                       self._flush_batch, url)
+            return True
+        self._enqueue(url, params, method, 1)
+        return True
+
+    def flush(self):
+        """Queues all pending batches now
+        """
+        for url in self._batches.keys():
+            self._flush_batch(url)
+
+    def join(self, timeout=None):
+        """Waits for queued notifications to be delivered, at most
+        timeout seconds (flush_timeout if None).
+
+        Returns True if all were delivered.
+        """
+        if timeout is None:
+            timeout = self.flush_timeout
+        gevent.joinall(self._workers.values(), timeout=timeout)
+        return not self._queued
+
+    def _flush_batch(self, url):
+        timer = self._timers.pop(url, None)
+        if timer and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+        batch = self._batches.pop(url, None)
+        if batch:
+            self._enqueue(url, {'Batch': json.dumps(batch)}, 'POST',
+                          len(batch))
+
+    def _enqueue(self, url, params, method, count):
+        host = urlparse.urlsplit(url)[1]
+        call = params.get('RequestUUID') or params.get('CallUUID') or url
+        key = (host, hash(call) % self.max_per_host)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._workers[key] = gevent.spawn(self._run, key)
+        queue.append((url, params, method, count))
+
+    def _run(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                url, params, method, count = queue.popleft()
+                self.in_flight += count
+                try:
+                    self._deliver(url, params, method, count)
+                finally:
+                    self.in_flight -= count
+                    self._queued -= count
+        finally:
+            del self._queues[key]
+            del self._workers[key]
+
+    def _deliver(self, url, params, method, count):
+        attempt = 0
+        while True:
+            try:
+                # fetch_response adds query string args to params
+                data = HTTPRequest(self.auth_id, self.auth_token).fetch_response(
+                                                    url, dict(params), method)
+                self.sent += count
+                if self.log:
+                    self.log.info("Sent to %s %s with %s -- Result: %s"
+                                  % (method, url, params, data))
+                return True
+            except Exception, e:
+                if self.log:
+                    self.log.error("Sending to %s %s with %s -- Error: %s"
+                                   % (method, url, params, e))
+                # Client errors are not retried
+                if isinstance(e, urllib2.HTTPError) and e.code < 500:
+                    break
+            if attempt >= self.retries:
+                break
+            gevent.sleep(self.retry_delay * 2 ** attempt)
+            attempt += 1
+            self.retried += 1
+        self.failed += count
+        return False
+
+    def get_queue_size(self):
+        return self._queued
+
+    def _get_host_sizes(self):
+        sizes = {}
+        for (host, index), queue in self._queues.items():
+            sizes[host] = sizes.get(host, 0) + len(queue)
+        return sizes
+
+    def get_stats(self):
+        return {'queued': self._queued,
+                'in_flight': self.in_flight,
+                'hosts': self._get_host_sizes(),
+                'batched': sum([ len(b) for b in self._batches.values() ]),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'dropped': self.dropped,
+               }
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+"""
+Micro-benchmark for Event parsing.
+
+Run from testsuite directory :
+    PYTHONPATH=../src python -m benchmarks.freeswitch.bench_events [events.json]
+
+Json events are read from events.json, one event per line as sent by
+FreeSWITCH with "event json" (default data/channel_hangup.json).
+"""
+
+import os
+import sys
+import time
+from plivo.core.freeswitch.eventtypes import Event, JsonEvent, \
+        UJSON_DECODER, STDLIB_JSON_DECODER, HeaderSubsetDecoder
+
+
+CHANNEL_EVENT = """Event-Name: CHANNEL_HANGUP
+Core-UUID: 12640749-db62-421c-beac-4863eac76510
+FreeSWITCH-Hostname: vocaldev
+FreeSWITCH-IPv4: 10.0.0.108
+Event-Date-Local: 2011-01-04%2010%3A19%3A56
+Event-Date-Timestamp: 1294132796167745
+Unique-ID: 3cf2a8a6-1f14-11e0-9d2e-3b4d9e8e6a51
+Call-Direction: outbound
+Channel-State: CS_HANGUP
+Hangup-Cause: NORMAL_CLEARING
+Caller-Destination-Number: 1000
+Caller-Caller-ID-Number: 0000000000
+"""
+CHANNEL_EVENT += ''.join(["variable_plivo_var_%d: some%%20value%%20%d\n" % (i, i)
+                          for i in range(150)])
+
+# Headers usually read by handlers.
+READ_HEADERS = ('Event-Name', 'Unique-ID', 'Call-Direction', 'Hangup-Cause',
+                'Caller-Destination-Number', 'Caller-Caller-ID-Number',
+                'variable_plivo_request_uuid')
+
+# Headers read to route an event (scheduler, call sessions).
+ROUTING_HEADERS = ('Event-Name', 'Unique-ID')
+
+
+JSON_EVENTS_FILE = os.path.join(os.path.dirname(__file__), 'data',
+                                'channel_hangup.json')
+
+
+def load_json_events(filename):
+    return [ line.strip() for line in open(filename) if line.strip() ]
+
+
+def run(name, lazy, events=20000):
+    start = time.time()
+    for i in xrange(events):
+        ev = Event(CHANNEL_EVENT, lazy=lazy)
+        for header in READ_HEADERS:
+            ev[header]
+    elapsed = time.time() - start
+    print "%-10s %8d events in %.3fs -- %d events/sec" \
+            % (name, events, elapsed, events / elapsed)
+    return events / elapsed
+
+
+def run_json(name, json_events, decoder, headers=READ_HEADERS, events=20000):
+    count = len(json_events)
+    start = time.time()
+    for i in xrange(events):
+        ev = JsonEvent(json_events[i % count], decoder)
+        for header in headers:
+            ev[header]
+    elapsed = time.time() - start
+    print "%-10s %8d events in %.3fs -- %d events/sec" \
+            % (name, events, elapsed, events / elapsed)
+    return events / elapsed
+
+
+def main():
+    before = run('eager', False)
+    after = run('lazy', True)
+    print "speedup x%.2f" % (after / before)
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = JSON_EVENTS_FILE
+    json_events = load_json_events(filename)
+    print "%d json events from %s, %d bytes average" \
+            % (len(json_events), filename,
+               sum(map(len, json_events)) / len(json_events))
+    run_json('stdlib', json_events, STDLIB_JSON_DECODER)
+    before = run_json('ujson', json_events, UJSON_DECODER)
+    after = run_json('subset', json_events, HeaderSubsetDecoder(READ_HEADERS))
+    print "speedup x%.2f" % (after / before)
+    before = run_json('ujson', json_events, UJSON_DECODER, ROUTING_HEADERS)
+    after = run_json('subset', json_events, HeaderSubsetDecoder(ROUTING_HEADERS),
+                     ROUTING_HEADERS)
+    print "speedup x%.2f (routing headers only)" % (after / before)
+    # Reading a header not extracted decodes the whole event
+    before = run_json('ujson', json_events, UJSON_DECODER, ('variable_duration',))
+    after = run_json('subset', json_events, HeaderSubsetDecoder(ROUTING_HEADERS),
+                     ('variable_duration',))
+    print "speedup x%.2f (header not extracted)" % (after / before)
+
+
+if __name__ == '__main__':
+    main()
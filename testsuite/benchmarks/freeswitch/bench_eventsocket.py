@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+"""
+Micro-benchmark for the EventSocket event handler loop.
+
+Run from testsuite directory :
+    PYTHONPATH=../src python -m benchmarks.freeswitch.bench_eventsocket
+"""
+
+import time
+
+import gevent
+import gevent.event
+
+from plivo.core.freeswitch.eventsocket import EventSocket, YieldPolicy
+from plivo.core.freeswitch.eventtypes import Event, ApiResponse
+
+
+EVENT_PLAIN = """Event-Name: HEARTBEAT
+Core-UUID: 12640749-db62-421c-beac-4863eac76510
+FreeSWITCH-Hostname: vocaldev
+FreeSWITCH-IPv4: 10.0.0.108
+FreeSWITCH-IPv6: %3A%3A1
+Event-Date-Local: 2011-01-04%2010%3A19%3A56
+Event-Date-GMT: Tue,%2004%20Jan%202011%2009%3A19%3A56%20GMT
+Event-Date-Timestamp: 1294132796167745
+Event-Calling-File: switch_core.c
+Event-Calling-Function: send_heartbeat
+Event-Calling-Line-Number: 65
+Event-Info: System%20Ready
+Session-Count: 0
+Session-Per-Sec: 30
+Session-Since-Startup: 0
+Idle-CPU: 100.000000
+
+"""
+
+EVENT_FRAME = "Content-Length: %d\nContent-Type: text/event-plain\n\n%s" \
+                % (len(EVENT_PLAIN), EVENT_PLAIN)
+
+COMMAND_REPLY = "Content-Type: command/reply\nReply-Text: +OK Job-UUID: 7f4db78a-17d7-11dd-b7a0-db4edd065621\nJob-UUID: 7f4db78a-17d7-11dd-b7a0-db4edd065621\n\n"
+
+API_RESPONSE = "Content-Type: api/response\nContent-Length: 16\n\n+OK 1 session(s)"
+
+
+class MemoryTransport(object):
+    '''
+    Transport reading from an in-memory string.
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def recv_into(self, buffer):
+        chunk = self.data[self.pos:self.pos+len(buffer)]
+        self.pos += len(chunk)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+class LoopbackTransport(MemoryTransport):
+    '''
+    Transport answering each command with a reply frame.
+    '''
+    def __init__(self):
+        MemoryTransport.__init__(self, '')
+        self.ready = gevent.event.Event()
+
+    def write(self, data):
+        if data.startswith('api '):
+            self.data += API_RESPONSE
+        else:
+            self.data += COMMAND_REPLY
+        self.ready.set()
+
+    def recv_into(self, buffer):
+        while self.pos >= len(self.data):
+            self.data = ''
+            self.pos = 0
+            self.ready.clear()
+            self.ready.wait()
+        return MemoryTransport.recv_into(self, buffer)
+
+
+class LegacyYieldPolicy(YieldPolicy):
+    '''
+    Former behaviour : sleeps with a timer after every event.
+    '''
+    def step(self, pending=0):
+        gevent.sleep(0.0001)
+
+
+class BenchEventSocket(EventSocket):
+    def __init__(self, data, yield_policy):
+        EventSocket.__init__(self, filter=None, eventjson=False,
+                             yield_policy=yield_policy)
+        self.transport = MemoryTransport(data)
+        self.count = 0
+        self.connect()
+
+    def on_heartbeat(self, ev):
+        self.count += 1
+
+
+def run(name, yield_policy, events=5000):
+    sock = BenchEventSocket(EVENT_FRAME * events, yield_policy)
+    start = time.time()
+    sock.handle_events()
+    sock.pool.join()
+    elapsed = time.time() - start
+    assert sock.count == events
+    print "%-10s %8d events in %.3fs -- %d events/sec" \
+            % (name, events, elapsed, events / elapsed)
+    return events / elapsed
+
+
+def legacy_cast(cls, event):
+    '''
+    Former cast : copies Event into a new instance.
+    '''
+    res = cls()
+    res._headers = event._headers
+    res._raw_headers = event._raw_headers
+    res._raw_body = event._raw_body
+    return res
+
+
+def run_cast(name, cast, count=200000):
+    event = Event()
+    start = time.time()
+    for i in xrange(count):
+        event = cast(ApiResponse, event)
+    elapsed = time.time() - start
+    print "%-10s %8d casts in %.3fs -- %d casts/sec" \
+            % (name, count, elapsed, count / elapsed)
+    return count / elapsed
+
+
+def run_commands(command, count=20000):
+    sock = EventSocket(filter=None, eventjson=False)
+    sock.transport = LoopbackTransport()
+    sock.connect()
+    sock.start_event_handler()
+    start = time.time()
+    for i in xrange(count):
+        if command == 'api':
+            sock.api('status')
+        else:
+            sock.bgapi('status')
+    elapsed = time.time() - start
+    sock.stop_event_handler()
+    print "%-10s %8d commands in %.3fs -- %d commands/sec" \
+            % (command, count, elapsed, count / elapsed)
+    return count / elapsed
+
+
+def run_pipelined(count=20000, window=100):
+    sock = EventSocket(filter=None, eventjson=False)
+    sock.transport = LoopbackTransport()
+    sock.connect()
+    sock.start_event_handler()
+    start = time.time()
+    for i in xrange(count / window):
+        results = [sock.api_async('status') for j in xrange(window)]
+        [result.get() for result in results]
+    elapsed = time.time() - start
+    sock.stop_event_handler()
+    print "%-10s %8d commands in %.3fs -- %d commands/sec" \
+            % ('api_async', count, elapsed, count / elapsed)
+    return count / elapsed
+
+
+def main():
+    before = run('legacy', LegacyYieldPolicy())
+    after = run('policy', YieldPolicy())
+    print "speedup x%.2f" % (after / before)
+    before = run_cast('copy', legacy_cast)
+    after = run_cast('in place', lambda cls, ev: cls.cast(ev))
+    print "speedup x%.2f" % (after / before)
+    run_commands('api')
+    run_commands('bgapi')
+    run_pipelined()
+
+
+if __name__ == '__main__':
+    main()
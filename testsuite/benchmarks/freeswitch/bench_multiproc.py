@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+"""
+Benchmark of accept to first command latency of the multiprocess
+outbound server, with a new process per call and with a process pool.
+
+The latency is the time between FreeSWITCH connecting to the server
+and receiving the first command ('connect') of the outbound socket.
+
+Run from testsuite directory :
+    PYTHONPATH=../src python -m benchmarks.freeswitch.bench_multiproc
+"""
+
+import socket
+import time
+
+import gevent
+
+from plivo.core.freeswitch.multiprocserver import OutboundServer, Process
+
+
+class FirstCommandHandler(object):
+    '''
+    Sends the first command of an outbound socket and ends the call.
+    '''
+    def __init__(self, sock, address, filter):
+        sock.sendall('connect\n\n')
+        sock.close()
+
+
+def run_server(address, pool_size, max_calls):
+    server = OutboundServer(address, FirstCommandHandler, pool_size=pool_size,
+                            max_calls=max_calls)
+    server.start()
+    server.loop()
+
+
+def get_free_address():
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    address = probe.getsockname()
+    probe.close()
+    return address
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(name, pool_size=0, max_calls=0, calls=500):
+    address = get_free_address()
+    server = Process(target=run_server, args=(address, pool_size, max_calls))
+    server.start()
+    try:
+        # Waits for server and workers to be ready
+        for i in range(50):
+            try:
+                socket.create_connection(address).recv(64)
+                break
+            except socket.error:
+                gevent.sleep(0.1)
+        latencies = []
+        start = time.time()
+        for i in xrange(calls):
+            t = time.time()
+            sock = socket.create_connection(address)
+            sock.recv(64)
+            latencies.append((time.time() - t) * 1000)
+            sock.close()
+        elapsed = time.time() - start
+    finally:
+        server.terminate()
+        server.join()
+    latencies.sort()
+    print "%-16s %6d calls in %.3fs -- %d calls/sec -- latency ms p50 %.2f p99 %.2f" \
+            % (name, calls, elapsed, calls / elapsed,
+               percentile(latencies, 50), percentile(latencies, 99))
+    return percentile(latencies, 50)
+
+
+def main():
+    before = run('fork per call')
+    after = run('pool', pool_size=4)
+    print "p50 speedup x%.2f" % (before / after)
+    run('pool recycled', pool_size=4, max_calls=100)
+
+
+if __name__ == '__main__':
+    main()
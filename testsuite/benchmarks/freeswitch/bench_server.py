@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+"""
+Event socket benchmark with a fake FreeSWITCH server.
+
+A fake switch (the TestEventSocketServer of inbound socket tests),
+started in another process, replays ESL traffic to InboundEventSocket
+or OutboundEventSocket at a given rate.
+Each run is done in a fresh process, it measures parse throughput,
+dispatch latency percentiles (from Event-Date-Timestamp set when the event
+is sent) and memory per event (peak resident memory growth).
+
+Traffic is a generated call load by default, or a raw ESL stream
+recorded from a switch connection (--capture FILE),
+only text/event-plain and text/event-json frames are replayed.
+
+Results are printed as json. With --baseline, results are compared with
+a previous output and exit status is 1 if a regression is found.
+
+Run from testsuite directory :
+    PYTHONPATH=../src python -m benchmarks.freeswitch.bench_server --output results.json
+    PYTHONPATH=../src python -m benchmarks.freeswitch.bench_server --baseline results.json
+"""
+
+import os
+import sys
+import time
+import socket as pysocket
+import subprocess
+import optparse
+from urllib import quote
+
+import ujson as json
+import gevent
+import gevent.event
+from gevent import socket
+from gevent.server import StreamServer
+
+from plivo.core.freeswitch.eventtypes import Event
+from plivo.core.freeswitch.frameparser import FrameParser
+from plivo.core.freeswitch.inboundsocket import InboundEventSocket
+from plivo.core.freeswitch.outboundsocket import OutboundEventSocket
+from plivo.core.errors import ConnectError
+from tests.freeswitch.test_inboundsocket import TestEventSocketServer
+
+
+PASSWORD = 'ClueCon'
+# Event-Date-Timestamp value replaced with send time (same length)
+TIMESTAMP_MARK = '9' * 16
+# Events sent in one write when rate is not limited
+BURST = 100
+
+CALL_EVENTS = ('CHANNEL_CREATE', 'CHANNEL_PROGRESS', 'CHANNEL_ANSWER',
+               'CHANNEL_EXECUTE', 'CHANNEL_EXECUTE_COMPLETE',
+               'CHANNEL_HANGUP', 'CHANNEL_HANGUP_COMPLETE')
+
+
+def make_traffic(calls=100, variables=30):
+    '''
+    Generates events for calls, as a list of headers dicts.
+    '''
+    events = []
+    for call in range(calls):
+        uuid = '3cf2a8a6-1f14-11e0-9d2e-%012d' % call
+        for name in CALL_EVENTS:
+            headers = {'Event-Name': name,
+                       'Core-UUID': '12640749-db62-421c-beac-4863eac76510',
+                       'FreeSWITCH-Hostname': 'vocaldev',
+                       'FreeSWITCH-IPv4': '10.0.0.108',
+                       'Event-Date-Local': '2011-01-04 10:19:56',
+                       'Event-Calling-File': 'switch_channel.c',
+                       'Unique-ID': uuid,
+                       'Call-Direction': 'outbound',
+                       'Channel-State': 'CS_EXECUTE',
+                       'Channel-Call-State': 'ACTIVE',
+                       'Answer-State': 'answered',
+                       'Caller-Destination-Number': '1000',
+                       'Caller-Caller-ID-Number': '0000000000',
+                       'Caller-Channel-Name': 'sofia/internal/1000@10.0.0.108',
+                      }
+            if name.startswith('CHANNEL_HANGUP'):
+                headers['Hangup-Cause'] = 'NORMAL_CLEARING'
+            for i in range(variables):
+                headers['variable_plivo_var_%d' % i] = 'some value %d' % i
+            events.append(headers)
+        events.append({'Event-Name': 'HEARTBEAT',
+                       'Core-UUID': '12640749-db62-421c-beac-4863eac76510',
+                       'Event-Info': 'System Ready',
+                       'Session-Count': str(calls)})
+    return events
+
+
+class FileTransport(object):
+    '''
+    Transport reading a recorded ESL stream from a file.
+    '''
+    def __init__(self, fd):
+        self.fd = fd
+
+    def recv_into(self, buffer):
+        return self.fd.readinto(buffer)
+
+
+def load_capture(path):
+    '''
+    Loads events from a raw ESL stream file, as a list of headers dicts.
+    '''
+    events = []
+    parser = FrameParser(FileTransport(open(path, 'rb')))
+    while True:
+        try:
+            header, body = parser.read_frame()
+        except ConnectError:
+            break
+        content_type = Event(header).get_content_type()
+        if not body:
+            continue
+        if content_type == 'text/event-plain':
+            events.append(Event(body).get_headers())
+        elif content_type == 'text/event-json':
+            events.append(json.loads(body))
+    return events
+
+
+def make_frame(headers, eventjson):
+    '''
+    Builds event frame, split around Event-Date-Timestamp value.
+    '''
+    headers = dict(headers)
+    headers['Event-Date-Timestamp'] = TIMESTAMP_MARK
+    if eventjson:
+        body = json.dumps(headers)
+        content_type = 'text/event-json'
+    else:
+        body = ''.join([ '%s: %s\n' % (key, quote(str(value)))
+                         for key, value in headers.iteritems() ]) + '\n'
+        content_type = 'text/event-plain'
+    frame = 'Content-Length: %d\nContent-Type: %s\n\n%s' \
+            % (len(body), content_type, body)
+    return frame.split(TIMESTAMP_MARK, 1)
+
+
+class FakeSwitch(TestEventSocketServer):
+    '''
+    Fake FreeSWITCH, replays events on an event socket connection.
+    '''
+    def __init__(self, events, count, rate, port):
+        TestEventSocketServer.__init__(self, port)
+        self.port = port
+        self.events = events
+        self.count = count
+        self.rate = rate
+
+    def read_command(self, fd):
+        '''
+        Reads a command until blank line, returns '' if closed.
+        '''
+        buff = ''
+        while True:
+            line = fd.readline()
+            if not line:
+                return ''
+            if line in ('\n', '\r\n'):
+                return buff
+            buff += line
+
+    def reply(self, fd, text, headers=''):
+        fd.write('Content-Type: command/reply\nReply-Text: %s\n%s\n' % (text, headers))
+        fd.flush()
+
+    def replay(self, fd, eventjson):
+        frames = [ make_frame(headers, eventjson) for headers in self.events ]
+        if self.rate:
+            burst = max(1, self.rate / 100)
+            interval = float(burst) / self.rate
+        else:
+            burst = BURST
+            interval = 0
+        sent = 0
+        next_send = time.time()
+        while sent < self.count:
+            buff = []
+            timestamp = '%d' % (time.time() * 1000000)
+            for i in xrange(min(burst, self.count - sent)):
+                prefix, suffix = frames[(sent + i) % len(frames)]
+                buff.append(prefix + timestamp + suffix)
+            fd.write(''.join(buff))
+            fd.flush()
+            sent += len(buff)
+            if interval:
+                next_send += interval
+                gevent.sleep(max(0, next_send - time.time()))
+
+    def send_events(self, client):
+        self.replay(client.fd, client.event_json)
+        # Waits until client closes connection
+        while self.read_command(client.fd):
+            self.reply(client.fd, '+OK')
+
+    def disconnect(self, client):
+        client.close()
+
+    def connect_outbound(self):
+        sock = socket.socket()
+        for i in range(100):
+            try:
+                sock.connect(('127.0.0.1', self.port))
+                break
+            except socket.error:
+                gevent.sleep(0.05)
+        fd = sock.makefile()
+        channel = 'Event-Name: CHANNEL_DATA\nUnique-ID: 3cf2a8a6-1f14-11e0-9d2e-000000000000\n'
+        while True:
+            cmd = self.read_command(fd)
+            if not cmd:
+                return
+            if cmd.startswith('connect'):
+                self.reply(fd, '+OK', channel)
+            elif cmd.startswith('event '):
+                self.reply(fd, '+OK event listener enabled')
+                self.replay(fd, cmd.startswith('event json'))
+            else:
+                self.reply(fd, '+OK')
+
+
+class Recorder(object):
+    '''
+    Records dispatched events.
+    '''
+    def __init__(self, count):
+        self.count = count
+        self.latencies = []
+        # Events are kept to measure memory per event
+        self.events = []
+        self.first = None
+        self.last = None
+        self.done = gevent.event.Event()
+
+    def record(self, event):
+        if self.done.is_set():
+            return
+        now = time.time()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.events.append(event)
+        self.latencies.append(now - int(event['Event-Date-Timestamp']) / 1000000.0)
+        if len(self.events) >= self.count:
+            self.done.set()
+
+
+class BenchInboundEventSocket(InboundEventSocket):
+    def __init__(self, port, recorder, eventjson):
+        InboundEventSocket.__init__(self, '127.0.0.1', port, PASSWORD,
+                                    eventjson=eventjson)
+        self.recorder = recorder
+
+    def unbound_event(self, event):
+        self.recorder.record(event)
+
+
+class BenchOutboundEventSocket(OutboundEventSocket):
+    def __init__(self, sock, address, recorder, eventjson):
+        self.recorder = recorder
+        OutboundEventSocket.__init__(self, sock, address, eventjson=eventjson)
+
+    def unbound_event(self, event):
+        self.recorder.record(event)
+
+    def run(self):
+        self.recorder.done.wait()
+
+
+def get_rss():
+    '''
+    Gets resident memory size in bytes (peak size if unknown).
+    '''
+    try:
+        pages = int(open('/proc/self/statm').read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return get_peak_rss()
+
+
+def get_peak_rss():
+    '''
+    Gets peak resident memory size of the process in bytes.
+    '''
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def get_testsuite_dir():
+    return os.path.dirname(os.path.dirname(os.path.dirname(
+                                            os.path.abspath(__file__))))
+
+
+def start_process(args, **kwargs):
+    '''
+    Starts this benchmark in a new process with args
+    '''
+    return subprocess.Popen([sys.executable, '-m',
+                             'benchmarks.freeswitch.bench_server'] + args,
+                            cwd=get_testsuite_dir(), **kwargs)
+
+
+def get_free_port():
+    sock = pysocket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, pct):
+    '''
+    Gets percentile from sorted values.
+    '''
+    if not values:
+        return None
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def start_fake_switch(options, mode, port):
+    args = ['--fake-switch', mode, '--port', str(port),
+            '--events', str(options.events), '--rate', str(options.rate)]
+    if options.capture:
+        args += ['--capture', options.capture]
+    return start_process(args)
+
+
+def run_process(options, mode, eventjson):
+    '''
+    Runs benchmark in a fresh process, so memory of previous runs
+    is not measured, and returns results dict.
+    '''
+    args = ['--run', mode, '--format', eventjson and 'json' or 'plain',
+            '--events', str(options.events), '--rate', str(options.rate),
+            '--timeout', str(options.timeout)]
+    if options.capture:
+        args += ['--capture', options.capture]
+    process = start_process(args, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise RuntimeError("%s run failed (exit status %d)"
+                           % (mode, process.returncode))
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(options, mode, eventjson):
+    '''
+    Runs benchmark for mode (inbound or outbound) and returns results dict.
+    '''
+    port = get_free_port()
+    recorder = Recorder(options.events)
+    rss = get_rss()
+    if get_peak_rss() > rss:
+        print >> sys.stderr, "%s: peak memory already above current memory, " \
+                             "memory per event is underestimated" % mode
+    if mode == 'inbound':
+        fake_switch = start_fake_switch(options, mode, port)
+        sock = BenchInboundEventSocket(port, recorder, eventjson)
+        for i in range(100):
+            try:
+                sock.connect()
+                break
+            except ConnectError:
+                gevent.sleep(0.05)
+    else:
+        server = StreamServer(('127.0.0.1', port),
+                lambda sock, address: BenchOutboundEventSocket(
+                                        sock, address, recorder, eventjson))
+        server.start()
+        fake_switch = start_fake_switch(options, mode, port)
+    try:
+        recorder.done.wait(timeout=options.timeout)
+        rss = max(0, get_peak_rss() - rss)
+    finally:
+        recorder.done.set()
+        if mode == 'inbound':
+            sock.disconnect()
+        else:
+            server.stop()
+        fake_switch.kill()
+        fake_switch.wait()
+    received = len(recorder.events)
+    if received < options.events:
+        print >> sys.stderr, "%s: timeout, %d/%d events received" \
+                                % (mode, received, options.events)
+    latencies = sorted(recorder.latencies)
+    if received > 1 and recorder.last > recorder.first:
+        throughput = (received - 1) / (recorder.last - recorder.first)
+    else:
+        throughput = 0
+    return {'name': '%s-%s' % (mode, eventjson and 'json' or 'plain'),
+            'events': received,
+            'rate': options.rate,
+            'throughput': throughput,
+            'latency_ms': dict([ ('p%d' % pct, percentile(latencies, pct) * 1000)
+                                 for pct in (50, 90, 99, 100) if latencies ]),
+            'rss_per_event': received and rss / received or 0,
+           }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Compares results with baseline results.
+
+    Returns list of regressions.
+    '''
+    regressions = []
+    # Only results with same name and rate are comparable
+    previous = dict([ ((result['name'], result['rate']), result)
+                      for result in baseline ])
+    for result in results:
+        base = previous.get((result['name'], result['rate']))
+        if not base:
+            continue
+        checks = [('throughput', base['throughput'], result['throughput'], -1),
+                  ('rss_per_event', base['rss_per_event'], result['rss_per_event'], 1)]
+        if 'p99' in base['latency_ms'] and 'p99' in result['latency_ms']:
+            checks.append(('latency p99', base['latency_ms']['p99'],
+                           result['latency_ms']['p99'], 1))
+        for metric, before, after, worse in checks:
+            # No relative change from an invalid baseline
+            if before <= 0:
+                continue
+            change = (after - before) / float(before)
+            if change * worse > tolerance:
+                regressions.append('%s %s: %.2f -> %.2f (%+d%%)'
+                                   % (result['name'], metric, before, after, change * 100))
+    return regressions
+
+
+def opt():
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--socket", action="store", type="choice",
+                      choices=("inbound", "outbound", "all"), dest="socket",
+                      default="all", help="socket to benchmark (default: all)")
+    parser.add_option("-f", "--format", action="store", type="choice",
+                      choices=("plain", "json", "all"), dest="format",
+                      default="all", help="event format (default: all)")
+    parser.add_option("-n", "--events", action="store", type="int",
+                      dest="events", default=20000, help="events to replay")
+    parser.add_option("-r", "--rate", action="store", type="int",
+                      dest="rate", default=0,
+                      help="events per second, 0 for no limit (default)")
+    parser.add_option("--capture", action="store", type="string",
+                      dest="capture", metavar="FILE",
+                      help="replay events from raw ESL stream FILE")
+    parser.add_option("--timeout", action="store", type="float",
+                      dest="timeout", default=120, help="timeout per run")
+    parser.add_option("-o", "--output", action="store", type="string",
+                      dest="output", metavar="FILE",
+                      help="also write results to FILE")
+    parser.add_option("-b", "--baseline", action="store", type="string",
+                      dest="baseline", metavar="FILE",
+                      help="compare with results from FILE")
+    parser.add_option("-t", "--tolerance", action="store", type="float",
+                      dest="tolerance", default=0.1,
+                      help="regression tolerance (default: 0.1)")
+    parser.add_option("--fake-switch", action="store", type="choice",
+                      choices=("inbound", "outbound"), dest="fake_switch",
+                      help=optparse.SUPPRESS_HELP)
+    parser.add_option("--port", action="store", type="int", dest="port",
+                      help=optparse.SUPPRESS_HELP)
+    parser.add_option("--run", action="store", type="choice",
+                      choices=("inbound", "outbound"), dest="run",
+                      help=optparse.SUPPRESS_HELP)
+    (options, args) = parser.parse_args()
+    return options
+
+
+def main():
+    options = opt()
+    if options.fake_switch:
+        if options.capture:
+            events = load_capture(options.capture)
+        else:
+            events = make_traffic()
+        switch = FakeSwitch(events, options.events, options.rate,
+                            options.port)
+        if options.fake_switch == 'inbound':
+            switch.start()
+        else:
+            switch.connect_outbound()
+        return 0
+    if options.run:
+        print json.dumps(run(options, options.run, options.format == 'json'))
+        return 0
+
+    modes = options.socket == 'all' and ('inbound', 'outbound') or (options.socket,)
+    formats = options.format == 'all' and (False, True) or (options.format == 'json',)
+    results = []
+    for mode in modes:
+        for eventjson in formats:
+            result = run_process(options, mode, eventjson)
+            print >> sys.stderr, "%-16s %8d events -- %d events/sec -- p99 %.1fms -- %d bytes/event" \
+                    % (result['name'], result['events'], result['throughput'],
+                       result['latency_ms'].get('p99', 0), result['rss_per_event'])
+            results.append(result)
+    output = json.dumps(results)
+    print output
+    if options.output:
+        open(options.output, 'w').write(output)
+    if options.baseline:
+        regressions = compare(results, json.loads(open(options.baseline).read()),
+                              options.tolerance)
+        for regression in regressions:
+            print >> sys.stderr, "REGRESSION %s" % regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
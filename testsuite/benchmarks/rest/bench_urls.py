@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+"""
+Micro-benchmark for url validation of RESTXML documents.
+
+Run from testsuite directory :
+    PYTHONPATH=../src python -m benchmarks.rest.bench_urls
+"""
+
+import re
+import time
+import urlparse
+import xml.etree.cElementTree as etree
+
+from plivo.rest.freeswitch.urlvalidator import validate_url, clear_cache
+
+
+DOCUMENTS = [
+"""<Response>
+    <Play>http://media.example.com/sounds/welcome.mp3</Play>
+    <GetDigits action="http://app.example.com/digits/" numDigits="1">
+        <Play>http://media.example.com/sounds/menu.mp3</Play>
+        <Speak>Press 1 for sales, 2 for support</Speak>
+    </GetDigits>
+    <Redirect>http://app.example.com/answer/?retry=1</Redirect>
+</Response>""",
+"""<Response>
+    <Dial action="http://app.example.com/dial/" dialMusic="http://media.example.com/moh/ring.mp3,/usr/local/freeswitch/sounds/ring.wav">
+        <Number gateways="sofia/gateway/pstn/">15551234567</Number>
+    </Dial>
+    <Play>http://media.example.com/sounds/goodbye.mp3</Play>
+</Response>""",
+"""<Response>
+    <Conference waitSound="http://media.example.com/moh/jazz.mp3,http://media.example.com/moh/rock.mp3">room-42</Conference>
+    <Redirect>http://app.example.com/conference/ended/</Redirect>
+</Response>""",
+]
+
+
+def get_urls(document):
+    """Gets values validated as urls when parsing a document
+    """
+    urls = []
+    for element in etree.fromstring(document).getiterator():
+        if element.tag in ('Play', 'Redirect'):
+            urls.append(element.text.strip())
+        for attr in ('action', 'dialMusic', 'waitSound'):
+            value = element.get(attr)
+            if value:
+                urls.extend(value.split(','))
+    return urls
+
+
+def is_valid_url_uncompiled(value):
+    """Url validation compiling regex on each call, as before urlvalidator
+    """
+    regex = re.compile(
+      r'^(?:http|ftp)s?://'
+      r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|'
+      r'localhost|'
+      r'http://127.0.0.1|'
+      r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+      r'(?::\d+)?'
+      r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+    if not value.startswith('http://') and not value.startswith('https://') \
+        and not value.startswith('ftp://'):
+        value = ''.join(['http://', value])
+    if regex.search(value):
+        return True
+    if value:
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(value)
+        try:
+            netloc = netloc.encode('idna')
+        except UnicodeError:
+            return False
+        url = urlparse.urlunsplit((scheme, netloc, path, query, fragment))
+        if regex.search(url):
+            return True
+    return False
+
+
+def run(name, validate, urls, documents=20000):
+    start = time.time()
+    for i in xrange(documents):
+        for url in urls[i % len(urls)]:
+            validate(url)
+    elapsed = time.time() - start
+    print "%-10s %8d documents in %.3fs -- %d documents/sec" \
+            % (name, documents, elapsed, documents / elapsed)
+    return documents / elapsed
+
+
+def main():
+    urls = [ get_urls(document) for document in DOCUMENTS ]
+    before = run('uncompiled', is_valid_url_uncompiled, urls)
+    clear_cache()
+    after = run('cached', validate_url, urls)
+    print "speedup x%.2f" % (after / before)
+
+
+if __name__ == '__main__':
+    main()
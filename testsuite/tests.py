@@ -10,7 +10,20 @@ def make_test():
 def make_suite():
     return unittest.TestLoader().loadTestsFromNames([
         'tests.freeswitch.test_events',
+        'tests.freeswitch.test_eventsocket',
+        'tests.freeswitch.test_frameparser',
         'tests.freeswitch.test_inboundsocket',
+        'tests.freeswitch.test_multiprocserver',
+        'tests.freeswitch.test_multithreadserver',
+        'tests.freeswitch.test_outboundsocket',
+        'tests.freeswitch.test_preforkserver',
+        'tests.freeswitch.test_scheduler',
+        'tests.rest.test_audiocache',
+        'tests.rest.test_auth',
+        'tests.rest.test_helpers',
+        'tests.rest.test_outboundsocket',
+        'tests.rest.test_urlvalidator',
+        'tests.rest.test_webhooks',
     ])
 
 def run_test():
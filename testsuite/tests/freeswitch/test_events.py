@@ -3,7 +3,8 @@
 
 from unittest import TestCase
 
-from plivo.core.freeswitch.eventtypes import Event
+from plivo.core.freeswitch.eventtypes import Event, BgapiResponse, JsonEvent, \
+                                            HeaderSubsetDecoder, STDLIB_JSON_DECODER
 
 
 class TestEvent(TestCase):
@@ -48,3 +49,54 @@ Task-Runtime: 1294076056
         ev2 = Event(self.EVENT_PLAIN)
         self.assertEquals(ev2.get_header("Event-Name"), "RE_SCHEDULE")
         self.assertEquals(len(self.EVENT_PLAIN), ev1.get_content_length())
+
+    def test_lazy_event(self):
+        ev = Event(self.EVENT_PLAIN, lazy=True)
+        self.assertFalse(ev.is_empty())
+        self.assertEquals(ev.get_header("Event-Name"), "RE_SCHEDULE")
+        self.assertEquals(ev["FreeSWITCH-IPv6"], "::1")
+        self.assertEquals(ev.get_header("Task-Runtime"), "1294076056")
+        self.assertEquals(ev.get_header("Not-Found"), None)
+        self.assertEquals(ev.get_header("Not-Found", "default"), "default")
+        ev.set_header("Task-ID", "2")
+        self.assertEquals(ev["Task-ID"], "2")
+        headers = ev.get_headers()
+        self.assertEquals(headers["Task-ID"], "2")
+        self.assertEquals(headers["Event-Date-Local"], "2011-01-03 18:33:56")
+        expected = Event(self.EVENT_PLAIN)
+        expected.set_header("Task-ID", "2")
+        self.assertEquals(headers, expected.get_headers())
+
+    def test_lazy_event_duplicate_header(self):
+        buff = "Content-Type: text/plain\nContent-Type: api/response\n"
+        self.assertEquals(Event(buff, lazy=True).get_content_type(),
+                          Event(buff).get_content_type())
+
+    def test_cast(self):
+        ev = Event(self.EVENT_COMMAND_REPLY + "Job-UUID: 1234\n", lazy=True)
+        res = BgapiResponse.cast(ev)
+        self.assertTrue(isinstance(res, BgapiResponse))
+        self.assertEquals(res.get_job_uuid(), "1234")
+        self.assertTrue(res.is_success())
+
+    def test_json_decoders(self):
+        buff = '{"Event-Name": "CHANNEL_HANGUP",\n\t"Event-Info": "say \\"Unique-ID\\": x",' \
+               '"Unique-ID":"1234", "Hangup-Cause":\t"NORMAL_CLEARING", "_body": "+OK"}'
+        ev = JsonEvent(buff)
+        self.assertEquals(JsonEvent(buff, STDLIB_JSON_DECODER).get_headers(), ev.get_headers())
+        subset = JsonEvent(buff, HeaderSubsetDecoder(['Unique-ID', 'Event-Name', 'Missing']))
+        self.assertEquals(subset._headers, {'Unique-ID': '1234', 'Event-Name': 'CHANNEL_HANGUP',
+                                            '_body': '+OK'})
+        self.assertEquals(subset.get_body(), '+OK')
+        # Other headers are decoded on first access
+        self.assertEquals(subset['Hangup-Cause'], 'NORMAL_CLEARING')
+        self.assertEquals(subset['Missing'], None)
+        self.assertEquals(subset.get_headers(), ev.get_headers())
+        # Full decode uses decoder loads
+        decoded = []
+        def loads(buffer):
+            decoded.append(buffer)
+            return STDLIB_JSON_DECODER.loads(buffer)
+        subset = JsonEvent(buff, HeaderSubsetDecoder(['Unique-ID'], loads))
+        self.assertEquals(subset['Hangup-Cause'], 'NORMAL_CLEARING')
+        self.assertTrue(buff in decoded)
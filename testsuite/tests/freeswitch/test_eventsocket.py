@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+import gevent
+import gevent.event
+
+from plivo.core.freeswitch.eventsocket import EventSocket
+from plivo.core.freeswitch.eventtypes import Event, ApiResponse, BgapiResponse
+
+
+class TestTransport(object):
+    '''
+    Fake transport, replies are pushed by the test.
+    '''
+    def __init__(self):
+        self.written = []
+        self.data = ''
+        self.ready = gevent.event.Event()
+
+    def write(self, data):
+        self.written.append(data)
+
+    def reply(self, data):
+        self.data += data
+        self.ready.set()
+
+    def recv_into(self, buffer):
+        while not self.data:
+            self.ready.clear()
+            self.ready.wait()
+        chunk = self.data[:len(buffer)]
+        self.data = self.data[len(chunk):]
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        pass
+
+
+class TestPipelinedCommands(TestCase):
+    def setUp(self):
+        self.sock = EventSocket(filter=None, eventjson=False)
+        self.sock.transport = TestTransport()
+        self.sock.connect()
+        self.sock.start_event_handler()
+
+    def tearDown(self):
+        self.sock.stop_event_handler()
+
+    def test_commands_in_flight(self):
+        results = [self.sock.api_async('status'),
+                   self.sock.bgapi_async('originate'),
+                   self.sock.api_async('version')]
+        # All commands are written before any response
+        self.assertEquals(len(self.sock.transport.written), 3)
+        self.assertFalse([r for r in results if r.ready()])
+        self.sock.transport.reply("Content-Type: api/response\nContent-Length: 6\n\n+OK up"
+                                  "Content-Type: command/reply\nReply-Text: +OK Job-UUID: 1234\nJob-UUID: 1234\n\n"
+                                  "Content-Type: api/response\nContent-Length: 9\n\n+OK 1.0.7")
+        status, job, version = [r.get(timeout=1) for r in results]
+        self.assertTrue(isinstance(status, ApiResponse))
+        self.assertEquals(status.get_response(), "+OK up")
+        self.assertTrue(isinstance(job, BgapiResponse))
+        self.assertEquals(job.get_job_uuid(), "1234")
+        self.assertEquals(version.get_response(), "+OK 1.0.7")
+
+    def test_disconnect_releases_commands(self):
+        result = self.sock.api_async('status')
+        self.sock.disconnect()
+        self.assertTrue(result.get(timeout=1).is_empty())
+
+
+class DispatchEventSocket(EventSocket):
+    def __init__(self):
+        EventSocket.__init__(self, filter=None, eventjson=False)
+        self.handled = []
+
+    def on_custom(self, ev):
+        self.handled.append('on_custom')
+
+    def on_custom_conference_maintenance(self, ev):
+        self.handled.append('on_custom_conference_maintenance')
+
+    def on_channel_hangup(self, ev):
+        self.handled.append('on_channel_hangup')
+
+    def unbound_event(self, ev):
+        self.handled.append('unbound_event')
+
+
+class TestDispatchEvent(TestCase):
+    def make_event(self, name, subclass=None, uuid=None):
+        ev = Event()
+        ev['Event-Name'] = name
+        if subclass:
+            ev['Event-Subclass'] = subclass
+        if uuid:
+            ev['Unique-ID'] = uuid
+        return ev
+
+    def test_class_handlers(self):
+        sock = DispatchEventSocket()
+        sock.dispatch_event(self.make_event('CHANNEL_HANGUP'))
+        sock.dispatch_event(self.make_event('CUSTOM', 'conference::maintenance'))
+        sock.dispatch_event(self.make_event('CUSTOM', 'sofia::register'))
+        sock.dispatch_event(self.make_event('HEARTBEAT'))
+        self.assertEquals(sock.handled, ['on_channel_hangup',
+                                         'on_custom_conference_maintenance',
+                                         'on_custom',
+                                         'on_custom',
+                                         'unbound_event'])
+
+    def test_instance_handlers(self):
+        sock = DispatchEventSocket()
+        handled = []
+        sock.on_heartbeat = lambda ev: handled.append('on_heartbeat')
+        sock.on_channel_hangup = lambda ev: handled.append('on_channel_hangup')
+        sock.dispatch_event(self.make_event('HEARTBEAT'))
+        sock.dispatch_event(self.make_event('CHANNEL_HANGUP'))
+        self.assertEquals(handled, ['on_heartbeat', 'on_channel_hangup'])
+        self.assertEquals(sock.handled, [])
+        # Other instances still use class handlers
+        other = DispatchEventSocket()
+        other.dispatch_event(self.make_event('CHANNEL_HANGUP'))
+        self.assertEquals(other.handled, ['on_channel_hangup'])
+
+    def test_registered_handlers(self):
+        sock = DispatchEventSocket()
+        handled = []
+        handler = lambda ev: handled.append(ev['Event-Subclass'])
+        sock.register_handler(handler, 'CUSTOM', 'sofia::register')
+        sock.register_handler(handler, 'HEARTBEAT')
+        sock.dispatch_event(self.make_event('CUSTOM', 'conference::maintenance'))
+        sock.dispatch_event(self.make_event('CUSTOM', 'sofia::register'))
+        sock.dispatch_event(self.make_event('HEARTBEAT'))
+        self.assertEquals(handled, ['sofia::register', None])
+        self.assertTrue('unbound_event' not in sock.handled)
+        sock.unregister_handler(handler, 'HEARTBEAT')
+        sock.dispatch_event(self.make_event('HEARTBEAT'))
+        self.assertEquals(sock.handled[-1], 'unbound_event')
+
+    def test_unique_id_filter(self):
+        sock = DispatchEventSocket()
+        sock.set_unique_id_filter('1234')
+        self.assertFalse(sock.is_filtered(self.make_event('CHANNEL_HANGUP', uuid='1234')))
+        self.assertTrue(sock.is_filtered(self.make_event('CHANNEL_HANGUP', uuid='5678')))
+        self.assertFalse(sock.is_filtered(self.make_event('BACKGROUND_JOB')))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+from plivo.core.freeswitch.frameparser import FrameParser, get_content_length
+from plivo.core.errors import LimitExceededError, ConnectError
+
+
+class TestTransport(object):
+    '''
+    Fake transport returning data in fixed size chunks.
+    '''
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def recv_into(self, buffer):
+        size = min(self.chunk_size, len(buffer))
+        chunk = self.data[:size]
+        self.data = self.data[size:]
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class TestFrameParser(TestCase):
+    COMMAND_REPLY = "Content-Type: command/reply\nReply-Text: +OK accepted\n\n"
+    API_RESPONSE = "Content-Type: api/response\nContent-Length: 12\n\n+OK\n\n\nDone\n\n"
+    EVENT_PLAIN = "Event-Name: HEARTBEAT\nCore-UUID: 12640749\n\n"
+
+    def get_stream(self):
+        event = "Content-Length: %d\nContent-Type: text/event-plain\n\n%s" \
+                    % (len(self.EVENT_PLAIN), self.EVENT_PLAIN)
+        return self.COMMAND_REPLY + self.API_RESPONSE + event
+
+    def check_frames(self, parser):
+        header, body = parser.read_frame()
+        self.assertEquals(header, "Content-Type: command/reply\nReply-Text: +OK accepted\n")
+        self.assertEquals(body, None)
+        header, body = parser.read_frame()
+        self.assertEquals(get_content_length(header), 12)
+        self.assertEquals(body, "+OK\n\n\nDone\n\n")
+        header, body = parser.read_frame()
+        self.assertEquals(get_content_length(header), len(self.EVENT_PLAIN))
+        self.assertEquals(body, self.EVENT_PLAIN)
+        self.assertEquals(parser.pending(), 0)
+
+    def test_one_chunk(self):
+        parser = FrameParser(TestTransport(self.get_stream(), 65536))
+        self.check_frames(parser)
+
+    def test_small_chunks(self):
+        for size in (1, 2, 3, 7, 16):
+            parser = FrameParser(TestTransport(self.get_stream(), size))
+            self.check_frames(parser)
+
+    def test_connection_closed(self):
+        parser = FrameParser(TestTransport(self.COMMAND_REPLY[:-1], 8))
+        self.assertRaises(ConnectError, parser.read_frame)
+
+    def test_max_header_size(self):
+        parser = FrameParser(TestTransport("X-Header: x\n" * 100, 64),
+                             max_header_size=256)
+        self.assertRaises(LimitExceededError, parser.read_frame)
+
+    def test_content_length(self):
+        self.assertEquals(get_content_length("Content-Length: 491\n"), 491)
+        self.assertEquals(get_content_length("Content-Type: x\nContent-Length: 12"), 12)
+        self.assertEquals(get_content_length("Content-Type: x\n"), 0)
+        self.assertEquals(get_content_length("Content-Length: abc\n"), 0)
@@ -2,8 +2,12 @@
 # Copyright (c) 2011 Plivo Team. See LICENSE for details.
 
 from unittest import TestCase
+from urllib import unquote
 
-from plivo.core.freeswitch.inboundsocket import InboundEventSocket
+import ujson as json
+
+from plivo.core.freeswitch.inboundsocket import InboundEventSocket, \
+                                            InboundEventSocketPool, CallSession
 from plivo.core.freeswitch.eventtypes import Event
 from plivo.core.errors import ConnectError
 import gevent
@@ -21,6 +25,7 @@ class TestClient(object):
         self.fd = self.socket.makefile()
         self.auth = False
         self.event_plain = False
+        self.event_json = False
 
     def send(self, msg):
         self.fd.write(msg)
@@ -40,8 +45,8 @@ class TestEventSocketServer(object):
     '''
     Test inbound socket server.
     '''
-    def __init__(self):
-        self.server = StreamServer(('127.0.0.1', 18021), self.emulate)
+    def __init__(self, port=18021):
+        self.server = StreamServer(('127.0.0.1', port), self.emulate)
 
     def start(self):
         self.server.serve_forever()
@@ -87,12 +92,17 @@ class TestEventSocketServer(object):
                     if buff.startswith('exit'):
                         self.disconnect(client)
                         return
-            if client.event_plain is True:
+            if client.event_plain is True or client.event_json is True:
                 break
-        if client.event_plain is False:
+        if client.event_plain is False and client.event_json is False:
             self.disconnect(client)
             return
 
+        self.send_events(client)
+        self.disconnect(client)
+        return
+
+    def send_events(self, client):
         # send fake heartbeat and re_schedule events to client 10 times
         for i in range(10):
             self.send_heartbeat(client)
@@ -100,19 +110,28 @@ class TestEventSocketServer(object):
             self.send_re_schedule(client)
             gevent.sleep(0.01)
 
-        self.disconnect(client)
-        return
-
     def disconnect(self, client):
         client.send("Content-Type: text/disconnect-notice\nContent-Length: 67\n\nDisconnected, goodbye.\nSee you at ClueCon! http://www.cluecon.com/\n\n")
         client.close()
 
+    def send_event(self, client, event):
+        if client.event_json:
+            headers = {}
+            for line in event.splitlines():
+                if line:
+                    var, val = line.split(': ', 1)
+                    headers[var] = unquote(val)
+            body = json.dumps(headers)
+            content_type = "text/event-json"
+        else:
+            body = event
+            content_type = "text/event-plain"
+        client.send("Content-Length: %d\nContent-Type: %s\n\n%s" \
+                    % (len(body), content_type, body))
+
     def send_heartbeat(self, client):
         msg = \
-"""Content-Length: 630
-Content-Type: text/event-plain
-
-Event-Name: HEARTBEAT
+"""Event-Name: HEARTBEAT
 Core-UUID: 12640749-db62-421c-beac-4863eac76510
 FreeSWITCH-Hostname: vocaldev
 FreeSWITCH-IPv4: 10.0.0.108
@@ -131,14 +150,11 @@ Session-Since-Startup: 0
 Idle-CPU: 100.000000
 
 """
-        client.send(msg)
+        self.send_event(client, msg)
 
     def send_re_schedule(self, client):
         msg = \
-"""Content-Length: 491
-Content-Type: text/event-plain
-
-Event-Name: RE_SCHEDULE
+"""Event-Name: RE_SCHEDULE
 Core-UUID: 12640749-db62-421c-beac-4863eac76510
 FreeSWITCH-Hostname: vocaldev
 FreeSWITCH-IPv4: 10.0.0.108
@@ -155,7 +171,7 @@ Task-Group: core
 Task-Runtime: 1294132816
 
 """
-        client.send(msg)
+        self.send_event(client, msg)
 
     def check_auth(self, client, buff):
         # auth request
@@ -178,6 +194,10 @@ Task-Runtime: 1294132816
             client.event_plain = True
             client.send("Content-Type: command/reply\nReply-Text: +OK event listener enabled plain\n\n")
             return True
+        elif buff.startswith('event json'):
+            client.event_json = True
+            client.send("Content-Type: command/reply\nReply-Text: +OK event listener enabled json\n\n")
+            return True
         return False
 
 
@@ -251,3 +271,105 @@ class TestInboundCase(TestCase):
             self.assertEquals(ev.get_header('Event-Name'), 'HEARTBEAT')
         for ev in isock.re_schedule_events:
             self.assertEquals(ev.get_header('Event-Name'), 'RE_SCHEDULE')
+
+    def test_pool(self):
+        pool = InboundEventSocketPool('127.0.0.1', 18021, 'ClueCon', size=2,
+                                      check_timeout=1)
+        try:
+            pool.check()
+            self.assertEquals(pool.get_connected_count(), 2)
+            # Test server never answers api, so first socket stays busy
+            busy = pool.get_socket()
+            busy.api_async('status')
+            self.assertTrue(pool.get_socket() is not busy)
+            # Not responding socket is reconnected
+            pool.check()
+            self.assertEquals(pool.get_connected_count(), 2)
+            self.assertEquals(busy.get_pending_count(), 0)
+        finally:
+            pool.stop()
+        self.assertEquals(pool.get_connected_count(), 0)
+        self.assertRaises(ConnectError, pool.get_socket)
+
+    def test_pool_check_errors(self):
+        pool = InboundEventSocketPool('127.0.0.1', 18021, 'ClueCon', size=2,
+                                      check_timeout=1)
+        def connect():
+            raise socket.error("connect failed")
+        pool.sockets[0].connect = connect
+        try:
+            # Other errors than ConnectError don't stop checks
+            pool.check()
+            self.assertEquals(pool.get_connected_count(), 1)
+            self.assertTrue(pool.get_socket() is pool.sockets[1])
+        finally:
+            pool.stop()
+
+    def test_pool_check_concurrent(self):
+        pool = InboundEventSocketPool('127.0.0.1', 18021, 'ClueCon', size=3,
+                                      check_timeout=1)
+        try:
+            pool.check()
+            # Test server never answers api, all sockets time out
+            for sock in pool.sockets:
+                sock.api_async('status')
+            timer = Timeout(2)
+            timer.start()
+            try:
+                pool.check()
+            except Timeout:
+                self.fail("sockets checked one at a time")
+            finally:
+                timer.cancel()
+            self.assertEquals(pool.get_connected_count(), 3)
+        finally:
+            pool.stop()
+
+
+class TestWriteTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class TestCallSession(TestCase):
+    '''
+    Test case for call sessions on Inbound Event Socket.
+    '''
+    def make_event(self, name, uuid):
+        ev = Event()
+        ev['Event-Name'] = name
+        ev['Unique-ID'] = uuid
+        return ev
+
+    def test_demultiplex(self):
+        isock = TestInboundEventSocket('127.0.0.1', 18021, 'ClueCon')
+        dispatched = []
+        isock.dispatch_event = dispatched.append
+        isock._spawn = lambda func, ev: func(ev)
+        session = isock.open_session('1234')
+        self.assertTrue(isinstance(session, CallSession))
+        self.assertTrue(isock.open_session('1234') is session)
+        isock.route_event(self.make_event('CHANNEL_ANSWER', '1234'))
+        isock.route_event(self.make_event('CHANNEL_ANSWER', '5678'))
+        isock.route_event(self.make_event('CHANNEL_HANGUP_COMPLETE', '1234'))
+        self.assertEquals([ev['Unique-ID'] for ev in dispatched], ['5678'])
+        self.assertEquals(isock.get_session_count(), 0)
+        self.assertEquals(session.get_event()['Event-Name'], 'CHANNEL_ANSWER')
+        self.assertEquals(session.get_event()['Event-Name'], 'CHANNEL_HANGUP_COMPLETE')
+        self.assertEquals(session.get_event(), None)
+        self.assertEquals(session.get_event(), None)
+
+    def test_sendmsg(self):
+        isock = InboundEventSocket('127.0.0.1', 18021, 'ClueCon')
+        isock.transport = TestWriteTransport()
+        session = isock.open_session('1234')
+        gevent.spawn(session.answer)
+        gevent.sleep(0)
+        self.assertTrue(isock.transport.written[0].startswith("sendmsg 1234\n"))
+        self.assertEquals(isock.get_pending_count(), 1)
+        self.assertEquals(session.get_event(timeout=0.01), None)
+        session.close()
+        self.assertEquals(isock.get_session('1234'), None)
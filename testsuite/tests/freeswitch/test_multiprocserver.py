@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+import os
+import socket
+import time
+
+import _multiprocessing
+import gevent
+
+from plivo.core.freeswitch.multiprocserver import OutboundServer, Process
+
+
+class PidHandler(object):
+    '''
+    Replies process pid.
+    '''
+    def __init__(self, sock, address, filter):
+        sock.sendall(str(os.getpid()))
+        sock.close()
+
+
+class SlowPidHandler(object):
+    '''
+    Replies process pid, stays busy 0.5 second.
+    '''
+    def __init__(self, sock, address, filter):
+        sock.sendall(str(os.getpid()))
+        time.sleep(0.5)
+        sock.close()
+
+
+def run_server(address, pool_size, max_calls, pool_max=0,
+               handler=PidHandler, overload='close'):
+    server = OutboundServer(address, handler, pool_size=pool_size,
+                            max_calls=max_calls, pool_max=pool_max,
+                            overload=overload)
+    server.start()
+    server.loop()
+
+
+class TestProcessPool(TestCase):
+    def setUp(self):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.address = probe.getsockname()
+        probe.close()
+
+    def start_server(self, pool_size=0, max_calls=0, pool_max=0,
+                     handler=PidHandler, overload='close'):
+        self.server = Process(target=run_server,
+                              args=(self.address, pool_size, max_calls,
+                                    pool_max, handler, overload))
+        self.server.start()
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.join()
+
+    def connect(self):
+        for i in range(50):
+            try:
+                return socket.create_connection(self.address)
+            except socket.error:
+                gevent.sleep(0.1)
+
+    def request(self):
+        return int(self.connect().recv(64) or 0)
+
+    def test_fork_per_call(self):
+        self.start_server()
+        pids = [ self.request() for i in range(3) ]
+        self.assertEquals(len(set(pids)), 3)
+        self.assertFalse(self.server.pid in pids)
+
+    def test_pool_recycle(self):
+        self.start_server(pool_size=2, max_calls=2)
+        pids = [ self.request() for i in range(6) ]
+        self.assertFalse(self.server.pid in pids)
+        # Workers are reused, and replaced after 2 calls
+        self.assertTrue(len(set(pids)) < 6)
+        self.assertEquals(max([ pids.count(pid) for pid in pids ]), 2)
+
+    def test_pool_grow(self):
+        self.start_server(pool_size=1, handler=SlowPidHandler)
+        pids = [ self.request() for i in range(3) ]
+        # All busy workers, new ones are started
+        self.assertEquals(len(set(pids)), 3)
+        gevent.sleep(1)
+        # Extra workers exited once idle, the remaining one is reused
+        self.assertTrue(self.request() in pids)
+
+    def test_pool_max(self):
+        self.start_server(pool_size=1, pool_max=2, handler=SlowPidHandler)
+        pids = [ self.request() for i in range(3) ]
+        # Third connection is rejected (closed)
+        self.assertEquals(len(set(pids[:2])), 2)
+        self.assertEquals(pids[2], 0)
+
+    def test_pool_max_hangup(self):
+        self.start_server(pool_size=1, pool_max=1, handler=SlowPidHandler,
+                          overload='hangup')
+        self.assertTrue(self.request())
+        # Rejected call is hung up by the rejecter process
+        sock = self.connect()
+        sock.settimeout(5)
+        self.assertEquals(sock.recv(64).strip(), 'connect')
+
+
+def serve_worker(channel, server_channel):
+    server = OutboundServer(('127.0.0.1', 0), PidHandler)
+    server.socket = socket.socket()
+    server.serve_pool(channel, server_channel)
+
+
+class TestPoolWorker(TestCase):
+    def test_server_gone(self):
+        channel, server_channel = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_STREAM)
+        worker = Process(target=serve_worker, args=(channel, server_channel))
+        worker.start()
+        channel.close()
+        conn, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        _multiprocessing.sendfd(server_channel.fileno(), conn.fileno())
+        conn.close()
+        server_channel.close()
+        # Worker handles the connection, then exits without error
+        self.assertTrue(int(peer.recv(64)))
+        worker.join(5)
+        self.assertEquals(worker.exitcode, 0)
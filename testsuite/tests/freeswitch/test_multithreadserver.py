@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+import socket
+
+import gevent
+from gevent.event import Event
+
+from plivo.core.freeswitch.multithreadserver import OutboundServer
+
+
+class WaitHandler(object):
+    '''
+    Replies 'ok' once the test releases it.
+    '''
+    release = None
+
+    def __init__(self, sock, address, filter):
+        self.release.wait()
+        sock.sendall('ok')
+
+
+def read_command(fp):
+    '''
+    Reads a command sent to FreeSWITCH, returns its headers and body lines
+    '''
+    lines = []
+    length = 0
+    while True:
+        line = fp.readline()
+        if not line:
+            return None
+        if line == '\n':
+            break
+        lines.append(line.strip())
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    if length:
+        lines.extend(fp.read(length + 2).split())
+    return lines
+
+
+class TestThreadServer(TestCase):
+    def start_server(self, **kwargs):
+        WaitHandler.release = Event()
+        self.server = OutboundServer(('127.0.0.1', 0), WaitHandler,
+                                     pool_size=1, queue_size=1, **kwargs)
+        self.server.start()
+        self.address = self.server.socket.getsockname()
+        self.loop = gevent.spawn(self.server.loop)
+
+    def tearDown(self):
+        WaitHandler.release.set()
+        self.server.kill()
+        self.loop.kill()
+        self.server.socket.close()
+
+    def test_overload_close(self):
+        self.start_server()
+        socks = [ socket.create_connection(self.address) for i in range(3) ]
+        gevent.sleep(0.1)
+        self.assertEquals(self.server.get_stats(),
+                          {'active': 1, 'queued': 1, 'rejected': 1})
+        # Rejected connection is closed
+        self.assertEquals(socks[2].recv(64), '')
+        # Kill doesn't block on a full queue, queued connections are handled
+        with gevent.Timeout(1):
+            self.server.kill()
+        WaitHandler.release.set()
+        self.assertEquals([ s.recv(64) for s in socks[:2] ], ['ok', 'ok'])
+        gevent.sleep(0.1)
+        self.assertEquals(self.server.get_active_count(), 0)
+
+    def test_overload_hangup(self):
+        self.start_server(overload='hangup')
+        socks = [ socket.create_connection(self.address) for i in range(3) ]
+        fp = socks[2].makefile('rb')
+        commands = []
+        while True:
+            headers = read_command(fp)
+            if headers is None:
+                break
+            commands.append(headers)
+            if headers == ['connect']:
+                socks[2].sendall('Content-Type: command/reply\n'
+                                 'Reply-Text: +OK\nUnique-ID: 1234\n\n')
+            else:
+                socks[2].sendall('Content-Type: command/reply\n'
+                                 'Reply-Text: +OK\n\n')
+            if 'execute-app-name: hangup' in headers:
+                socks[2].close()
+                break
+        # Same policy as spawn server, hung up with USER_BUSY
+        self.assertEquals(commands[0], ['connect'])
+        self.assertTrue('execute-app-name: hangup' in commands[-1])
+        self.assertTrue('USER_BUSY' in commands[-1])
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+import gevent
+from gevent import socket
+from gevent.event import Event
+
+from plivo.core.freeswitch.outboundsocket import OutboundServer, TokenBucket
+
+
+class WaitHandler(object):
+    '''
+    Replies 'ok' once the test releases it.
+    '''
+    release = None
+
+    def __init__(self, sock, address, filter):
+        self.release.wait()
+        sock.sendall('ok')
+
+
+def read_command(fp):
+    '''
+    Reads a command sent to FreeSWITCH, returns its headers
+    '''
+    headers = []
+    length = 0
+    while True:
+        line = fp.readline()
+        if not line:
+            return None
+        if line == '\n':
+            break
+        headers.append(line.strip())
+        if line.lower().startswith('content-length:'):
+            length = int(line.split(':', 1)[1])
+    if length:
+        fp.read(length + 2)
+    return headers
+
+
+class TestTokenBucket(TestCase):
+    def test_consume(self):
+        bucket = TokenBucket(1000, 2)
+        self.assertEquals([ bucket.consume() for i in range(3) ],
+                          [True, True, False])
+        gevent.sleep(0.01)
+        self.assertTrue(bucket.consume())
+
+
+class TestOutboundServer(TestCase):
+    def start_server(self, **kwargs):
+        WaitHandler.release = Event()
+        self.server = OutboundServer(('127.0.0.1', 0), WaitHandler, **kwargs)
+        self.server.start()
+        self.address = self.server.server_host, self.server.server_port
+
+    def tearDown(self):
+        WaitHandler.release.set()
+        self.server.stop()
+
+    def test_max_sessions(self):
+        self.start_server(max_sessions=2)
+        socks = [ socket.create_connection(self.address) for i in range(3) ]
+        gevent.sleep(0.1)
+        # Rejected connection is closed
+        self.assertEquals(socks[2].recv(64), '')
+        WaitHandler.release.set()
+        self.assertEquals([ s.recv(64) for s in socks[:2] ], ['ok', 'ok'])
+        gevent.sleep(0.1)
+        self.assertEquals(self.server.get_stats(),
+                          {'active': 0, 'accepted': 2,
+                           'rejected_sessions': 1, 'rejected_rate': 0})
+
+    def test_rate_busy(self):
+        self.start_server(rate=0.01, burst=1, overload='busy')
+        WaitHandler.release.set()
+        self.assertEquals(socket.create_connection(self.address).recv(64), 'ok')
+        sock = socket.create_connection(self.address)
+        fp = sock.makefile('rb')
+        commands = []
+        while True:
+            headers = read_command(fp)
+            if headers is None:
+                break
+            commands.append(headers)
+            if headers == ['connect']:
+                sock.sendall('Content-Type: command/reply\n'
+                             'Reply-Text: +OK\nUnique-ID: 1234\n\n')
+            else:
+                sock.sendall('Content-Type: command/reply\n'
+                             'Reply-Text: +OK\n\n')
+            if 'execute-app-name: hangup' in headers:
+                sock.close()
+                break
+        apps = [ h for c in commands for h in c
+                 if h.startswith('execute-app-name') ]
+        self.assertEquals(apps, ['execute-app-name: set',
+                                 'execute-app-name: playback',
+                                 'execute-app-name: hangup'])
+        gevent.sleep(0.1)
+        self.assertEquals(self.server.rejected_rate, 1)
+
+    def test_do_handle_subclass(self):
+        class LegacyServer(OutboundServer):
+            def do_handle(self, sock, address):
+                sock.sendall('legacy')
+        self.server = LegacyServer(('127.0.0.1', 0), WaitHandler,
+                                   max_sessions=1)
+        WaitHandler.release = Event()
+        self.server.start()
+        address = self.server.server_host, self.server.server_port
+        # do_handle is still the call hook, after admission control
+        self.assertEquals(socket.create_connection(address).recv(64), 'legacy')
+        self.assertEquals(self.server.get_stats()['accepted'], 1)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+import os
+import signal
+import socket
+
+import gevent
+
+from plivo.core.freeswitch.preforkserver import OutboundServer
+
+
+class PidHandler(object):
+    '''
+    Replies worker pid, after the delay sent by client.
+    '''
+    def __init__(self, sock, address, filter):
+        delay = float(sock.recv(64))
+        gevent.sleep(delay)
+        sock.sendall(str(os.getpid()))
+        sock.close()
+
+
+class TestPreforkServer(TestCase):
+    def setUp(self):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        self.address = probe.getsockname()
+        probe.close()
+        self.server = OutboundServer(self.address, PidHandler, workers=2,
+                                     drain_timeout=5)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.kill()
+
+    def request(self, delay=0):
+        for i in range(50):
+            try:
+                sock = socket.create_connection(self.address)
+                break
+            except socket.error:
+                gevent.sleep(0.1)
+        sock.sendall(str(delay))
+        return sock
+
+    def test_respawn_and_drain(self):
+        pid = int(self.request().recv(64))
+        self.assertTrue(pid in [ p.pid for p in self.server._workers.values() ])
+        os.kill(pid, signal.SIGKILL)
+        gevent.sleep(0.2)
+        self.assertEquals(len(self.server.check_workers()), 1)
+        self.assertTrue(pid not in [ p.pid for p in self.server._workers.values() ])
+        # Calls in progress finish when server stops
+        sock = self.request(0.5)
+        gevent.sleep(0.2)
+        self.server.kill()
+        self.assertTrue(int(sock.recv(64)) > 0)
+        self.assertFalse([ p for p in self.server._workers.values()
+                           if p.is_alive() ])
+
+    def test_max_sessions(self):
+        self.server.kill()
+        self.server = OutboundServer(self.address, PidHandler, workers=1,
+                                     drain_timeout=5, max_sessions=1)
+        self.server.start()
+        busy = self.request(0.5)
+        gevent.sleep(0.2)
+        # Worker is busy, next call is rejected, connection is closed
+        try:
+            data = self.request().recv(64)
+        except socket.error:
+            data = ''
+        self.assertEquals(data, '')
+        self.assertTrue(int(busy.recv(64)) > 0)
+        self.assertTrue(int(self.request().recv(64)) > 0)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+import gevent
+
+from plivo.core.freeswitch.eventtypes import Event
+from plivo.core.freeswitch.scheduler import DispatchScheduler, HIGH, LOW
+
+
+def make_event(name, uuid='', state=''):
+    ev = Event()
+    ev['Event-Name'] = name
+    ev['Unique-ID'] = uuid
+    ev['Channel-State'] = state
+    return ev
+
+
+class TestDispatchScheduler(TestCase):
+    def test_priorities(self):
+        scheduler = DispatchScheduler(priorities={'CHANNEL_HANGUP': HIGH,
+                                                  'CHANNEL_STATE': LOW})
+        scheduler.put(make_event('CHANNEL_STATE'))
+        scheduler.put(make_event('CHANNEL_PROGRESS'))
+        scheduler.put(make_event('CHANNEL_HANGUP'))
+        names = [ scheduler.get()['Event-Name'] for x in range(3) ]
+        self.assertEquals(names, ['CHANNEL_HANGUP', 'CHANNEL_PROGRESS', 'CHANNEL_STATE'])
+        self.assertEquals(scheduler.get(), None)
+
+    def test_limits(self):
+        scheduler = DispatchScheduler(limits={'CHANNEL_STATE': 2})
+        for x in range(5):
+            scheduler.put(make_event('CHANNEL_STATE'))
+        scheduler.put(make_event('CHANNEL_HANGUP'))
+        stats = scheduler.get_stats()
+        self.assertEquals(stats['depth'], 3)
+        self.assertEquals(stats['dropped'], {'CHANNEL_STATE': 3})
+        scheduler.get()
+        self.assertTrue(scheduler.put(make_event('CHANNEL_STATE')))
+
+    def test_coalesce(self):
+        scheduler = DispatchScheduler(coalesce=['CHANNEL_PROGRESS'])
+        scheduler.put(make_event('CHANNEL_PROGRESS', 'a', 'first'))
+        scheduler.put(make_event('CHANNEL_PROGRESS', 'b'))
+        self.assertFalse(scheduler.put(make_event('CHANNEL_PROGRESS', 'a', 'last')))
+        self.assertEquals(scheduler.get_stats()['coalesced'], {'CHANNEL_PROGRESS': 1})
+        ev = scheduler.get()
+        self.assertEquals((ev['Unique-ID'], ev['Channel-State']), ('a', 'last'))
+        self.assertEquals(scheduler.get()['Unique-ID'], 'b')
+        # Not queued anymore, so not coalesced
+        self.assertTrue(scheduler.put(make_event('CHANNEL_PROGRESS', 'a')))
+
+    def test_workers(self):
+        handled = []
+        scheduler = DispatchScheduler(size=2, priorities={'CHANNEL_HANGUP': HIGH})
+        for x in range(10):
+            scheduler.put(make_event('CHANNEL_STATE'))
+        scheduler.put(make_event('CHANNEL_HANGUP'))
+        scheduler.start(lambda ev: handled.append(ev['Event-Name']))
+        gevent.sleep(0.01)
+        scheduler.stop()
+        self.assertEquals(len(handled), 11)
+        self.assertEquals(handled[0], 'CHANNEL_HANGUP')
+        self.assertEquals(scheduler.get_stats()['dispatched'], 11)
+
+    def test_call_order(self):
+        scheduler = DispatchScheduler(priorities={'CHANNEL_HANGUP': HIGH,
+                                                  'CHANNEL_STATE': LOW})
+        scheduler.put(make_event('CHANNEL_STATE', 'a'))
+        scheduler.put(make_event('CHANNEL_PROGRESS', 'b'))
+        scheduler.put(make_event('CHANNEL_PROGRESS', 'a'))
+        scheduler.put(make_event('CHANNEL_HANGUP', 'a'))
+        # Call a is served first, but its events stay in order
+        events = [ scheduler.get() for x in range(4) ]
+        self.assertEquals([ (ev['Unique-ID'], ev['Event-Name']) for ev in events ],
+                          [('a', 'CHANNEL_STATE'), ('a', 'CHANNEL_PROGRESS'),
+                           ('a', 'CHANNEL_HANGUP'), ('b', 'CHANNEL_PROGRESS')])
+        self.assertEquals(scheduler.get(), None)
+        self.assertEquals(scheduler.get_queue_depth(), 0)
+
+    def test_keep(self):
+        scheduler = DispatchScheduler(limits={'CHANNEL_STATE': 1},
+                        keep=lambda ev: ev['Channel-State'] == 'CS_RESET')
+        scheduler.put(make_event('CHANNEL_STATE', 'a', 'CS_ROUTING'))
+        self.assertFalse(scheduler.put(make_event('CHANNEL_STATE', 'a', 'CS_EXECUTE')))
+        self.assertTrue(scheduler.put(make_event('CHANNEL_STATE', 'a', 'CS_RESET')))
+
+    def test_workers_call_order(self):
+        handled = []
+        def handler(ev):
+            if ev['Channel-State'] == 'error':
+                raise ValueError("handler error")
+            # Next event of call must wait for this one
+            gevent.sleep(0.01 * (3 - len(handled)))
+            handled.append(ev['Channel-State'])
+        scheduler = DispatchScheduler(size=3)
+        scheduler.put(make_event('CHANNEL_STATE', 'a', 'error'))
+        for x in range(3):
+            scheduler.put(make_event('CHANNEL_STATE', 'a', str(x)))
+        scheduler.start(handler)
+        gevent.sleep(0.1)
+        scheduler.stop()
+        self.assertEquals(handled, ['0', '1', '2'])
+        self.assertEquals(scheduler.get_stats()['errors'], 1)
+
+    def test_handler_error_logged(self):
+        errors = []
+        class Log(object):
+            def error(self, msg):
+                errors.append(msg)
+        def handler(ev):
+            raise ValueError("handler error")
+        scheduler = DispatchScheduler(size=1)
+        scheduler.put(make_event('CHANNEL_STATE', 'a', 'error'))
+        scheduler.start(handler, Log())
+        gevent.sleep(0.05)
+        scheduler.stop()
+        self.assertEquals(len(errors), 1)
+        self.assertTrue('Traceback' in errors[0])
+        self.assertTrue('ValueError: handler error' in errors[0])
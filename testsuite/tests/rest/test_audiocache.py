@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import gevent
+
+from plivo.rest.freeswitch.audiocache import AudioCache
+from plivo.rest.freeswitch.elements import get_prefetched_audio_path
+
+
+AUDIO = 'ID3' + 'x' * 1000
+
+
+class TestAudioHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if not self.path.endswith('.mp3'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path.endswith('/error.mp3'):
+            # Error page served with a success status
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            self.wfile.write('<html>Not found</html>')
+            return
+        audio = self.server.audio
+        etag = '"%d"' % len(audio)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(audio)))
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.end_headers()
+        self.wfile.write(audio)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAudioCache(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), TestAudioHandler)
+        self.server.requests = []
+        self.server.audio = AUDIO
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_fetch(self):
+        cache = AudioCache(self.directory)
+        url = self.url + 'hello.mp3'
+        self.assertEquals(cache.lookup(url), None)
+        # Concurrent prefetches share one download
+        first = cache.prefetch(url)
+        self.assertTrue(cache.prefetch(url) is first)
+        path = first.get(timeout=5)
+        self.assertEquals(open(path).read(), AUDIO)
+        self.assertEquals(cache.lookup(url), path)
+        self.assertEquals(cache.fetch(url), path)
+        self.assertEquals(len(self.server.requests), 1)
+        self.assertEquals(cache.fetch(self.url + 'missing.wav'), None)
+        self.assertEquals(sorted(os.listdir(self.directory)),
+                          [os.path.basename(path), os.path.basename(path) + '.meta'])
+
+    def test_not_audio(self):
+        cache = AudioCache(self.directory)
+        self.assertEquals(cache.fetch(self.url + 'error.mp3'), None)
+        self.assertEquals(os.listdir(self.directory), [])
+
+    def test_evict_interval(self):
+        cache = AudioCache(self.directory, evict_interval=60)
+        scans = []
+        evict = cache.evict
+        cache.evict = lambda: scans.append(1) or evict()
+        cache.fetch(self.url + '1.mp3')
+        cache.fetch(self.url + '2.mp3')
+        # Size is counted from downloads, directory is scanned once
+        self.assertEquals(len(scans), 1)
+        self.assertEquals(cache._size, len(AUDIO) * 2)
+        cache._evicted -= 120
+        cache.fetch(self.url + '3.mp3')
+        self.assertEquals(len(scans), 2)
+
+    def test_revalidate(self):
+        cache = AudioCache(self.directory, ttl=60)
+        url = self.url + 'hello.mp3'
+        path = cache.fetch(url)
+        expired = time.time() - 120
+        os.utime(path + '.meta', (expired, expired))
+        # Expired file is played while revalidated in background
+        self.assertEquals(cache.lookup(url), path)
+        cache.prefetch(url).get(timeout=5)
+        self.assertEquals(len(self.server.requests), 2)
+        self.assertFalse(cache.is_expired(path))
+        self.assertEquals(open(path).read(), AUDIO)
+        # Changed file is downloaded again
+        self.server.audio = AUDIO + 'new'
+        os.utime(path + '.meta', (expired, expired))
+        self.assertEquals(cache.fetch(url), path)
+        self.assertEquals(open(path).read(), AUDIO + 'new')
+
+    def test_evict(self):
+        cache = AudioCache(self.directory, max_size=len(AUDIO) * 2, grace=5)
+        first = cache.fetch(self.url + '1.mp3')
+        second = cache.fetch(self.url + '2.mp3')
+        # First becomes most recently used
+        os.utime(second, (time.time() - 10, time.time() - 10))
+        cache.lookup(self.url + '1.mp3')
+        cache.fetch(self.url + '3.mp3')
+        self.assertEquals(cache.lookup(self.url + '2.mp3'), None)
+        self.assertEquals(cache.lookup(self.url + '1.mp3'), first)
+        self.assertEquals(cache.get_size(), len(AUDIO) * 2)
+        self.assertFalse(os.path.exists(second + '.meta'))
+        # Files used recently are kept, even over max size
+        cache.fetch(self.url + '4.mp3')
+        self.assertEquals(cache.get_size(), len(AUDIO) * 3)
+        # Left over .tmp files are removed
+        tmp = os.path.join(self.directory, 'left.tmp')
+        open(tmp, 'w').close()
+        cache.evict()
+        self.assertTrue(os.path.exists(tmp))
+        os.utime(tmp, (time.time() - 60, time.time() - 60))
+        cache.evict()
+        self.assertFalse(os.path.exists(tmp))
+
+    def test_prefetched_audio_path(self):
+        cache = AudioCache(self.directory)
+        url = self.url + 'hello.mp3'
+        slow = gevent.spawn(gevent.sleep, 5)
+        cache._downloads[url] = slow
+        # Not downloaded soon enough, download keeps running
+        start = time.time()
+        self.assertEquals(get_prefetched_audio_path(url, cache, 0.05), None)
+        self.assertTrue(time.time() - start < 1)
+        self.assertFalse(slow.ready())
+        slow.kill()
+        del cache._downloads[url]
+        path = get_prefetched_audio_path(url, cache, 5)
+        self.assertEquals(path, cache.get_path(url))
+        self.assertEquals(get_prefetched_audio_path(url, cache, 0), path)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+import base64
+
+from plivo.rest.freeswitch import auth
+from plivo.rest.freeswitch.auth import RestAuth
+
+
+def basic(auth_id, auth_token):
+    return 'Basic %s' % base64.b64encode('%s:%s' % (auth_id, auth_token))
+
+
+class TestRestAuth(TestCase):
+    def test_check_ip(self):
+        rest_auth = RestAuth(allowed_ips='127.0.0.1, 10.1.0.0/16,192.168.1.8/30')
+        for ip in ('127.0.0.1', ' 127.0.0.1', '10.1.255.3', '192.168.1.11'):
+            self.assertTrue(rest_auth.check_ip(ip), ip)
+        for ip in ('127.0.0.2', '10.2.0.1', '192.168.1.12', '::1', 'foo'):
+            self.assertFalse(rest_auth.check_ip(ip), ip)
+        self.assertTrue(RestAuth().check_ip('10.0.0.1'))
+        self.assertRaises(ValueError, RestAuth, allowed_ips='10.0.0.0/33')
+
+    def test_check_authorization(self):
+        rest_auth = RestAuth('id', 'to:ken')
+        self.assertTrue(rest_auth.check_authorization(basic('id', 'to:ken')))
+        for header in (None, '', basic('id', 'token'), basic('ID', 'to:ken'),
+                       'Basic', 'Basic !!!', 'Digest %s' % basic('id', 'to:ken')[6:]):
+            self.assertFalse(rest_auth.check_authorization(header), header)
+        self.assertTrue(RestAuth('id', '').check_authorization(None))
+
+    def test_cache(self):
+        rest_auth = RestAuth('id', 'token')
+        header = basic('id', 'token')
+        self.assertTrue(rest_auth.check_authorization(header))
+        self.assertTrue(rest_auth._cache[header])
+        size = auth.CACHE_SIZE
+        auth.CACHE_SIZE = 2
+        try:
+            rest_auth.check_authorization(basic('a', 'b'))
+            rest_auth.check_authorization(basic('c', 'd'))
+            self.assertTrue(header in rest_auth._previous)
+            # Used again, moved back to current results
+            self.assertTrue(rest_auth.check_authorization(header))
+            self.assertTrue(rest_auth._cache[header])
+        finally:
+            auth.CACHE_SIZE = size
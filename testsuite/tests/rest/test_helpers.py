@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+import httplib
+import socket
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import gevent
+
+from plivo.rest.freeswitch.helpers import HTTPRequest, HTTPResponseCache, \
+                                          HTTPConnectionPool, URLChecker
+
+
+RESTXML = '<Response><Speak>Hello</Speak></Response>'
+
+
+class TestHTTPHandler(BaseHTTPRequestHandler):
+    '''
+    Answers RESTXML with headers set by the test.
+    '''
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append(self.headers.get('If-None-Match'))
+        etag = self.server.headers.get('ETag')
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        for key, value in self.server.headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(RESTXML)))
+        self.end_headers()
+        self.wfile.write(RESTXML)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPResponseCache(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), TestHTTPHandler)
+        self.server.requests = []
+        self.server.headers = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/answer/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, cache, **params):
+        return HTTPRequest('id', 'token').fetch_response(self.url, params,
+                                                         'POST', cache)
+
+    def test_max_age(self):
+        self.server.headers = {'Cache-Control': 'max-age=60'}
+        cache = HTTPResponseCache(params=['Digits'])
+        self.assertEquals(self.fetch(cache, CallUUID='1', Digits='1'), RESTXML)
+        self.assertEquals(self.fetch(cache, CallUUID='2', Digits='1'), RESTXML)
+        self.fetch(cache, CallUUID='3', Digits='2')
+        self.assertEquals(len(self.server.requests), 2)
+        self.assertEquals(cache.get_stats(), {'size': 2, 'hits': 1, 'misses': 2,
+                                              'revalidations': 0})
+
+    def test_etag(self):
+        self.server.headers = {'ETag': '"v1"'}
+        cache = HTTPResponseCache()
+        self.fetch(cache)
+        self.assertEquals(self.fetch(cache), RESTXML)
+        self.assertEquals(self.server.requests, [None, '"v1"'])
+        self.assertEquals(cache.get_stats()['revalidations'], 1)
+
+    def test_not_cacheable(self):
+        cache = HTTPResponseCache(ttl=60)
+        self.server.headers = {'Cache-Control': 'no-store'}
+        self.fetch(cache)
+        self.fetch(cache)
+        self.assertEquals(len(self.server.requests), 2)
+        self.assertEquals(cache.get_stats()['size'], 0)
+
+    def test_lru(self):
+        cache = HTTPResponseCache(size=2, ttl=60)
+        headers = {}
+        cache.put(cache.get_key('GET', 'a', {}), 'a', headers)
+        cache.put(cache.get_key('GET', 'b', {}), 'b', headers)
+        cache.get(cache.get_key('GET', 'a', {}))
+        cache.put(cache.get_key('GET', 'c', {}), 'c', headers)
+        self.assertEquals(cache.get(cache.get_key('GET', 'b', {})), None)
+        self.assertEquals(cache.get(cache.get_key('GET', 'a', {})).body, 'a')
+
+
+class TestKeepAliveHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP/1.1 handler, counts connections.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def drop(self):
+        # Closes connection without response, once asked by test
+        if self.server.drops:
+            self.server.drops -= 1
+            self.close_connection = True
+            return True
+        return False
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.posts += 1
+        if self.drop():
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.drop():
+            return
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/answer/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(RESTXML)))
+        self.end_headers()
+        self.wfile.write(RESTXML)
+
+    def do_HEAD(self):
+        self.server.heads += 1
+        if self.path.split('?')[0].endswith('.mp3'):
+            self.send_response(200)
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', '1000')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestHTTPConnectionPool(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), TestKeepAliveHandler)
+        self.server.connections = 0
+        self.server.heads = 0
+        self.server.posts = 0
+        self.server.drops = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, pool, path, **params):
+        return HTTPRequest('id', 'token', pool).fetch_response(self.url + path,
+                                                               params, 'GET')
+
+    def test_keep_alive(self):
+        pool = HTTPConnectionPool()
+        for i in range(3):
+            self.assertEquals(self.fetch(pool, 'answer/', CallUUID=str(i)),
+                              RESTXML)
+        self.assertEquals(self.server.connections, 1)
+        self.assertEquals(pool.get_idle_count(), 1)
+        # Redirect is followed on the same connection
+        self.assertEquals(self.fetch(pool, 'redirect/'), RESTXML)
+        self.assertEquals(self.server.connections, 1)
+        pool.close()
+        self.assertEquals(pool.get_idle_count(), 0)
+
+    def test_max_idle(self):
+        pool = HTTPConnectionPool(max_idle=1)
+        # Concurrent requests are not limited
+        responses = [ pool.open('GET', self.url + 'answer/') for i in range(3) ]
+        self.assertEquals([ r.read() for r in responses ], [RESTXML] * 3)
+        for response in responses:
+            response.close()
+        # but only max_idle connections are kept
+        self.assertEquals(self.server.connections, 3)
+        self.assertEquals(pool.get_idle_count(), 1)
+        pool.close()
+
+    def test_retry(self):
+        pool = HTTPConnectionPool()
+        self.fetch(pool, 'answer/')
+        # Connection closed after request was sent, GET is retried
+        self.server.drops = 1
+        self.assertEquals(self.fetch(pool, 'answer/'), RESTXML)
+        self.assertEquals(self.server.connections, 2)
+        # but POST is not, server may have handled it
+        self.server.drops = 1
+        self.assertRaises((httplib.HTTPException, socket.error), pool.request,
+                          'POST', self.url + 'hangup/', 'CallUUID=1',
+                          {'Content-Type': 'application/x-www-form-urlencoded'})
+        self.assertEquals(self.server.posts, 1)
+        pool.close()
+
+    def test_idle_timeout(self):
+        pool = HTTPConnectionPool(idle_timeout=0)
+        self.fetch(pool, 'answer/')
+        self.fetch(pool, 'answer/')
+        self.assertEquals(self.server.connections, 2)
+        pool.close()
+
+
+    def test_url_checker(self):
+        checker = URLChecker(negative_ttl=0)
+        jobs = [ gevent.spawn(checker.exists, self.url + 'hello.mp3')
+                 for i in range(10) ]
+        gevent.joinall(jobs, timeout=5)
+        self.assertEquals([ job.value for job in jobs ], [True] * 10)
+        self.assertEquals(self.server.heads, 1)
+        self.assertTrue(checker.exists(self.url + 'hello.mp3?x=1'))
+        self.assertFalse(checker.exists(self.url + 'missing.wav'))
+        self.assertFalse(checker.exists(self.url + 'missing.wav'))
+        self.assertEquals(self.server.heads, 4)
+        self.assertEquals(checker.get_stats(), {'size': 2, 'hits': 9,
+                                                'misses': 4})
+        self.assertFalse(checker.exists('http://127.0.0.1:1/hello.mp3'))
+        checker.pool.close()
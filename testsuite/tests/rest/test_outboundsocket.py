@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import threading
+import time
+from unittest import TestCase
+
+import gevent
+
+from plivo.rest.freeswitch.outboundsocket import PlivoOutboundEventSocket, \
+                                                 ParsedXMLCache, iter_xml
+from plivo.rest.freeswitch import helpers
+from plivo.rest.freeswitch.helpers import HTTPConnectionPool
+from plivo.rest.freeswitch.exceptions import RESTFormatException, \
+                                             RESTSyntaxException, \
+                                             UnrecognizedElementException
+
+
+RESTXML = '''<Response>
+    <GetDigits action="http://127.0.0.1:5000/digits/" numDigits="1">
+        <Speak>Press 1</Speak>
+    </GetDigits>
+    <Speak>Bye</Speak>
+</Response>'''
+
+PLAY_RESTXML = '<Response><Play>http://127.0.0.1:5000/a.mp3</Play></Response>'
+
+
+class TestLog(object):
+    def debug(self, msg):
+        pass
+
+
+class TestURLChecker(object):
+    exists_result = True
+
+    def exists(self, url):
+        return self.exists_result
+
+
+class TestParser(PlivoOutboundEventSocket):
+    '''
+    Only parses RESTXML, no connection.
+    '''
+    def __init__(self, parsed_xml_cache):
+        self.log = TestLog()
+        self.target_url = 'http://127.0.0.1:5000/answer/'
+        self.xml_response = RESTXML
+        self.parsed_element = []
+        self.lexed_xml_response = []
+        self.parsed_xml_cache = parsed_xml_cache
+        self.audio_cache = None
+        self.session_params = {'Direction': 'outbound'}
+
+    def has_hangup(self):
+        return True
+
+
+class TestParsedXMLCache(TestCase):
+    def test_cache(self):
+        cache = ParsedXMLCache()
+        first = TestParser(cache)
+        first.lex_and_parse_xml()
+        second = TestParser(cache)
+        second.lex_and_parse_xml()
+        self.assertEquals(cache.get_stats(), {'size': 1, 'hits': 1, 'misses': 1})
+        self.assertEquals([ e.name for e in second.parsed_element ], ['GetDigits', 'Speak'])
+        self.assertEquals(second.parsed_element[0].action, 'http://127.0.0.1:5000/digits/')
+        self.assertEquals(second.parsed_element[0].children[0].text, 'Press 1')
+        # Each call gets its own elements
+        first.parsed_element[0].sound_files.append('a.wav')
+        self.assertEquals(second.parsed_element[0].sound_files, [])
+        self.assertTrue(second.parsed_element[0].children[0] \
+                            is not first.parsed_element[0].children[0])
+        # Another url is another document
+        third = TestParser(cache)
+        third.target_url = 'http://127.0.0.1:5000/other/'
+        third.lex_and_parse_xml()
+        self.assertEquals(cache.get_stats()['misses'], 2)
+
+    def test_play_url_checked_per_call(self):
+        checker = TestURLChecker()
+        helpers.set_url_checker(checker)
+        try:
+            cache = ParsedXMLCache()
+            calls = []
+            for exists in (False, True):
+                checker.exists_result = exists
+                parser = TestParser(cache)
+                parser.xml_response = PLAY_RESTXML
+                parser.lex_and_parse_xml()
+                play = parser.parsed_element[0]
+                play.prepare(parser)
+                calls.append(play.sound_file_path)
+        finally:
+            helpers.set_url_checker(None)
+        # Missing url when first parsed doesn't stay missing once cached
+        self.assertEquals(cache.get_stats()['hits'], 1)
+        self.assertEquals(calls, ['', 'shout://127.0.0.1:5000/a.mp3'])
+
+
+class TestElement(object):
+    def __init__(self, name, delay, log):
+        self.name = name
+        self.delay = delay
+        self.log = log
+
+    def get_audio_urls(self):
+        return []
+
+    def prepare(self, outbound_socket):
+        self.log.append('prepare %s' % self.name)
+        gevent.sleep(self.delay)
+        self.log.append('prepared %s' % self.name)
+
+    def run(self, outbound_socket):
+        self.log.append('run %s' % self.name)
+        gevent.sleep(0.02)
+
+
+class TestExecuteXML(TestCase):
+    def test_prepare_concurrently(self):
+        log = []
+        parser = TestParser(None)
+        parser.parsed_element = [TestElement('a', 0, log),
+                                 TestElement('b', 0.01, log)]
+        parser.execute_xml()
+        # b is prepared while a runs, runs only wait their own element
+        self.assertEquals(log, ['prepare a', 'prepare b', 'prepared a', 'run a',
+                                'prepared b', 'run b'])
+
+    def test_execute_while_parsing(self):
+        log = []
+        def stream():
+            yield TestElement('a', 0, log)
+            log.append('parsed b')
+            gevent.sleep(0.05)
+            yield TestElement('b', 0, log)
+            raise RESTFormatException('c')
+        parser = TestParser(None)
+        self.assertRaises(RESTFormatException, parser.execute_xml, stream())
+        # a runs while b is still being parsed
+        self.assertEquals(log, ['parsed b', 'prepare a', 'prepared a', 'run a',
+                                'prepare b', 'prepared b', 'run b'])
+
+
+class TestChunkedSource(object):
+    '''
+    File-like object returning a chunk per read.
+    '''
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        if self.chunks:
+            return self.chunks.pop(0)
+        return ''
+
+
+class TestIterXML(TestCase):
+    def test_stream(self):
+        source = TestChunkedSource(['\n  ', '<Response><Speak>Hi</Speak><Wa',
+                                    'it length="1"/></Response>'])
+        stream = iter_xml(source)
+        element = stream.next()
+        self.assertEquals((element.tag, element.text), ('Speak', 'Hi'))
+        # Yielded before the rest of the document is read
+        self.assertEquals(source.reads, 2)
+        self.assertEquals([ e.tag for e in stream ], ['Wait'])
+
+    def test_invalid(self):
+        for xml, error in (('<Speak>Hi</Speak>', RESTFormatException),
+                           ('<Response><Play>a', RESTSyntaxException),
+                           ('<Response><Foo/></Response>',
+                            UnrecognizedElementException),
+                           ('', RESTSyntaxException)):
+            self.assertRaises(error, list, iter_xml(TestChunkedSource([xml])))
+
+
+class TestSlowHTTPHandler(BaseHTTPRequestHandler):
+    '''
+    Sends the RESTXML in 2 parts, 0.5 second apart.
+    '''
+    protocol_version = 'HTTP/1.1'
+    parts = ['<Response><Speak>Hi</Speak>', '<Wait length="1"/></Response>']
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        if self.path == '/chunked/':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i, part in enumerate(self.parts):
+                time.sleep(i and 0.5)
+                self.wfile.write('%x\r\n%s\r\n' % (len(part), part))
+            self.wfile.write('0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', len(''.join(self.parts)))
+            self.end_headers()
+            for i, part in enumerate(self.parts):
+                time.sleep(i and 0.5)
+                self.wfile.write(part)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestIterXMLHTTP(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), TestSlowHTTPHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.pool = HTTPConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_stream(self):
+        for path in ('/', '/chunked/'):
+            start = time.time()
+            response = self.pool.open('GET', self.url + path)
+            try:
+                stream = iter_xml(response)
+                self.assertEquals(stream.next().tag, 'Speak')
+                # Yielded as soon as received, not once the body is read
+                self.assertTrue(time.time() - start < 0.4)
+                self.assertEquals([ e.tag for e in stream ], ['Wait'])
+                self.assertTrue(time.time() - start >= 0.5)
+            finally:
+                response.close()
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+
+from plivo.rest.freeswitch import urlvalidator
+from plivo.rest.freeswitch.urlvalidator import validate_url
+from plivo.rest.freeswitch.helpers import is_valid_url
+
+
+class TestValidateURL(TestCase):
+    def setUp(self):
+        urlvalidator.clear_cache()
+
+    def test_validate(self):
+        url = validate_url('http://media.example.com/hello.mp3')
+        self.assertEquals(url.scheme, 'http')
+        self.assertEquals(url.shout_url, 'shout://media.example.com/hello.mp3')
+        self.assertEquals(validate_url('127.0.0.1:8000/hello.mp3').shout_url,
+                          'shout://127.0.0.1:8000/hello.mp3')
+        self.assertEquals(validate_url(u'http://bücher.example/').scheme, 'http')
+        self.assertEquals(validate_url('/usr/local/sounds/hello.wav'), None)
+        self.assertTrue(is_valid_url('ftp://example.com/hello.mp3'))
+        self.assertFalse(is_valid_url('hello world'))
+
+    def test_cache(self):
+        old_size = urlvalidator.CACHE_SIZE
+        urlvalidator.CACHE_SIZE = 2
+        try:
+            first = validate_url('http://a.example.com/')
+            self.assertTrue(validate_url('http://a.example.com/') is first)
+            validate_url('http://b.example.com/')
+            validate_url('http://c.example.com/')
+            # Recently used results are kept
+            self.assertTrue(validate_url('http://a.example.com/') is first)
+            validate_url('http://d.example.com/')
+            validate_url('http://e.example.com/')
+            validate_url('http://f.example.com/')
+            self.assertFalse(validate_url('http://a.example.com/') is first)
+        finally:
+            urlvalidator.CACHE_SIZE = old_size
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2011 Plivo Team. See LICENSE for details.
+
+from unittest import TestCase
+import cgi
+import json
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import gevent
+
+from plivo.rest.freeswitch.webhooks import WebhookDispatcher
+
+
+class TestWebhookHandler(BaseHTTPRequestHandler):
+    '''
+    Records posted params, fails the first requests if asked by the test.
+    '''
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.errors:
+            self.server.errors -= 1
+            self.send_response(self.server.error_code)
+        else:
+            self.server.requests.append(dict(cgi.parse_qsl(body)))
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWebhookDispatcher(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), TestWebhookHandler)
+        self.server.requests = []
+        self.server.errors = 0
+        self.server.error_code = 500
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/hangup/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait(self, webhooks):
+        with gevent.Timeout(5):
+            while webhooks.get_queue_size():
+                gevent.sleep(0.01)
+
+    def test_retry(self):
+        webhooks = WebhookDispatcher(max_per_host=1, retry_delay=0.01)
+        self.server.errors = 2
+        for i in range(3):
+            self.assertTrue(webhooks.send(self.url, {'CallUUID': str(i)}))
+        self.assertEquals(webhooks.get_stats()['hosts'],
+                          {'127.0.0.1:%d' % self.server.server_port: 3})
+        self.wait(webhooks)
+        self.assertEquals([ r['CallUUID'] for r in self.server.requests ],
+                          ['0', '1', '2'])
+        stats = webhooks.get_stats()
+        self.assertEquals((stats['sent'], stats['retried'], stats['failed']),
+                          (3, 2, 0))
+        # Client errors are not retried
+        self.server.errors, self.server.error_code = 1, 404
+        webhooks.send(self.url, {'CallUUID': '3'})
+        self.wait(webhooks)
+        self.assertEquals(webhooks.get_stats()['failed'], 1)
+
+    def test_call_order(self):
+        webhooks = WebhookDispatcher(max_per_host=4, retry_delay=0.05)
+        # Ring notification of call 0 is retried, its hangup waits
+        self.server.errors = 1
+        webhooks.send(self.url, {'RequestUUID': '0', 'CallStatus': 'ringing'})
+        for i in range(1, 4):
+            webhooks.send(self.url, {'RequestUUID': str(i), 'CallStatus': 'ringing'})
+        webhooks.send(self.url, {'RequestUUID': '0', 'CallStatus': 'completed'})
+        self.wait(webhooks)
+        self.assertEquals([ r['CallStatus'] for r in self.server.requests
+                            if r['RequestUUID'] == '0' ], ['ringing', 'completed'])
+        self.assertEquals(len(self.server.requests), 5)
+
+    def test_queue_size(self):
+        webhooks = WebhookDispatcher(queue_size=2)
+        self.assertTrue(webhooks.send(self.url, {}))
+        self.assertTrue(webhooks.send(self.url, {}))
+        self.assertFalse(webhooks.send(self.url, {}))
+        self.wait(webhooks)
+        self.assertEquals(webhooks.get_stats()['dropped'], 1)
+        self.assertEquals(len(self.server.requests), 2)
+
+    def test_batch(self):
+        webhooks = WebhookDispatcher(batch_urls=[self.url], batch_size=3,
+                                     batch_interval=0.05)
+        for i in range(4):
+            webhooks.send(self.url, {'CallUUID': str(i)})
+        self.assertEquals(webhooks.get_stats()['batched'], 1)
+        self.wait(webhooks)
+        batches = [ json.loads(r['Batch']) for r in self.server.requests ]
+        self.assertEquals(batches, [[{'CallUUID': '0'}, {'CallUUID': '1'},
+                                     {'CallUUID': '2'}], [{'CallUUID': '3'}]])
+        self.assertEquals(webhooks.get_stats()['sent'], 4)
+
+    def test_flush_join(self):
+        webhooks = WebhookDispatcher(batch_urls=[self.url],
+                                     batch_interval=60)
+        webhooks.send(self.url, {'CallUUID': '1'})
+        webhooks.send(self.url + '?a=1', {'CallUUID': '2'})
+        # Pending batch is sent and deliveries are waited for
+        webhooks.flush()
+        self.assertTrue(webhooks.join(5))
+        self.assertEquals(len(self.server.requests), 2)
+        self.assertEquals(webhooks.get_stats()['sent'], 2)
+        # Timeout when a delivery is still retried
+        self.server.errors = 10
+        webhooks = WebhookDispatcher(retry_delay=1)
+        webhooks.send(self.url, {'CallUUID': '3'})
+        self.assertFalse(webhooks.join(0.1))